@@ -3,6 +3,11 @@ ASGI config for config project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Run it with an ASGI server, for example ``uvicorn config.asgi:application``.
+This is needed for the live event stream at /api/events/, which keeps one
+connection open per dashboard without tying up a worker thread, and is where
+the async dispenser views under /api/async/ pay off.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
@@ -50,6 +50,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'main_app.metrics.PerformanceMiddleware',  # first, so it times everything below it
+    'main_app.db_routing.ReadYourWritesMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -92,12 +94,65 @@ DATABASES = {
         'PASSWORD': os.getenv('DB_PASSWORD'),
         'HOST': os.getenv('DB_HOST'),
         'PORT': os.getenv('DB_PORT'),
+        # Keep connections open between requests instead of connecting on every request
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '60')),
+        'CONN_HEALTH_CHECKS': True,  # a connection the server closed is replaced instead of failing a request
     }
 }
 
+# Django's connection pool (needs psycopg 3: pip install "psycopg[binary,pool]").
+# Pooled connections go back to the pool after each request, so CONN_MAX_AGE must be 0.
+if os.getenv('DB_POOL') == 'True':
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['OPTIONS'] = {
+        'pool': {
+            'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+            'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '20')),
+        },
+    }
+
+# A read replica for the read-only GET views (see main_app/db_routing.py)
+if os.getenv('DB_REPLICA_HOST'):
+    DATABASES['replica'] = dict(
+        DATABASES['default'],
+        HOST=os.getenv('DB_REPLICA_HOST'),
+        PORT=os.getenv('DB_REPLICA_PORT', os.getenv('DB_PORT')),
+        TEST={'MIRROR': 'default'},  # tests use the primary's test database for it
+    )
+
+DATABASE_ROUTERS = ['main_app.db_routing.PrimaryReplicaRouter']
+
+DATABASE_REPLICA = {
+    'ALIAS': 'replica',
+    'STICKY_SECONDS': int(os.getenv('DB_REPLICA_STICKY_SECONDS', '5')),  # reads stay on the primary after a write
+    'CACHE_TIMEOUT': 5,  # seconds; API cache entries built from replica reads, which may lag
+}
+
 SECRET_KEY = os.getenv('SECRET_KEY')
 DEBUG = os.getenv('DEBUG') == 'True'
 
+# Cache
+# In-process memory by default (also used by the tests); set REDIS_URL to share the cache between workers.
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# How long cached floor/pantry/dispenser responses live (seconds); writes invalidate them earlier
+API_CACHE_TIMEOUT = int(os.getenv('API_CACHE_TIMEOUT', '300'))
+
+# How long /stats/ responses are reused (seconds); level updates don't invalidate them
+STATS_CACHE_TIMEOUT = int(os.getenv('STATS_CACHE_TIMEOUT', '10'))
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -142,7 +197,17 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+    ),
+    # orjson when it is installed, DRF's json otherwise (see main_app/renderers.py)
+    'DEFAULT_RENDERER_CLASSES': (
+        'main_app.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'main_app.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
 }
 
 SIMPLE_JWT = {
@@ -163,4 +228,29 @@ SIMPLE_JWT = {
 }
 
 
-CORS_ALLOW_ALL_ORIGINS = True
\ No newline at end of file
+CORS_ALLOW_ALL_ORIGINS = True
+
+# Low-level email alerts (see main_app/notifications.py)
+LOW_LEVEL_ALERTS = {
+    'ASYNC': os.getenv('LOW_LEVEL_ALERTS_ASYNC', 'True') == 'True',  # send from a background worker
+    'DIGEST_WINDOW_SECONDS': int(os.getenv('LOW_LEVEL_ALERTS_WINDOW', '30')),  # alerts in a window share one email
+    'FROM_EMAIL': 'no-reply@yourapp.com',
+    'DEFAULT_RECIPIENT': 'user@example.com',  # used when the floor owner has no email
+}
+
+# Per-route request metrics at /metrics (see main_app/metrics.py); set a token to keep it private
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# API keys of dispenser sensors (see main_app/device_auth.py)
+DEVICE_KEYS = {
+    'CACHE_SIZE': 10000,  # verified keys kept in memory per process
+    'CACHE_TTL': 60,  # seconds; a revoked key keeps working on other processes for at most this long
+}
+
+# Buffer sensor levels in memory and write them in batches (see main_app/write_behind.py).
+# Only for a single ingest process: each process has its own buffer.
+LEVEL_WRITE_BEHIND = {
+    'ENABLED': os.getenv('LEVEL_WRITE_BEHIND', 'False') == 'True',
+    'FLUSH_INTERVAL_MS': int(os.getenv('LEVEL_WRITE_BEHIND_INTERVAL_MS', '200')),  # one batch write per interval
+    'MAX_PENDING': 10000,  # dispensers waiting before a flush is forced
+}
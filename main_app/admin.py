@@ -1,6 +1,10 @@
 from django.contrib import admin
-from .models import Floor, Pantry, Dispenser
+from .models import Floor, Pantry, Dispenser, DispenserReading, DispenserRollup, DeviceKey, AlertRule
 
 admin.site.register(Floor)
 admin.site.register(Pantry)
 admin.site.register(Dispenser)
+admin.site.register(DispenserReading)
+admin.site.register(DispenserRollup)
+admin.site.register(DeviceKey)
+admin.site.register(AlertRule)
@@ -0,0 +1,86 @@
+"""
+Low-stock alert rules evaluated by the database.
+
+A dispenser alerts when it is below its own ``threshold`` (the ``is_low``
+column) or below the threshold of any active ``AlertRule`` that matches it: same
+owner, matching type and pantry (or none set), and a time window that contains
+the current time. All of that is one ``EXISTS`` subquery, so deciding which of
+any number of dispensers alert under any number of rules is a single query:
+
+    SELECT ... FROM dispenser WHERE is_low OR EXISTS (SELECT 1 FROM alertrule WHERE ...)
+
+Level updates get the answer in the query that reads the dispenser back
+(``with_alerting``). The ``sweep_alerts`` command runs the same condition over
+every dispenser, which catches rules that start to apply at a time of day
+without any new reading.
+
+Times of day are in ``TIME_ZONE``.
+"""
+from django.db.models import BigIntegerField, BooleanField, Exists, ExpressionWrapper, F, OuterRef, Q
+from django.db.models.functions import Cast
+from django.db.models.lookups import GreaterThan
+from django.utils import timezone
+
+from .models import AlertRule, Dispenser
+from .notifications import LowLevelAlert, notifier, send_digest
+
+
+def in_window(time_of_day):
+    """Rules whose time window contains ``time_of_day``. A window with start after end wraps past midnight."""
+    return (
+        Q(start_time__isnull=True, end_time__isnull=True)
+        | Q(start_time__isnull=True, end_time__gt=time_of_day)
+        | Q(end_time__isnull=True, start_time__lte=time_of_day)
+        | (Q(start_time__lte=F('end_time')) & Q(start_time__lte=time_of_day, end_time__gt=time_of_day))
+        | (Q(start_time__gt=F('end_time')) & (Q(start_time__lte=time_of_day) | Q(end_time__gt=time_of_day)))
+    )
+
+
+def breached_rules(now=None):
+    """
+    Subquery of the active rules that match the outer dispenser and that its level
+    is below. Like ``is_low``, the percentage is compared in (big) integers:
+    ``current_level * 100 < threshold * max_capacity``.
+    """
+    time_of_day = timezone.localtime(now or timezone.now()).time()
+    return AlertRule.objects.filter(
+        in_window(time_of_day),
+        Q(dispenser_type='') | Q(dispenser_type=OuterRef('type')),
+        Q(pantry__isnull=True) | Q(pantry=OuterRef('pantry')),
+        GreaterThan(
+            Cast('threshold', BigIntegerField()) * OuterRef('max_capacity'),
+            Cast(OuterRef('current_level'), BigIntegerField()) * 100,
+        ),
+        active=True,
+        user=OuterRef('owner'),
+    )
+
+
+def alerting_condition(now=None):
+    return Q(is_low=True) | Exists(breached_rules(now))
+
+
+def alerting_dispensers(now=None):
+    """Every dispenser that should alert right now"""
+    return Dispenser.objects.filter(alerting_condition(now))
+
+
+def with_alerting(queryset, now=None):
+    """Adds an ``alerting`` boolean to every dispenser of ``queryset``, computed in the same query"""
+    return queryset.annotate(alerting=ExpressionWrapper(alerting_condition(now), output_field=BooleanField()))
+
+
+def sweep(now=None):
+    """
+    Alert for every dispenser that should alert now and hasn't yet, in one digest
+    email per recipient. Returns the number of new alerts.
+    """
+    queryset = alerting_dispensers(now).select_related('pantry__floor__user').order_by('id')
+    alerts = [
+        LowLevelAlert.from_dispenser(dispenser)
+        for dispenser in queryset.iterator(chunk_size=2000)
+        if notifier.claim(dispenser.id, is_low=True)
+    ]
+    if alerts:
+        send_digest(alerts)
+    return len(alerts)
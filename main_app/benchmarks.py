@@ -0,0 +1,408 @@
+"""
+Benchmarks for the API hot paths, run by ``python manage.py run_benchmarks``.
+
+Each benchmark is a function registered with ``@benchmark(name)``. It gets the
+seeded ``BenchmarkContext`` and returns a callable that performs one operation.
+The runner calls it repeatedly and records:
+
+- latency (mean, p50, p95, p99) in milliseconds
+- throughput in operations per second
+- the number of SQL queries one operation runs
+
+Results are plain JSON, so they can be saved as a baseline and diffed in review.
+Every request must get a 2xx response; anything else stops the run with a
+``BenchmarkError``, since its timing would be that of the error path.
+
+The runner replaces the cache with a dummy one (``BENCHMARK_CACHES``), so the
+read benchmarks measure the views and their queries, not cache hits.
+
+The ``*-concurrent`` benchmarks compare the sync views under WSGI with the async
+views under ASGI at high concurrency. One operation is a burst of
+``CONCURRENCY`` simultaneous requests: the WSGI side runs them on a pool of
+threads (one per worker, each with its own database connection, like a threaded
+WSGI server), the ASGI side runs them as tasks on one event loop the way
+``config/asgi.py`` would. For these, latency is per burst and ``ops_per_s``
+counts requests; the query count is that of a single request.
+"""
+import asyncio
+import platform
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import django
+from asgiref.sync import ThreadSensitiveContext, async_to_sync
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection, reset_queries
+from django.test import AsyncClient
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .device_auth import issue_keys
+from .loadgen import percentile
+from .models import Floor, Pantry, Dispenser
+from .renderers import FastJSONRenderer
+from .sample_data import generate
+from .serializers import DispenserSerializer, DispenserValuesSerializer
+
+BENCHMARKS = {}
+
+BENCH_USERNAME = 'benchuser'
+BENCH_PASSWORD = 'bench-password-123'
+
+CONCURRENCY = 50
+
+BENCHMARK_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+
+class BenchmarkError(Exception):
+    """A benchmarked request got an error response"""
+
+
+def ok(response):
+    """Return the response, or raise ``BenchmarkError`` unless it is a 2xx"""
+    if not 200 <= response.status_code < 300:
+        raise BenchmarkError(f"{response.status_code} response: {response.content[:200].decode(errors='replace')}")
+    return response
+
+
+def benchmark(name, concurrent_writes=False):
+    """
+    Register a benchmark setup function under ``name``. ``concurrent_writes``
+    marks benchmarks that write from many connections at once, which SQLite's
+    in-memory test database can't do.
+    """
+    def register(setup):
+        setup.concurrent_writes = concurrent_writes
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+@dataclass
+class BenchmarkContext:
+    user: object
+    client: object  # authenticated APIClient
+    token: str  # its access token, for clients created by the benchmarks
+    dispenser_ids: list
+    pantry_ids: list
+    floor_ids: list
+
+
+def seed(users=1, floors=5, pantries=3, dispensers=3):
+    """Create the benchmark dataset with bulk inserts and return a context for it"""
+    generate(users, floors, pantries, dispensers, username=BENCH_USERNAME, password=BENCH_PASSWORD, seed=0)
+    owners = list(User.objects.filter(username__startswith=BENCH_USERNAME).order_by('id'))
+
+    # A real token rather than force_authenticate, so the JWT check and user lookup are measured too
+    token = str(RefreshToken.for_user(owners[0]).access_token)
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+    return BenchmarkContext(
+        user=owners[0],
+        client=client,
+        token=token,
+        dispenser_ids=list(Dispenser.objects.values_list('id', flat=True)),
+        pantry_ids=list(Pantry.objects.values_list('id', flat=True)),
+        floor_ids=list(Floor.objects.values_list('id', flat=True)),
+    )
+
+
+# --------------------------------------------------------
+# BENCHMARKS
+# --------------------------------------------------------
+
+@benchmark('update-level')
+def bench_update_level(ctx):
+    ids = ctx.dispenser_ids
+    state = {'i': 0}
+
+    def run():
+        state['i'] += 1
+        dispenser_id = ids[state['i'] % len(ids)]
+        ok(ctx.client.post(f'/api/dispensers/{dispenser_id}/update-level/',
+                           {'current_level': 20 + state['i'] % 80}, format='json'))
+    return run
+
+
+@benchmark('update-level-device-key')
+def bench_update_level_device_key(ctx):
+    keys = issue_keys(ctx.dispenser_ids[:10])  # few enough for the warmup to put all of them in the key cache
+    ids = list(keys)
+    client = APIClient()
+    state = {'i': 0}
+
+    def run():
+        state['i'] += 1
+        dispenser_id = ids[state['i'] % len(ids)]
+        ok(client.post(f'/api/dispensers/{dispenser_id}/update-level/', {'current_level': 20 + state['i'] % 80},
+                       format='json', HTTP_AUTHORIZATION=f'Device {keys[dispenser_id]}'))
+    return run
+
+
+@benchmark('dispenser-list')
+def bench_dispenser_list(ctx):
+    return lambda: ok(ctx.client.get('/api/dispensers/'))
+
+
+@benchmark('pantry-list')
+def bench_pantry_list(ctx):
+    return lambda: ok(ctx.client.get('/api/pantries/'))
+
+
+@benchmark('floor-list')
+def bench_floor_list(ctx):
+    return lambda: ok(ctx.client.get('/api/floors/'))
+
+
+@benchmark('refill-plan')
+def bench_refill_plan(ctx):
+    # Every other dispenser needs a refill, so the route visits most pantries
+    Dispenser.objects.filter(id__in=ctx.dispenser_ids[::2]).update(current_level=1)
+    return lambda: ok(ctx.client.get('/api/refill-plan/'))
+
+
+@benchmark('stats')
+def bench_stats(ctx):
+    def run():
+        # The uncached path: the grouped query and the rollup
+        cache.delete(f'api:stats:{ctx.user.pk}')
+        ok(ctx.client.get('/api/stats/'))
+    return run
+
+
+@benchmark('login')
+def bench_login(ctx):
+    client = APIClient()
+    return lambda: ok(client.post('/api/users/login/',
+                                  {'username': BENCH_USERNAME, 'password': BENCH_PASSWORD}, format='json'))
+
+
+@benchmark('token-refresh')
+def bench_token_refresh(ctx):
+    return lambda: ok(ctx.client.get('/api/users/token/refresh/'))
+
+
+# --------------------------------------------------------
+# SERIALIZATION (ALL DISPENSERS OF THE USER IN ONE LIST)
+# --------------------------------------------------------
+
+def _dispensers(ctx):
+    return Dispenser.objects.filter(owner=ctx.user).order_by('id')
+
+
+@benchmark('serialize-model')
+def bench_serialize_model(ctx):
+    return lambda: DispenserSerializer(_dispensers(ctx), many=True).data
+
+
+@benchmark('serialize-values')
+def bench_serialize_values(ctx):
+    return lambda: list(DispenserValuesSerializer.values(_dispensers(ctx)))
+
+
+@benchmark('render-json')
+def bench_render_json(ctx):
+    rows = list(DispenserValuesSerializer.values(_dispensers(ctx)))
+    return lambda: JSONRenderer().render(rows)
+
+
+@benchmark('render-fast-json')
+def bench_render_fast_json(ctx):
+    rows = list(DispenserValuesSerializer.values(_dispensers(ctx)))
+    return lambda: FastJSONRenderer().render(rows)
+
+
+# --------------------------------------------------------
+# CONCURRENT BENCHMARKS (WSGI THREADS VS ASGI EVENT LOOP)
+# --------------------------------------------------------
+
+class WsgiBurst:
+    """Sends ``concurrency`` requests at once from a pool of threads, each with its own client"""
+
+    def __init__(self, ctx, make_request, concurrency=CONCURRENCY):
+        self.batch = concurrency
+        self.make_request = make_request  # (client, i) -> response
+        self.pool = ThreadPoolExecutor(concurrency)
+        self.local = threading.local()
+        self.token = ctx.token
+        self.calls = 0
+
+    def client(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = APIClient()
+            self.local.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        return self.local.client
+
+    def __call__(self):
+        start, self.calls = self.calls, self.calls + self.batch
+        futures = [self.pool.submit(lambda i=i: self.make_request(self.client(), i))
+                   for i in range(start, start + self.batch)]
+        for future in futures:
+            ok(future.result())
+
+    def single(self):
+        ok(self.make_request(self.client(), self.calls))
+
+    def close(self):
+        # One task per thread (the barrier keeps a thread from taking two) closes that thread's connection
+        barrier = threading.Barrier(self.batch)
+
+        def close_connection():
+            connection.close()
+            barrier.wait()
+        for future in [self.pool.submit(close_connection) for _ in range(self.batch)]:
+            future.result()
+        self.pool.shutdown()
+
+
+class AsgiBurst:
+    """Sends ``concurrency`` requests at once as tasks on one event loop"""
+
+    def __init__(self, ctx, make_request, concurrency=CONCURRENCY):
+        self.batch = concurrency
+        self.make_request = make_request  # async (client, headers, i) -> response
+        self.client = AsyncClient()
+        # Sent with every request; AsyncClient(headers=...) doesn't turn them into ASGI headers
+        self.headers = {'Authorization': f'Bearer {ctx.token}'}
+        self.calls = 0
+
+    async def request(self, i):
+        # The ASGI handler gives every request its own thread for sync code; the test client doesn't
+        async with ThreadSensitiveContext():
+            return await self.make_request(self.client, self.headers, i)
+
+    async def burst(self, start):
+        for response in await asyncio.gather(*(self.request(i) for i in range(start, start + self.batch))):
+            ok(response)
+
+    def __call__(self):
+        start, self.calls = self.calls, self.calls + self.batch
+        async_to_sync(self.burst)(start)
+
+    def single(self):
+        # Without the per-request thread, so the queries run on (and are counted on) this connection
+        ok(async_to_sync(self.make_request)(self.client, self.headers, self.calls))
+
+
+def _level_body(i):
+    return {'current_level': 20 + i % 80}
+
+
+@benchmark('update-level-concurrent', concurrent_writes=True)
+def bench_update_level_concurrent(ctx):
+    ids = ctx.dispenser_ids
+    return WsgiBurst(ctx, lambda client, i: client.post(
+        f'/api/dispensers/{ids[i % len(ids)]}/update-level/', _level_body(i), format='json'))
+
+
+@benchmark('update-level-async-concurrent', concurrent_writes=True)
+def bench_update_level_async_concurrent(ctx):
+    ids = ctx.dispenser_ids
+
+    async def request(client, headers, i):
+        return await client.post(f'/api/async/dispensers/{ids[i % len(ids)]}/update-level/',
+                                 _level_body(i), content_type='application/json', headers=headers)
+    return AsgiBurst(ctx, request)
+
+
+@benchmark('dispenser-detail-concurrent')
+def bench_dispenser_detail_concurrent(ctx):
+    ids = ctx.dispenser_ids
+    return WsgiBurst(ctx, lambda client, i: client.get(f'/api/dispensers/{ids[i % len(ids)]}/'))
+
+
+@benchmark('dispenser-detail-async-concurrent')
+def bench_dispenser_detail_async_concurrent(ctx):
+    ids = ctx.dispenser_ids
+
+    async def request(client, headers, i):
+        return await client.get(f'/api/async/dispensers/{ids[i % len(ids)]}/', headers=headers)
+    return AsgiBurst(ctx, request)
+
+
+# --------------------------------------------------------
+# RUNNER
+# --------------------------------------------------------
+
+def measure(operation, iterations, warmup):
+    """
+    Time ``iterations`` calls of ``operation`` after ``warmup`` untimed calls.
+    An operation that sends a burst of requests has a ``batch`` size and a
+    ``single()`` method that sends just one.
+    """
+    batch = getattr(operation, 'batch', 1)
+    for _ in range(warmup):
+        operation()
+
+    # Count the queries of a single call separately so timing runs without the capture overhead.
+    # Each request clears the query log when it starts, so start from an empty log.
+    reset_queries()
+    with CaptureQueriesContext(connection) as captured:
+        getattr(operation, 'single', operation)()
+    queries = len(captured.captured_queries)  # read now, the log is cleared by the next request
+
+    timings = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        begin = time.perf_counter()
+        operation()
+        timings.append(time.perf_counter() - begin)
+    total = time.perf_counter() - started
+
+    timings.sort()
+    return {
+        'iterations': iterations,
+        'queries': queries,
+        'mean_ms': round(statistics.fmean(timings) * 1000, 3),
+        'p50_ms': round(percentile(timings, 50) * 1000, 3),
+        'p95_ms': round(percentile(timings, 95) * 1000, 3),
+        'p99_ms': round(percentile(timings, 99) * 1000, 3),
+        'ops_per_s': round(iterations * batch / total, 1),
+    }
+
+
+def run_benchmarks(names, ctx, iterations=200, warmup=20):
+    results = {}
+    for name in names:
+        operation = BENCHMARKS[name](ctx)
+        try:
+            results[name] = measure(operation, iterations, warmup)
+        except BenchmarkError as error:
+            raise BenchmarkError(f'{name}: {error}') from error
+        finally:
+            if hasattr(operation, 'close'):
+                operation.close()
+    return results
+
+
+def environment(dataset):
+    return {
+        'database': connection.vendor,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'dataset': dataset,
+    }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    List the regressions of ``results`` against ``baseline``: a benchmark is
+    flagged when its p50 latency grew by more than ``tolerance`` (0.2 = 20%)
+    or when it runs more queries than before.
+    """
+    regressions = []
+    for name, current in results['benchmarks'].items():
+        previous = baseline.get('benchmarks', {}).get(name)
+        if previous is None:
+            continue
+        if current['queries'] > previous['queries']:
+            regressions.append(f"{name}: {previous['queries']} -> {current['queries']} queries")
+        if current['p50_ms'] > previous['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {previous['p50_ms']} ms -> {current['p50_ms']} ms")
+    return regressions
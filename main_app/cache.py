@@ -0,0 +1,125 @@
+"""
+Read-through cache for the floor, pantry and dispenser GET endpoints.
+
+- Detail responses are cached per object, version and user. Saving or deleting
+  the object moves it to a new version, so only that object's entry goes stale.
+  Every entry is built from the querysets of the user who asked, so one tenant
+  never gets another tenant's cached response.
+- List responses are cached per model and owner *version*. A change to a row
+  bumps the version of its owner only, so every cached list of that tenant and
+  model is skipped from then on and simply expires later. One tenant's sensor
+  writes never throw away another tenant's lists, and writing a dispenser never
+  touches the floor or pantry caches.
+- Versions are read *before* the database, so a write that lands while a
+  response is being built can never leave a stale entry under the current key.
+- Entries built from the read replica are kept apart from those built from the
+  primary. A client pinned to the primary after a write (see ``db_routing``)
+  never gets an entry another session built from a replica that lagged behind.
+- Every cached entry carries an ETag. A client that sends it back in
+  ``If-None-Match`` gets an empty ``304 Not Modified`` without a database hit.
+
+Saves and deletes through the ORM are picked up by the signal handlers in
+``signals.py``. Code that writes with ``bulk_update`` or ``QuerySet.update``
+bypasses signals and must call ``invalidate`` itself.
+"""
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework import status
+from rest_framework.response import Response
+
+from .db_routing import get_setting as replica_setting, reading_from_replica
+
+
+def _timeout():
+    timeout = getattr(settings, 'API_CACHE_TIMEOUT', 300)
+    if reading_from_replica():
+        # A lagging replica can return rows older than the version they are cached under,
+        # so such entries are only kept for about as long as the replica may lag
+        return min(timeout, replica_setting('CACHE_TIMEOUT'))
+    return timeout
+
+
+def _version(key):
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock so a lost or reset version never repeats an old one
+        cache.add(key, int(time.time() * 1000), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def _source():
+    return 'replica' if reading_from_replica() else 'primary'
+
+
+def _list_version_key(model_name, owner_id):
+    return f'api:{model_name}:list:{owner_id}:version'
+
+
+def _object_version_key(model_name, pk):
+    return f'api:{model_name}:{pk}:version'
+
+
+def invalidate(model_name, pks=(), owners=()):
+    """Make the cached details of ``pks`` and the cached lists of the model of each of ``owners`` stale"""
+    if pks:
+        cache.delete_many([_object_version_key(model_name, pk) for pk in pks])
+    for owner_id in set(owners):
+        try:
+            cache.incr(_list_version_key(model_name, owner_id))
+        except ValueError:
+            # No version yet, so nothing is cached under one
+            pass
+
+
+def make_entry(data):
+    body = json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True).encode()
+    return {'data': data, 'etag': f'"{hashlib.md5(body).hexdigest()}"'}
+
+
+def cached_response(request, entry):
+    """The cached data, or a 304 when the client already has this version"""
+    if entry['etag'] in request.headers.get('If-None-Match', ''):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(entry['data'])
+    response['ETag'] = entry['etag']
+    return response
+
+
+class CachedRetrieveMixin:
+    """Caches ``retrieve`` per object and user. Set ``cache_name`` on the view."""
+    cache_name = None
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = kwargs[self.lookup_field]
+        version = _version(_object_version_key(self.cache_name, pk))
+        key = f'api:{self.cache_name}:{pk}:{version}:{request.user.pk}:{_source()}'
+        entry = cache.get(key)
+        if entry is None:
+            entry = make_entry(super().retrieve(request, *args, **kwargs).data)
+            cache.set(key, entry, _timeout())
+        return cached_response(request, entry)
+
+
+class CachedListMixin:
+    """
+    Caches ``list`` per version, user and full URL (filters, cursor, fields). The
+    view must only list rows the user owns, so that their version covers it.
+    """
+    cache_name = None
+
+    def list(self, request, *args, **kwargs):
+        path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+        version = _version(_list_version_key(self.cache_name, request.user.pk))
+        key = f'api:{self.cache_name}:list:{version}:{request.user.pk}:{_source()}:{path}'
+        entry = cache.get(key)
+        if entry is None:
+            entry = make_entry(super().list(request, *args, **kwargs).data)
+            cache.set(key, entry, _timeout())
+        return cached_response(request, entry)
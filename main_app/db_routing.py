@@ -0,0 +1,130 @@
+"""
+Read replica routing.
+
+Writes, and every read that isn't marked otherwise, go to the primary
+(``default``). The read-only GET views (``ReplicaReadMixin``) run their queries
+on the replica alias instead, when one is configured. Reads in write paths, such
+as the read-back after a level update, always see the primary.
+
+A replica lags behind the primary a little, so a client that just wrote could
+read its old data back. After a successful POST, PUT, PATCH or DELETE,
+``ReadYourWritesMiddleware`` sets a cookie. For ``STICKY_SECONDS`` after that, the
+client's reads stay on the primary.
+
+Configure it with the ``DATABASE_REPLICA`` setting; without a database under
+``ALIAS`` everything uses the primary.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+DEFAULTS = {
+    'ALIAS': 'replica',
+    'STICKY_SECONDS': 5,
+    'COOKIE': 'read_primary_until',
+    'CACHE_TIMEOUT': 5,  # seconds; API cache entries built from replica reads
+}
+
+UNSAFE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+# The alias the router sends reads to (None: the primary), and whether the
+# current request must read from the primary
+_read_alias = ContextVar('read_alias', default=None)
+_pinned = ContextVar('pinned_to_primary', default=False)
+
+
+def get_setting(name):
+    return getattr(settings, 'DATABASE_REPLICA', {}).get(name, DEFAULTS[name])
+
+
+def replica_alias():
+    """The replica's alias, or None when there is no replica"""
+    alias = get_setting('ALIAS')
+    return alias if alias in connections.databases else None
+
+
+def reading_from_replica():
+    return _read_alias.get() is not None
+
+
+@contextmanager
+def read_from_replica():
+    """Route the reads inside the block to the replica, unless the request must see its own writes"""
+    alias = replica_alias()
+    if alias is None or _pinned.get():
+        yield
+        return
+    token = _read_alias.set(alias)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+class PrimaryReplicaRouter:
+    """``DATABASE_ROUTERS`` entry: writes to the primary, reads wherever ``read_from_replica`` says"""
+
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data
+        return True
+
+
+class ReplicaReadMixin:
+    """Serves GET from the replica. Put it first, so it wraps everything the view reads."""
+
+    def get(self, request, *args, **kwargs):
+        with read_from_replica():
+            return super().get(request, *args, **kwargs)
+
+
+class ReadYourWritesMiddleware:
+    """Keeps a client's reads on the primary for a few seconds after it wrote something"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = _pinned.set(self.is_pinned(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            _pinned.reset(token)
+        return self.finish(request, response)
+
+    async def __acall__(self, request):
+        token = _pinned.set(self.is_pinned(request))
+        try:
+            response = await self.get_response(request)
+        finally:
+            _pinned.reset(token)
+        return self.finish(request, response)
+
+    def is_pinned(self, request):
+        try:
+            return float(request.COOKIES.get(get_setting('COOKIE'), 0)) > time.time()
+        except ValueError:
+            return False
+
+    def finish(self, request, response):
+        if request.method in UNSAFE_METHODS and response.status_code < 400 and replica_alias() is not None:
+            sticky = get_setting('STICKY_SECONDS')
+            response.set_cookie(
+                get_setting('COOKIE'), f'{time.time() + sticky:.3f}', max_age=sticky, httponly=True, samesite='Lax',
+            )
+        return response
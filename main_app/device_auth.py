@@ -0,0 +1,178 @@
+"""
+API keys for IoT sensors.
+
+A sensor sends ``Authorization: Device <key>``. A key belongs to one dispenser
+and only works on that dispenser's update-level endpoint, so a leaked sensor
+can't read or change anything else. The human ``User`` is never loaded.
+
+Only a SHA-256 hash of each key is stored. Verified keys are kept in an
+in-process LRU cache (hash -> dispenser id), so after the first request a
+sensor's readings are authenticated without touching the database. Unknown
+keys are cached too, so a device with a wrong key can't hammer the database.
+Entries expire after ``CACHE_TTL`` seconds; that is how long a revoked key can
+keep working on other workers.
+
+Configure it with the ``DEVICE_KEYS`` setting.
+"""
+import hashlib
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from django.conf import settings
+from rest_framework import exceptions, permissions
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+
+from .models import DeviceKey
+
+KEYWORD = 'Device'
+KEY_PREFIX = 'pbk_'
+
+DEFAULTS = {
+    'CACHE_SIZE': 10000,
+    'CACHE_TTL': 60,
+}
+
+
+def get_setting(name):
+    return getattr(settings, 'DEVICE_KEYS', {}).get(name, DEFAULTS[name])
+
+
+def hash_key(raw_key):
+    # Keys are 256 random bits, so a fast hash is enough; a slow password hash would defeat the cache
+    return hashlib.sha256(raw_key.encode()).hexdigest()
+
+
+def issue_keys(dispenser_ids):
+    """Create one new key per dispenser and return ``{dispenser_id: key}``. The keys can't be recovered later."""
+    keys = {dispenser_id: KEY_PREFIX + secrets.token_urlsafe(32) for dispenser_id in dispenser_ids}
+    DeviceKey.objects.bulk_create((
+        DeviceKey(dispenser_id=dispenser_id, prefix=key[:12], key_hash=hash_key(key))
+        for dispenser_id, key in keys.items()
+    ), batch_size=1000)
+    return keys
+
+
+def revoke_keys(queryset):
+    """Revoke keys now in this process; other processes notice when their cache entry expires"""
+    hashes = list(queryset.values_list('key_hash', flat=True))
+    queryset.update(revoked=True)
+    for key_hash in hashes:
+        key_cache.discard(key_hash)
+
+
+MISSING = object()
+
+
+class KeyCache:
+    """Thread-safe LRU of key hash -> dispenser id (None for unknown keys), with a TTL"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key hash -> (dispenser id, expires at)
+
+    def get(self, key_hash):
+        with self._lock:
+            entry = self._entries.get(key_hash)
+            if entry is None:
+                return MISSING
+            if entry[1] < time.monotonic():
+                del self._entries[key_hash]
+                return MISSING
+            self._entries.move_to_end(key_hash)
+            return entry[0]
+
+    def set(self, key_hash, dispenser_id):
+        with self._lock:
+            self._entries[key_hash] = (dispenser_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key_hash)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, key_hash):
+        with self._lock:
+            self._entries.pop(key_hash, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+key_cache = KeyCache(get_setting('CACHE_SIZE'), get_setting('CACHE_TTL'))
+
+
+def _active_keys(key_hash):
+    return DeviceKey.objects.filter(key_hash=key_hash, revoked=False).values_list('dispenser_id', flat=True)
+
+
+def dispenser_for_key(raw_key):
+    """The dispenser a key belongs to, or None for an unknown or revoked key"""
+    key_hash = hash_key(raw_key)
+    dispenser_id = key_cache.get(key_hash)
+    if dispenser_id is MISSING:
+        dispenser_id = _active_keys(key_hash).first()
+        key_cache.set(key_hash, dispenser_id)
+    return dispenser_id
+
+
+async def adispenser_for_key(raw_key):
+    """Async version of ``dispenser_for_key``"""
+    key_hash = hash_key(raw_key)
+    dispenser_id = key_cache.get(key_hash)
+    if dispenser_id is MISSING:
+        dispenser_id = await _active_keys(key_hash).afirst()
+        key_cache.set(key_hash, dispenser_id)
+    return dispenser_id
+
+
+def get_raw_key(header):
+    """
+    The key from an ``Authorization`` header value (bytes), None when the header
+    isn't a device key. Raises AuthenticationFailed for a malformed one.
+    """
+    parts = header.split()
+    if not parts or parts[0].decode('latin-1').lower() != KEYWORD.lower():
+        return None
+    if len(parts) != 2:
+        raise exceptions.AuthenticationFailed('Invalid device key header. It must be "Device <key>".')
+    return parts[1].decode('latin-1')
+
+
+@dataclass(frozen=True)
+class DeviceIdentity:
+    """``request.user`` and ``request.auth`` of a request made with a device key"""
+    dispenser_id: int
+    pk = None
+    is_authenticated = True
+    is_anonymous = False
+
+
+class DeviceKeyAuthentication(BaseAuthentication):
+    """Authenticates ``Authorization: Device <key>`` without loading a user"""
+
+    def authenticate(self, request):
+        raw_key = get_raw_key(get_authorization_header(request))
+        if raw_key is None:
+            return None
+        dispenser_id = dispenser_for_key(raw_key)
+        if dispenser_id is None:
+            raise exceptions.AuthenticationFailed('Invalid or revoked device key.')
+        identity = DeviceIdentity(dispenser_id)
+        return identity, identity
+
+    def authenticate_header(self, request):
+        return KEYWORD
+
+
+class DeviceKeyScope(permissions.BasePermission):
+    """A device key only works for the dispenser in the URL"""
+    message = 'This device key belongs to another dispenser.'
+
+    def has_permission(self, request, view):
+        if isinstance(request.auth, DeviceIdentity):
+            return request.auth.dispenser_id == view.kwargs.get('id')
+        return True
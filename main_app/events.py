@@ -0,0 +1,126 @@
+"""
+Live dispenser events for dashboards, pushed with Server-Sent Events.
+
+Clients subscribe to floors and/or pantries on ``/api/events/`` and get a
+``level`` event every time a dispenser there reports a new level, plus a
+``low_stock`` event when a dispenser goes low. This replaces polling
+``/api/dispensers/``.
+
+The views publish events from ordinary (sync) request threads; subscribers are
+asyncio tasks of the ASGI server. The default ``InMemoryBroker`` hands events
+between the two inside one process, which is enough for a single node and for
+tests. For several nodes, point ``DISPENSER_EVENT_BROKER`` at a broker class
+with the same ``publish``/``subscribe`` interface backed by e.g. Redis pub/sub.
+"""
+import asyncio
+import json
+import threading
+from collections import defaultdict
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+
+def floor_channel(floor_id):
+    return f'floor:{floor_id}'
+
+
+def pantry_channel(pantry_id):
+    return f'pantry:{pantry_id}'
+
+
+class Subscription:
+    """The events of some channels, queued for one connected client"""
+
+    def __init__(self, broker, channels, max_queue):
+        self.broker = broker
+        self.channels = channels
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=max_queue)
+
+    def put(self, event):
+        # A client that can't keep up loses its oldest events instead of growing memory
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout=None):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InMemoryBroker:
+    """Fan-out of events to the subscribers in this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)  # channel -> subscriptions
+
+    def subscribe(self, channels, max_queue=100):
+        """Must be called from the event loop that will read the events"""
+        subscription = Subscription(self, list(channels), max_queue)
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscribers[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscribers[channel].discard(subscription)
+                if not self._subscribers[channel]:
+                    del self._subscribers[channel]
+
+    def publish(self, channels, event):
+        """Safe to call from any thread. A client subscribed to several of the channels gets the event once."""
+        with self._lock:
+            targets = set()
+            for channel in channels:
+                targets.update(self._subscribers.get(channel, ()))
+        for subscription in targets:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:
+                # The client's event loop is already closed
+                self.unsubscribe(subscription)
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    path = getattr(settings, 'DISPENSER_EVENT_BROKER', 'main_app.events.InMemoryBroker')
+    return import_string(path)()
+
+
+def publish_level_change(dispenser, went_low=False):
+    """
+    Tell the subscribers of the dispenser's floor and pantry about its new level.
+    Sent after the transaction commits, so clients never see a rolled-back level.
+    ``dispenser.pantry`` must already be loaded (``select_related('pantry')``).
+    """
+    event = {
+        'dispenser': dispenser.id,
+        'pantry': dispenser.pantry_id,
+        'floor': dispenser.pantry.floor_id,
+        'type': dispenser.type,
+        'current_level': dispenser.current_level,
+        'max_capacity': dispenser.max_capacity,
+        'is_low': dispenser.is_running_low(),
+    }
+    channels = [floor_channel(event['floor']), pantry_channel(event['pantry'])]
+
+    def send():
+        broker = get_broker()
+        broker.publish(channels, {'event': 'level', 'data': event})
+        if went_low:
+            broker.publish(channels, {'event': 'low_stock', 'data': event})
+
+    transaction.on_commit(send)
+
+
+def format_sse(event):
+    """Encode an event in the text/event-stream wire format"""
+    return f"event: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
@@ -0,0 +1,105 @@
+"""
+Depletion forecasting: how long until each dispenser runs empty.
+
+The consumption rate of every dispenser is an exponentially weighted average of
+its hourly consumption (from the hourly rollups), so recent hours count more
+than older ones. All dispensers are handled at once with NumPy arrays instead of
+a Python loop per dispenser:
+
+    consumption matrix (dispensers x hours) @ decay weights -> rate per hour
+    current_level / rate                                    -> hours to empty
+"""
+from dataclasses import dataclass
+from datetime import timedelta
+
+import numpy as np
+from django.utils import timezone
+
+from .models import Dispenser, DispenserForecast, DispenserRollup
+from .rollups import hour_of
+
+DEFAULT_WINDOW_HOURS = 24
+DEFAULT_ALPHA = 0.3  # weight of the newest hour; higher reacts faster to changes
+
+
+@dataclass
+class Forecasts:
+    """Forecast arrays, one entry per dispenser, in ``dispenser_ids`` order"""
+    computed_at: object
+    dispenser_ids: np.ndarray
+    levels: np.ndarray
+    rates: np.ndarray
+    hours_to_empty: np.ndarray  # inf when the dispenser is not being used
+
+    def within(self, hours):
+        """Ids and hours to empty of the dispensers that run empty within ``hours``, soonest first"""
+        mask = self.hours_to_empty <= hours
+        order = np.argsort(self.hours_to_empty[mask], kind='stable')
+        return self.dispenser_ids[mask][order], self.hours_to_empty[mask][order]
+
+
+def decay_weights(window_hours, alpha):
+    """Exponential weights for the hours of the window, oldest first, summing to 1"""
+    ages = np.arange(window_hours - 1, -1, -1)
+    weights = alpha * (1 - alpha) ** ages
+    return weights / weights.sum()
+
+
+def compute_forecasts(window_hours=DEFAULT_WINDOW_HOURS, alpha=DEFAULT_ALPHA, now=None):
+    """Forecast every dispenser from the hourly rollups of the last ``window_hours``"""
+    now = now or timezone.now()
+    start = hour_of(now) - timedelta(hours=window_hours - 1)
+
+    # Two queries: the current levels and the hourly consumption in the window
+    dispensers = np.array(
+        list(Dispenser.objects.order_by('id').values_list('id', 'current_level')), dtype=np.int64
+    ).reshape(-1, 2)
+    dispenser_ids, levels = dispensers[:, 0], dispensers[:, 1].astype(np.float64)
+
+    rollups = list(
+        DispenserRollup.objects.filter(period=DispenserRollup.HOUR, bucket__gte=start)
+        .values_list('dispenser_id', 'bucket', 'consumed')
+    )
+
+    consumption = np.zeros((len(dispenser_ids), window_hours))
+    if rollups and len(dispenser_ids):
+        rollup_ids, buckets, consumed = zip(*rollups)
+        rollup_ids = np.array(rollup_ids, dtype=np.int64)
+        seconds = np.array([bucket.timestamp() for bucket in buckets]) - start.timestamp()
+        columns = (seconds // 3600).astype(np.int64)
+        rows = np.minimum(np.searchsorted(dispenser_ids, rollup_ids), len(dispenser_ids) - 1)
+        # Skip rollups of dispensers created after the first query
+        keep = (dispenser_ids[rows] == rollup_ids) & (columns >= 0) & (columns < window_hours)
+        np.add.at(consumption, (rows[keep], columns[keep]), np.array(consumed, dtype=np.float64)[keep])
+
+    rates = consumption @ decay_weights(window_hours, alpha)
+    hours_to_empty = np.full(len(dispenser_ids), np.inf)
+    np.divide(levels, rates, out=hours_to_empty, where=rates > 0)
+
+    return Forecasts(now, dispenser_ids, levels, rates, hours_to_empty)
+
+
+def store_forecasts(forecasts, batch_size=1000):
+    """Save the forecasts in ``DispenserForecast``, replacing the previous run"""
+    computed_at = forecasts.computed_at
+    rows = []
+    for dispenser_id, rate, hours in zip(
+        forecasts.dispenser_ids.tolist(), forecasts.rates.tolist(), forecasts.hours_to_empty.tolist()
+    ):
+        finite = hours != float('inf')
+        rows.append(DispenserForecast(
+            dispenser_id=dispenser_id,
+            rate_per_hour=rate,
+            hours_to_empty=hours if finite else None,
+            empty_at=computed_at + timedelta(hours=hours) if finite else None,
+            computed_at=computed_at,
+        ))
+
+    DispenserForecast.objects.bulk_create(
+        rows,
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=['dispenser'],
+        update_fields=['rate_per_hour', 'hours_to_empty', 'empty_at', 'computed_at'],
+    )
+    return len(rows)
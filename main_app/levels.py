@@ -0,0 +1,252 @@
+"""
+Race-free level updates.
+
+A level change is a single ``UPDATE ... SET current_level = <expression>`` that
+the database evaluates against the row as it is at that moment. So two sensors,
+or a sensor and a refill crew, can't overwrite each other's change the way a
+``get()`` followed by ``save()`` can. The expression also clamps the result to
+``[0, max_capacity]``, and only the ``current_level`` column is written.
+
+Sensors can number their readings (``seq``, counting up per device). The
+dispenser keeps the number of the newest reading applied (``last_seq``), and the
+``UPDATE`` only matches while that is lower: ``WHERE last_seq < :seq``. A
+retried reading, or one that arrives after a newer one, then changes nothing,
+without locking the row first. Readings without a number are always applied.
+A number more than ``Dispenser.SEQ_WRAP_GAP`` (half the 32-bit range) below
+``last_seq`` is taken as a frame counter that wrapped around, and is applied; it
+becomes the new ``last_seq``. Anything closer is a late reading, however late. A
+device that restarts its counter, e.g. after a reboot, sends its first reading
+with ``seq_reset``: that one is applied whatever ``last_seq`` is.
+
+With write-behind enabled (see ``write_behind``) updates are buffered in memory
+and written in batches instead.
+"""
+from django.db import transaction
+from django.db.models import BigIntegerField, Case, F, PositiveIntegerField, Q, Value, When
+from django.db.models.functions import Cast, Greatest, Least
+from django.db.models.lookups import GreaterThan
+from django.utils import timezone
+
+from .alert_rules import alerting_dispensers, with_alerting
+from .cache import invalidate
+from .events import publish_level_change
+from .models import Dispenser, DispenserReading
+from .notifications import notifier
+from .write_behind import is_enabled as write_behind_enabled, level_buffer
+
+OPERATIONS = ('current_level', 'consume', 'refill', 'refill_to_full')
+
+
+def level_expression(operation, amount=None):
+    """
+    SQL expression for the new level:
+    - ``current_level``: set an absolute level (capped at max_capacity)
+    - ``consume``: take ``amount`` units out (not below 0)
+    - ``refill``: put ``amount`` units in (not above max_capacity)
+    - ``refill_to_full``: fill up to max_capacity
+    """
+    if operation == 'current_level':
+        return Least(Value(amount), F('max_capacity'))
+    if operation == 'consume':
+        return Greatest(F('current_level') - Value(amount), Value(0))
+    if operation == 'refill':
+        return Least(F('current_level') + Value(amount), F('max_capacity'))
+    if operation == 'refill_to_full':
+        return F('max_capacity')
+    raise ValueError(f"Unknown level operation {operation!r}")
+
+
+def newer_than_last(seq):
+    """Dispensers that haven't applied reading ``seq`` or a later one yet, or whose device's counter wrapped"""
+    wrapped = GreaterThan(F('last_seq') - Value(Dispenser.SEQ_WRAP_GAP), seq)
+    return Q(last_seq__isnull=True) | Q(last_seq__lt=seq) | Q(wrapped)
+
+
+def apply_level_update(dispenser_id, expression, ts, owner=None, seq=None, seq_reset=False):
+    """
+    Apply ``expression`` to one dispenser and append the resulting level to its
+    history. Returns the updated dispenser (with pantry, floor and owner loaded for
+    notifications, and ``alerting`` set by the alert rules) or None when it doesn't
+    exist or, with ``owner``, belongs to someone else.
+
+    With ``seq`` the dispenser is only written when the reading is newer than its
+    ``last_seq`` (or ``seq_reset`` says the device's counter started over).
+    Otherwise it is returned unchanged, with ``applied`` False.
+    """
+    dispensers = Dispenser.objects.filter(id=dispenser_id)
+    if owner is not None:
+        dispensers = dispensers.filter(owner=owner)
+    changes = {'current_level': expression}
+    writable = dispensers
+    if seq is not None:
+        changes['last_seq'] = seq
+        if not seq_reset:
+            writable = dispensers.filter(newer_than_last(seq))
+    with transaction.atomic():
+        if not writable.update(**changes):
+            if seq is None:
+                return None
+            # Unknown, or a reading that was already applied or came after a newer one
+            dispenser = dispensers.select_related('pantry__floor__user').first()
+            if dispenser is not None:
+                dispenser.applied = False
+            return dispenser
+        # Our UPDATE holds the row lock until commit, so this reads exactly the level we wrote
+        dispenser = with_alerting(Dispenser.objects.select_related('pantry__floor__user')).get(id=dispenser_id)
+        dispenser.applied = True
+        DispenserReading.objects.create(dispenser=dispenser, ts=ts, level=dispenser.current_level)
+        # QuerySet.update() sends no signals, so drop the cached copies ourselves
+        transaction.on_commit(lambda: invalidate('dispenser', [dispenser_id], [dispenser.owner_id]))
+    return dispenser
+
+
+def update_level(dispenser_id, operation, amount=None, ts=None, owner=None, seq=None, seq_reset=False):
+    """
+    Everything a level update does: the write, a low-stock alert when the dispenser
+    just went low, and the live event for dashboards. Shared by the sync and async
+    views. Returns the updated dispenser or None when it doesn't exist (or isn't ``owner``'s).
+    ``applied`` on the dispenser is False when ``seq`` says the reading is old.
+    """
+    if write_behind_enabled():
+        return level_buffer.update(dispenser_id, operation, amount, ts, owner, seq, seq_reset)
+    dispenser = apply_level_update(
+        dispenser_id, level_expression(operation, amount), ts or timezone.now(), owner, seq, seq_reset
+    )
+    if dispenser is not None and dispenser.applied:
+        went_low = notifier.report(dispenser, dispenser.alerting)
+        publish_level_change(dispenser, went_low)
+    return dispenser
+
+
+def bulk_update_levels(readings, dispensers):
+    """
+    Apply many absolute readings (dicts with ``id``, ``current_level`` and optionally
+    ``ts`` and ``seq``; levels are capped at max_capacity) with one ``UPDATE``, and append them to the history with one
+    ``bulk_create``. Only the dispensers in the ``dispensers`` queryset are written.
+    Returns a status per reading: ``updated``, ``superseded`` (a newer reading of the
+    same dispenser won), ``stale`` (the dispenser already has this or a newer
+    reading) or ``not_found``.
+    """
+    statuses = [None] * len(readings)
+
+    # Keep only the newest reading per dispenser (by seq, then ts, then position)
+    latest = {}  # dispenser id -> index of the reading that wins
+    for index, reading in enumerate(readings):
+        current = latest.get(reading['id'])
+        if current is None or reading_order(reading, index) >= reading_order(readings[current], current):
+            if current is not None:
+                statuses[current] = 'superseded'
+            latest[reading['id']] = index
+        else:
+            statuses[index] = 'superseded'
+
+    # Load all the dispensers we need with a single query. Readings they already have are
+    # dropped right away, so a retried batch costs no write.
+    found = dispensers.select_related('pantry__floor__user').in_bulk(list(latest))
+
+    winners = {}  # dispenser id -> the reading to write
+    for index, reading in enumerate(readings):
+        if reading['id'] not in found:
+            if latest[reading['id']] == index:
+                statuses[index] = 'not_found'
+        elif not found[reading['id']].is_new_reading(reading.get('seq')):
+            statuses[index] = 'stale'
+        elif latest[reading['id']] == index:
+            winners[reading['id']] = reading
+            statuses[index] = 'updated'
+
+    now = timezone.now()
+    with transaction.atomic():
+        written = write_levels(winners, dispensers)
+        for dispenser_id in set(winners) - written:
+            # A newer reading got in between our load and our UPDATE
+            statuses[latest[dispenser_id]] = 'stale'
+        DispenserReading.objects.bulk_create(history(readings, statuses, winners, written, found, now))
+    if not written:
+        return statuses
+    changed = [found[dispenser_id] for dispenser_id in written]
+    for dispenser in changed:
+        dispenser.current_level = min(winners[dispenser.id]['current_level'], dispenser.max_capacity)
+        if winners[dispenser.id].get('seq') is not None:
+            dispenser.last_seq = winners[dispenser.id]['seq']
+    # QuerySet.update() sends no signals, so drop the cached copies ourselves
+    invalidate('dispenser', list(written), [dispenser.owner_id for dispenser in changed])
+
+    # Queue notifications for the dispensers that just went low and push the new levels.
+    # One query tells which of them alert under their thresholds and the alert rules.
+    alerting = set(alerting_dispensers().filter(id__in=list(written)).values_list('id', flat=True))
+    for dispenser in changed:
+        went_low = notifier.report(dispenser, dispenser.id in alerting)
+        publish_level_change(dispenser, went_low)
+    return statuses
+
+
+def history(readings, statuses, winners, written, found, now):
+    """
+    The history rows of a bulk update: the written reading of each dispenser, plus
+    the superseded ones taken at their own ``ts`` up to the written one's. So the
+    history of a dispenser always ends at the level it was left at; a superseded
+    reading without a ``ts`` has no time of its own and is left out.
+    """
+    rows = []
+    for reading, status in zip(readings, statuses):
+        if reading['id'] not in written:
+            continue
+        winner = winners[reading['id']]
+        last_ts = winner.get('ts') or now
+        if reading is winner:
+            rows.append((last_ts, True, reading))
+        elif status == 'superseded' and reading.get('ts') is not None and reading['ts'] <= last_ts:
+            rows.append((reading['ts'], False, reading))
+    # Insert in time order with the written reading last, as rollups read them by (ts, id)
+    rows.sort(key=lambda row: (row[0], row[1]))
+    return [
+        DispenserReading(
+            dispenser_id=reading['id'], ts=ts, level=min(reading['current_level'], found[reading['id']].max_capacity),
+        )
+        for ts, _, reading in rows
+    ]
+
+
+def write_levels(readings, dispensers):
+    """
+    Write ``{dispenser id: reading}`` in one statement:
+
+        UPDATE dispenser SET current_level = CASE id WHEN ... THEN LEAST(..., max_capacity) END,
+                             last_seq = CASE id WHEN ... END
+        WHERE id IN (...) AND (last_seq IS NULL OR last_seq < CASE id WHEN ... END OR ...)
+
+    where the condition only applies to readings with a sequence number. Returns the
+    ids that were written.
+    """
+    if not readings:
+        return set()
+    numbered = {dispenser_id: r['seq'] for dispenser_id, r in readings.items() if r.get('seq') is not None}
+    levels = Case(*(When(id=dispenser_id, then=level_expression('current_level', reading['current_level']))
+                    for dispenser_id, reading in readings.items()),
+                  default=F('current_level'), output_field=PositiveIntegerField())
+    changes = {'current_level': Cast(levels, PositiveIntegerField())}
+    condition = Q(id__in=[dispenser_id for dispenser_id in readings if dispenser_id not in numbered])
+    if numbered:
+        seqs = Cast(Case(*(When(id=dispenser_id, then=Value(seq)) for dispenser_id, seq in numbered.items()),
+                         default=F('last_seq'), output_field=BigIntegerField()), BigIntegerField())
+        changes['last_seq'] = seqs
+        condition |= Q(id__in=list(numbered)) & newer_than_last(seqs)
+    count = dispensers.filter(condition).update(**changes)
+    if count == len(readings):
+        return set(readings)
+    # Some rows didn't match: the ones that now carry our sequence number are ours
+    current = dict(Dispenser.objects.filter(id__in=list(numbered)).values_list('id', 'last_seq'))
+    return {
+        dispenser_id for dispenser_id in readings
+        if dispenser_id not in numbered or current.get(dispenser_id) == numbered[dispenser_id]
+    }
+
+
+def reading_order(reading, index):
+    """
+    Sort key of readings of the same dispenser: by sequence number, then timestamped
+    ones by time, then by position
+    """
+    ts = reading.get('ts')
+    return (reading.get('seq') or 0, ts is not None, ts.timestamp() if ts else 0, index)
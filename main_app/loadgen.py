@@ -0,0 +1,247 @@
+"""
+Load generator used by ``simulate_iot --devices N``.
+
+A pool of worker threads plays N simulated devices against a running server at a
+target request rate. Each thread keeps its own ``requests.Session``, so TCP
+connections are reused instead of opened per request. Requests are paced from a
+shared schedule (request k is sent at ``start + k / rate``). The rate therefore
+holds even when some requests are slow, and the latency numbers include the time
+a request waited behind slower ones.
+"""
+import base64
+import itertools
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .frames import MEDIA_TYPE, encode_frame
+
+
+def token_expiry(token):
+    """Expiry (unix time) from the payload of a JWT, without verifying it"""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))['exp']
+    except (IndexError, KeyError, ValueError):
+        return None
+
+
+class TokenManager:
+    """
+    Shares one access token between all worker threads and logs in again
+    shortly before it expires, so requests don't start failing with 401.
+    """
+
+    def __init__(self, login_url, username, password, refresh_margin=60):
+        self.login_url = login_url
+        self.credentials = {'username': username, 'password': password}
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
+
+    def get(self):
+        if self._token is None or time.time() > self._expires_at - self.refresh_margin:
+            with self._lock:
+                # Another thread may have refreshed it while we waited for the lock
+                if self._token is None or time.time() > self._expires_at - self.refresh_margin:
+                    self._login()
+        return self._token
+
+    def invalidate(self, token):
+        """Called after a 401 so the next get() logs in again"""
+        with self._lock:
+            if self._token == token:
+                self._token = None
+
+    def _login(self):
+        response = requests.post(self.login_url, json=self.credentials, timeout=10)
+        response.raise_for_status()
+        self._token = response.json()['access']
+        self._expires_at = token_expiry(self._token) or time.time() + 300
+
+
+def clock_seq():
+    """
+    A sequence number for binary frames: the clock in milliseconds, so it keeps
+    going up when the simulator is restarted. It wraps after about 49 days, which
+    the server recognises (see ``Dispenser.SEQ_WRAP_GAP``).
+    """
+    return time.time_ns() // 1_000_000 % 2 ** 32
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def applied_readings(body, readings):
+    """
+    How many of a request's ``readings`` the server applied, from the JSON of its 200
+    response. Bulk and frame responses count them (``updated``); the rest of their
+    readings were not found, invalid, superseded or stale.
+    """
+    if isinstance(body, dict) and 'updated' in body:
+        return body['updated']
+    return readings
+
+
+@dataclass
+class LoadReport:
+    duration: float = 0.0
+    requests: int = 0
+    readings: int = 0  # applied by the server
+    rejected: int = 0  # sent in a successful request but not applied
+    errors: int = 0
+    status_counts: dict = field(default_factory=dict)
+    latencies: list = field(default_factory=list)  # seconds
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        return {
+            'duration_s': round(self.duration, 2),
+            'requests': self.requests,
+            'readings': self.readings,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'status_counts': self.status_counts,
+            'requests_per_s': round(self.requests / self.duration, 1) if self.duration else 0.0,
+            'readings_per_s': round(self.readings / self.duration, 1) if self.duration else 0.0,
+            'latency_ms': {
+                'p50': round(percentile(latencies, 50) * 1000, 2),
+                'p95': round(percentile(latencies, 95) * 1000, 2),
+                'p99': round(percentile(latencies, 99) * 1000, 2),
+                'max': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            },
+        }
+
+
+class LoadGenerator:
+    """
+    Sends level updates for ``devices`` simulated sensors at ``rate`` requests per second.
+    With ``device_keys`` ({dispenser id: key}) every device authenticates with its own
+    dispenser's key instead of the shared user token. With ``binary`` the readings are
+    sent as binary frames (see ``frames``) instead of JSON. A key only covers its own
+    dispenser, so with keys a bulk frame holds ``batch_size`` readings of one device,
+    like a sensor that buffers readings; JSON bulk requests can't use keys.
+    """
+
+    def __init__(self, base_url, tokens, dispenser_ids, devices, rate, duration, workers=32,
+                 bulk=False, batch_size=100, device_keys=None, binary=False):
+        if bulk and device_keys and not binary:
+            raise ValueError("Device keys only work for single updates and binary frames, not JSON bulk requests")
+        self.base_url = base_url.rstrip('/')
+        self.tokens = tokens
+        self.device_keys = device_keys
+        # Device i reports for dispenser i (wrapping around when there are more devices than dispensers)
+        self.devices = [dispenser_ids[i % len(dispenser_ids)] for i in range(devices)]
+        self.rate = rate
+        self.duration = duration
+        self.workers = workers
+        self.bulk = bulk
+        self.batch_size = batch_size
+        self.binary = binary
+        self._seq = itertools.count(clock_seq())  # goes up for every device
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._report = LoadReport()
+
+    def run(self):
+        schedule = itertools.count()
+        start = time.perf_counter()
+        deadline = start + self.duration
+
+        def worker():
+            while True:
+                send_at = start + next(schedule) / self.rate
+                if send_at >= deadline:
+                    return
+                delay = send_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                self._send_one(send_at)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for _ in range(self.workers):
+                pool.submit(worker)
+
+        self._report.duration = time.perf_counter() - start
+        return self._report
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            # One kept-alive connection per thread is all a thread can use
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        return session
+
+    def _request(self):
+        """URL, JSON body (bytes for a frame), number of readings and device key (if any) of the next request"""
+        if self.binary:
+            count = self.batch_size if self.bulk else 1
+            if self.device_keys:
+                # The key only covers its own dispenser, so the whole frame is that device's
+                ids = [random.choice(self.devices)] * count
+            else:
+                ids = [random.choice(self.devices) for _ in range(count)]
+            now = int(time.time())
+            frame = encode_frame((i, next(self._seq), now, random.randint(0, 100)) for i in ids)
+            device_key = self.device_keys[ids[0]] if self.device_keys else None
+            return f'{self.base_url}/api/dispensers/levels/frame/', frame, len(ids), device_key
+        if self.bulk:
+            body = [
+                {'id': random.choice(self.devices), 'current_level': random.randint(0, 100)}
+                for _ in range(self.batch_size)
+            ]
+            return f'{self.base_url}/api/dispensers/levels/bulk/', body, len(body), None
+        dispenser_id = random.choice(self.devices)
+        url = f'{self.base_url}/api/dispensers/{dispenser_id}/update-level/'
+        device_key = self.device_keys[dispenser_id] if self.device_keys else None
+        return url, {'current_level': random.randint(0, 100)}, 1, device_key
+
+    def _send_one(self, scheduled_at):
+        url, body, readings, device_key = self._request()
+        try:
+            token = None if device_key else self.tokens.get()
+            headers = {'Authorization': f'Device {device_key}' if device_key else f'Bearer {token}'}
+            if isinstance(body, bytes):
+                headers['Content-Type'] = MEDIA_TYPE
+                response = self._session().post(url, data=body, headers=headers, timeout=30)
+            else:
+                response = self._session().post(url, json=body, headers=headers, timeout=30)
+            status_code = str(response.status_code)
+            if response.status_code == 401 and token:
+                self.tokens.invalidate(token)
+            applied = 0
+            if response.status_code == 200:
+                try:
+                    applied = applied_readings(response.json() if self.bulk or self.binary else None, readings)
+                except ValueError:
+                    applied = 0
+        except requests.RequestException:
+            status_code = 'network_error'
+        # Measured from the scheduled send time, so queueing delay counts too
+        latency = time.perf_counter() - scheduled_at
+
+        with self._lock:
+            report = self._report
+            report.requests += 1
+            report.latencies.append(latency)
+            report.status_counts[status_code] = report.status_counts.get(status_code, 0) + 1
+            if status_code == '200':
+                report.readings += applied
+                report.rejected += readings - applied
+            else:
+                report.errors += 1
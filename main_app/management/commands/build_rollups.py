@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from main_app.rollups import build_rollups
+
+
+class Command(BaseCommand):
+    help = 'Builds the hourly and daily consumption rollups from new dispenser readings'
+
+    def handle(self, *args, **options):
+        """
+        Only readings added since the last run are processed, so this is cheap to
+        run often (for example every few minutes from cron).
+        """
+        result = build_rollups()
+        self.stdout.write(self.style.SUCCESS(
+            f"Processed {result['readings']} readings into {result['hours']} hourly "
+            f"and {result['days']} daily rollups"
+        ))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from main_app.forecasting import DEFAULT_ALPHA, DEFAULT_WINDOW_HOURS, compute_forecasts, store_forecasts
+
+
+class Command(BaseCommand):
+    help = 'Forecasts when every dispenser will run empty and stores the result'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=int, default=DEFAULT_WINDOW_HOURS,
+                            help='Hours of consumption history to look at')
+        parser.add_argument('--alpha', type=float, default=DEFAULT_ALPHA,
+                            help='Smoothing factor between 0 and 1; higher follows recent hours more closely')
+
+    def handle(self, *args, **options):
+        """
+        Run this after build_rollups so the forecasts use the latest consumption.
+        """
+        if options['window'] <= 0:
+            raise CommandError("--window must be at least 1 hour")
+        if not 0 < options['alpha'] <= 1:
+            raise CommandError("--alpha must be greater than 0 and at most 1")
+        forecasts = compute_forecasts(window_hours=options['window'], alpha=options['alpha'])
+        stored = store_forecasts(forecasts)
+        soon, _ = forecasts.within(24)
+        self.stdout.write(self.style.SUCCESS(
+            f"Stored forecasts for {stored} dispensers; {len(soon)} will be empty within 24 hours"
+        ))
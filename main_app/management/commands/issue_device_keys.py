@@ -0,0 +1,39 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main_app.device_auth import issue_keys, revoke_keys
+from main_app.models import DeviceKey, Dispenser
+
+
+class Command(BaseCommand):
+    help = 'Issues API keys for dispenser sensors, so they can update their level without a user login'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dispensers', nargs='*', type=int, help='Dispenser ids (default: every dispenser)')
+        parser.add_argument('--output', help='Write {dispenser id: key} to this JSON file instead of printing it')
+        parser.add_argument('--revoke', action='store_true', help='Revoke the existing keys of these dispensers first')
+
+    def handle(self, *args, **options):
+        """
+        The keys are only shown here: the database keeps a hash. Give each sensor
+        the key of its own dispenser, or pass the file to ``simulate_iot --device-keys``.
+        """
+        dispensers = Dispenser.objects.all()
+        if options['dispensers']:
+            dispensers = dispensers.filter(id__in=options['dispensers'])
+        dispenser_ids = list(dispensers.order_by('id').values_list('id', flat=True))
+        if not dispenser_ids:
+            raise CommandError('No dispensers found')
+
+        if options['revoke']:
+            revoke_keys(DeviceKey.objects.filter(dispenser_id__in=dispenser_ids, revoked=False))
+        keys = issue_keys(dispenser_ids)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(keys, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {len(keys)} device keys to {options['output']}"))
+        else:
+            for dispenser_id, key in keys.items():
+                self.stdout.write(f"{dispenser_id}\t{key}")
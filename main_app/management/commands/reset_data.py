@@ -1,45 +1,54 @@
-import random
 from django.core.management.base import BaseCommand
-from main_app.models import Floor, Pantry, Dispenser
-from django.contrib.auth.models import User
 from django.core.management import call_command
+from main_app.sample_data import sample_users, truncate_app_tables
 
 
 class Command(BaseCommand):
     help = 'Resets the database and regenerates sample data'
 
+    def add_arguments(self, parser):
+        # Any size options are passed on to generate_sample_data
+        parser.add_argument('--users', type=int, default=1)
+        parser.add_argument('--floors', type=int, default=5)
+        parser.add_argument('--pantries', type=int, default=3)
+        parser.add_argument('--dispensers', type=int, default=3)
+        parser.add_argument('--history', type=int, default=0)
+
     def handle(self, *args, **options):
         """
         This is the main function that runs when you execute the command.
         It deletes existing data from the database and regenerates fresh sample data.
         """
 
-        # Step 1: Delete all existing Floors, Pantries, and Dispensers
+        # Step 1: Empty all the app tables (Floors, Pantries, Dispensers and their history)
         self.stdout.write("Deleting all Floors, Pantries, and Dispensers...")
-        # Removes all records of Floor, Pantry, and Dispenser from the database.
-        # This is like clearing everything so you can start fresh.
-        Floor.objects.all().delete()
-        Pantry.objects.all().delete()
-        Dispenser.objects.all().delete()
-
-        # Step 2: Delete the sample user if it exists
-        self.stdout.write("Deleting sample user...")
-        try:
-            # Tries to find a user with the username 'sampleuser'
-            user = User.objects.get(username='sampleuser')
-
-            # If found, delete the user
-            user.delete()
-            self.stdout.write(self.style.SUCCESS('Sample user deleted'))
-        except User.DoesNotExist:
-            # If the user doesn't exist, print a message
+        # This truncates the tables in one statement instead of deleting row by row.
+        truncate_app_tables()
+
+        # Step 2: Delete the sample users if they exist
+        self.stdout.write("Deleting sample users...")
+        # Their floors are already gone, so this is a cheap delete. Only the generated names:
+        # a real account that happens to start with the sample name is kept.
+        deleted, _ = sample_users().delete()
+        if deleted:
+            self.stdout.write(self.style.SUCCESS('Sample users deleted'))
+        else:
+            # If the users don't exist, print a message
             self.stdout.write("Sample user not found")
 
         # Step 3: Regenerate all the sample data
         self.stdout.write("Regenerating sample data...")
         # Calls another management command called 'generate_sample_data'
-        # This command will create new Floors, Pantries, Dispensers, and a sample user.
-        call_command('generate_sample_data')
+        # This command will create new Floors, Pantries, Dispensers, and the sample users.
+        call_command(
+            'generate_sample_data',
+            users=options['users'],
+            floors=options['floors'],
+            pantries=options['pantries'],
+            dispensers=options['dispensers'],
+            history=options['history'],
+            stdout=self.stdout,
+        )
 
         # Step 4: Print a success message once everything is done
         self.stdout.write(self.style.SUCCESS('Successfully reset and regenerated sample data!'))
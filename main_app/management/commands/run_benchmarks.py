@@ -0,0 +1,86 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from main_app.benchmarks import BENCHMARK_CACHES, BENCHMARKS, BenchmarkError, compare, environment, run_benchmarks, seed
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the API hot paths against a freshly seeded test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmarks', nargs='*', help=f"Benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+        parser.add_argument('--users', type=int, default=1)
+        parser.add_argument('--floors', type=int, default=10, help='Floors per user')
+        parser.add_argument('--pantries', type=int, default=10, help='Pantries per floor')
+        parser.add_argument('--dispensers', type=int, default=10, help='Dispensers per pantry')
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--warmup', type=int, default=20)
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='Compare against a previous results file and fail on regressions')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed p50 slowdown against the baseline (0.2 = 20%%)')
+
+    def handle(self, *args, **options):
+        """
+        Runs in a separate test database (SQLite or Postgres, whatever DATABASES
+        points at), so your development data is never touched.
+        """
+        names = options['benchmarks'] or list(BENCHMARKS)
+        unknown = set(names) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+
+        if not options['benchmarks'] and connection.vendor == 'sqlite':
+            # SQLite locks the whole database for a write, so many writers at once just fail
+            skipped = [name for name in names if BENCHMARKS[name].concurrent_writes]
+            if skipped:
+                names = [name for name in names if name not in skipped]
+                self.stdout.write(f"Skipping {', '.join(skipped)} on SQLite (needs concurrent writes)")
+
+        dataset = {key: options[key] for key in ('users', 'floors', 'pantries', 'dispensers')}
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            # Emails go to the in-memory backend, sent inline so no worker thread outlives the run.
+            # No cache: a list served from the API cache would report 0 queries and hide an N+1 in the view.
+            with override_settings(LOW_LEVEL_ALERTS={'ASYNC': False}, CACHES=BENCHMARK_CACHES):
+                started = time.perf_counter()
+                ctx = seed(**dataset)
+                self.stdout.write(f"Seeded {len(ctx.dispenser_ids)} dispensers in {time.perf_counter() - started:.1f}s")
+
+                results = {
+                    'environment': environment(dataset),
+                    'benchmarks': run_benchmarks(names, ctx, options['iterations'], options['warmup']),
+                }
+        except BenchmarkError as error:
+            raise CommandError(str(error)) from error
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        for name, result in results['benchmarks'].items():
+            self.stdout.write(
+                f"{name:<34} p50 {result['p50_ms']:>8.2f} ms  p95 {result['p95_ms']:>8.2f} ms  "
+                f"{result['ops_per_s']:>8.1f} ops/s  {result['queries']:>3} queries"
+            )
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+                f.write('\n')
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = compare(results, baseline, options['tolerance'])
+            if regressions:
+                for regression in regressions:
+                    self.stderr.write(f"REGRESSION {regression}")
+                raise CommandError(f"{len(regressions)} regression(s) against {options['baseline']}")
+            self.stdout.write(self.style.SUCCESS(f"No regressions against {options['baseline']}"))
@@ -1,21 +1,20 @@
 from django.core.management.base import BaseCommand
+import json
 import requests
 import random
 import time
 
+from main_app.frames import MEDIA_TYPE, encode_frame
+from main_app.loadgen import LoadGenerator, TokenManager, clock_seq
+
 # ====================
 # CONFIGURATION SECTION
 # ====================
 
-# Base URL of our local Django server
+# Base URL of our local Django server (can be changed with --base-url)
+# The dispenser and login endpoints live under /api/dispensers/ and /api/users/login/
 BASE_URL = 'http://localhost:8000'
 
-# API endpoint to interact with dispensers
-DISPENSER_URL = f'{BASE_URL}/api/dispensers/'
-
-# API endpoint to authenticate and get a token
-AUTH_URL = f'{BASE_URL}/api/users/login/'
-
 # Replace with your actual username and password that you set in generate_sample_data script
 USERNAME = 'sampleuser'
 PASSWORD = 'password123'
@@ -24,11 +23,35 @@ PASSWORD = 'password123'
 class Command(BaseCommand):
     help = 'Simulate IoT devices updating dispenser levels'
 
+    def add_arguments(self, parser):
+        # Without --devices the command runs the slow, one-sensor-at-a-time simulation.
+        # With --devices it becomes a load generator and prints throughput and latency at the end.
+        parser.add_argument('--base-url', default=BASE_URL, help='Server to send the updates to')
+        parser.add_argument('--devices', type=int, help='Number of simulated devices (enables load mode)')
+        parser.add_argument('--rate', type=float, default=100, help='Target requests per second in load mode')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to run in load mode')
+        parser.add_argument('--workers', type=int, default=32, help='Concurrent connections in load mode')
+        parser.add_argument('--bulk', action='store_true', help='Send readings through the bulk endpoint')
+        parser.add_argument('--batch-size', type=int, default=100, help='Readings per bulk request')
+        parser.add_argument('--json', action='store_true', help='Print the load report as JSON')
+        parser.add_argument('--format', choices=['json', 'binary'], default='json',
+                            help='Send JSON bodies or binary level frames (to /api/dispensers/levels/frame/)')
+        parser.add_argument('--device-keys',
+                            help='JSON file from issue_device_keys; each device then uses its own key, not a login')
+
     def handle(self, *args, **options):
         """
         This is the main function that runs when you execute the command.
         It continuously updates the dispenser levels to simulate real-life usage.
         """
+        base_url = options['base_url'].rstrip('/')
+        self.binary = options['format'] == 'binary'
+        self.dispenser_url = f'{base_url}/api/dispensers/'
+        self.auth_url = f'{base_url}/api/users/login/'
+
+        if options['devices']:
+            self.run_load_test(base_url, options)
+            return
 
         # Step 1: Authenticate and get an access token
         token = self.get_access_token()
@@ -67,6 +90,66 @@ class Command(BaseCommand):
                 self.stdout.write("Simulation interrupted. Exiting...")
                 break
 
+    def run_load_test(self, base_url, options):
+        """
+        Simulate many devices at once at a fixed request rate and report
+        throughput and p50/p95/p99 latency when the time is up.
+        With --device-keys every device signs its requests with its own
+        dispenser's key, like real sensors would, and no user logs in.
+        """
+        tokens = device_keys = None
+        if options['device_keys']:
+            if options['bulk'] and not self.binary:
+                self.stdout.write("Device keys can't sign JSON --bulk requests (try --format binary). Exiting...")
+                return
+            # JSON keys are strings; the load generator looks them up by dispenser id
+            with open(options['device_keys']) as f:
+                device_keys = {int(dispenser_id): key for dispenser_id, key in json.load(f).items()}
+            dispenser_ids = list(device_keys)
+        else:
+            tokens = TokenManager(self.auth_url, USERNAME, PASSWORD)
+            try:
+                token = tokens.get()
+            except requests.RequestException as e:
+                self.stdout.write(f"Authentication failed: {e}")
+                return
+            dispenser_ids = self.get_dispenser_ids(token)
+
+        if not dispenser_ids:
+            self.stdout.write("No dispensers found. Exiting...")
+            return
+
+        mode = f"bulk ({options['batch_size']} readings/request)" if options['bulk'] else 'single updates'
+        mode += f", {options['format']}"
+        self.stdout.write(
+            f"Simulating {options['devices']} devices at {options['rate']} req/s for {options['duration']}s "
+            f"with {options['workers']} connections, {mode}..."
+        )
+        generator = LoadGenerator(
+            base_url, tokens, dispenser_ids,
+            devices=options['devices'],
+            rate=options['rate'],
+            duration=options['duration'],
+            workers=options['workers'],
+            bulk=options['bulk'],
+            batch_size=options['batch_size'],
+            device_keys=device_keys,
+            binary=self.binary,
+        )
+        summary = generator.run().summary()
+
+        if options['json']:
+            self.stdout.write(json.dumps(summary, indent=2))
+            return
+        latency = summary['latency_ms']
+        self.stdout.write(f"Requests:   {summary['requests']} ({summary['errors']} errors) {summary['status_counts']}")
+        self.stdout.write(f"Readings:   {summary['readings']} applied, {summary['rejected']} rejected by the server")
+        self.stdout.write(f"Throughput: {summary['requests_per_s']} req/s, {summary['readings_per_s']} readings/s applied")
+        self.stdout.write(
+            f"Latency:    p50 {latency['p50']} ms, p95 {latency['p95']} ms, "
+            f"p99 {latency['p99']} ms, max {latency['max']} ms"
+        )
+
     def get_access_token(self):
         """
         Authenticate the user and obtain a JWT token for authorization.
@@ -78,7 +161,7 @@ class Command(BaseCommand):
         }
         try:
             # Make a POST request to the authentication endpoint
-            response = requests.post(AUTH_URL, json=payload)
+            response = requests.post(self.auth_url, json=payload)
 
             # Check if the request was successful (status code 200)
             if response.status_code == 200:
@@ -97,22 +180,27 @@ class Command(BaseCommand):
         """
         Fetch the list of all dispenser IDs from the API.
         This ensures we're always using the correct IDs, even if the data changes.
+        We only ask for the 'id' field and follow the cursor pages until the end.
         """
         headers = {
             'Authorization': f'Bearer {token}'
         }
+        url = f"{self.dispenser_url}?fields=id&page_size=1000"
+        dispenser_ids = []
         try:
-            # Make a GET request to fetch all dispensers
-            response = requests.get(DISPENSER_URL, headers=headers)
+            while url:
+                # Make a GET request to fetch the next page of dispenser ids
+                response = requests.get(url, headers=headers)
 
-            if response.status_code == 200:
-                # Convert the response to a list of dispensers and extract their IDs
-                dispensers = response.json()
-                return [dispenser['id'] for dispenser in dispensers]
-            else:
-                # Print an error message if fetching dispensers fails
-                self.stdout.write(f"Failed to fetch dispensers: {response.status_code} {response.text}")
-                return []
+                if response.status_code != 200:
+                    # Print an error message if fetching dispensers fails
+                    self.stdout.write(f"Failed to fetch dispensers: {response.status_code} {response.text}")
+                    return []
+
+                page = response.json()
+                dispenser_ids.extend(dispenser['id'] for dispenser in page['results'])
+                url = page['next']  # None on the last page
+            return dispenser_ids
         except requests.RequestException as e:
             # Handle network errors
             self.stdout.write(f"Error fetching dispenser data: {e}")
@@ -123,7 +211,7 @@ class Command(BaseCommand):
         Simulate the consumption of items in a dispenser by reducing its current level.
         """
         # Endpoint to update the dispenser's current level
-        url = f"{DISPENSER_URL}{dispenser_id}/update-level/"
+        url = f"{self.dispenser_url}{dispenser_id}/update-level/"
 
         # Headers for the request, including the authentication token
         headers = {
@@ -135,11 +223,17 @@ class Command(BaseCommand):
         consumption = random.randint(1, 10)
 
         # Create the payload (data) to send in the request
-        payload = {'current_level': consumption}
+        payload = json.dumps({'current_level': consumption})
+
+        if self.binary:
+            # The same reading as a one-reading binary frame
+            url = f"{self.dispenser_url}levels/frame/"
+            headers['Content-Type'] = MEDIA_TYPE
+            payload = encode_frame([(dispenser_id, clock_seq(), int(time.time()), consumption)])
 
         try:
             # Make a POST request to update the dispenser's current level
-            response = requests.post(url, json=payload, headers=headers)
+            response = requests.post(url, data=payload, headers=headers)
 
             if response.status_code == 200:
                 # Print success message if update was successful
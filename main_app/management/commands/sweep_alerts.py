@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from main_app.alert_rules import sweep
+
+
+class Command(BaseCommand):
+    help = 'Raises low-stock alerts for every dispenser below its threshold or one of its alert rules'
+
+    def handle(self, *args, **options):
+        """
+        Run this every few minutes (e.g. from cron). Level updates already alert on
+        their own; the sweep catches rules that start to apply at a time of day,
+        like "coffee below 30% before 9am", when no new reading comes in.
+        Dispensers that already alerted are not alerted again until they recover.
+        """
+        raised = sweep()
+        self.stdout.write(self.style.SUCCESS(f"Raised {raised} new low-stock alerts"))
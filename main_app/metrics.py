@@ -0,0 +1,215 @@
+"""
+Per-route performance metrics.
+
+``PerformanceMiddleware`` measures every request and files it under the URL name
+of the route (``dispenser-list``, ``update-dispenser-level``, ...):
+
+- wall time of the whole request
+- number of SQL queries and the time spent in them, counted by an
+  ``execute_wrapper`` that sits on every database connection
+- time spent building serializer ``.data``
+- response size
+
+Each response gets a ``Server-Timing`` header, so the breakdown shows up in the
+browser's network tab. The numbers are also aggregated into histograms and
+served in the Prometheus text format at ``/metrics``. A route whose query count
+grows with the page size is an N+1.
+
+The histograms live in the memory of each process: with several workers, every
+worker reports its own and Prometheus adds them up.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+# Upper bounds of the histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)  # queries per request
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)  # bytes
+
+METRICS = {
+    # name: (help text, buckets)
+    'request_duration_seconds': ('Wall time of the request', DURATION_BUCKETS),
+    'db_queries': ('SQL queries run by one request', QUERY_BUCKETS),
+    'db_duration_seconds': ('Time one request spent in SQL queries', DURATION_BUCKETS),
+    'serializer_duration_seconds': ('Time one request spent building serializer data', DURATION_BUCKETS),
+    'response_size_bytes': ('Size of the response body', SIZE_BUCKETS),
+}
+PREFIX = 'pantryboss_'
+
+
+@dataclass
+class RequestStats:
+    """What one request has spent so far, filled in while it runs"""
+    queries: int = 0
+    db_time: float = 0.0
+    serializer_time: float = 0.0
+
+
+# The stats of the request being handled. Context variables follow the request
+# into sync_to_async threads, so queries of async views are counted too.
+_current = ContextVar('request_stats', default=None)
+
+
+def query_recorder(execute, sql, params, many, context):
+    """``execute_wrapper`` that adds every query to the current request's stats"""
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.db_time += time.perf_counter() - start
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    """``connection_created`` receiver: put the recorder on every new database connection"""
+    if query_recorder not in connection.execute_wrappers:
+        connection.execute_wrappers.append(query_recorder)
+
+
+@contextmanager
+def serializer_timer():
+    """Adds the time spent inside the block to the current request's serializer time"""
+    stats = _current.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.serializer_time += time.perf_counter() - start
+
+
+class Histogram:
+    """Cumulative bucket counts, a sum and a count, like a Prometheus histogram"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """All histograms of this process, per metric, route and method, plus response counts per status"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # (metric, route, method) -> Histogram
+        self._responses = {}  # (route, method, status) -> count
+
+    def record(self, route, method, status, values):
+        with self._lock:
+            for metric, value in values.items():
+                key = (metric, route, method)
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram(METRICS[metric][1])
+                histogram.observe(value)
+            key = (route, method, status)
+            self._responses[key] = self._responses.get(key, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._responses.clear()
+
+    def render(self):
+        """Everything in the Prometheus text exposition format"""
+        with self._lock:
+            lines = [
+                f'# HELP {PREFIX}responses_total Responses sent',
+                f'# TYPE {PREFIX}responses_total counter',
+            ]
+            for (route, method, status), count in sorted(self._responses.items()):
+                lines.append(f'{PREFIX}responses_total{{route="{route}",method="{method}",status="{status}"}} {count}')
+
+            for metric, (help_text, _) in METRICS.items():
+                name = PREFIX + metric
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for (key_metric, route, method), histogram in sorted(self._histograms.items()):
+                    if key_metric != metric:
+                        continue
+                    labels = f'route="{route}",method="{method}"'
+                    for upper, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{{{labels},le="{upper}"}} {count}')
+                    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{{labels}}} {histogram.sum:.6f}')
+                    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def route_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return (match.url_name or match.view_name) if match else 'unmatched'
+
+
+def server_timing(total, stats):
+    return (
+        f'app;dur={total * 1000:.1f}, '
+        f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries", '
+        f'serialize;dur={stats.serializer_time * 1000:.1f}'
+    )
+
+
+class PerformanceMiddleware:
+    """Measures every request; put it first in ``MIDDLEWARE`` so it sees the whole request"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = RequestStats()
+        token = _current.set(stats)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, stats, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        token = _current.set(stats)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, stats, time.perf_counter() - start)
+
+    def finish(self, request, response, stats, total):
+        values = {
+            'request_duration_seconds': total,
+            'db_queries': stats.queries,
+            'db_duration_seconds': stats.db_time,
+            'serializer_duration_seconds': stats.serializer_time,
+        }
+        # A stream (the live events) has no size yet, and its wall time is only until the stream started
+        if not response.streaming:
+            values['response_size_bytes'] = len(response.content)
+        registry.record(route_name(request), request.method, response.status_code, values)
+        response['Server-Timing'] = server_timing(total, stats)
+        return response
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:38
+
+import django.db.models.expressions
+import django.db.models.functions.comparison
+import django.db.models.lookups
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0002_dispenser_threshold'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dispenser',
+            name='fill_pct',
+            field=models.GeneratedField(db_persist=True, expression=models.Case(models.When(max_capacity=0, then=models.Value(0.0)), default=django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.F('current_level'), '*', models.Value(100.0)), '/', models.F('max_capacity'))), output_field=models.FloatField()),
+        ),
+        migrations.AddField(
+            model_name='dispenser',
+            name='is_low',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.lookups.LessThan(django.db.models.expressions.CombinedExpression(django.db.models.functions.comparison.Cast('current_level', models.BigIntegerField()), '*', models.Value(100)), django.db.models.expressions.CombinedExpression(django.db.models.functions.comparison.Cast('threshold', models.BigIntegerField()), '*', models.F('max_capacity'))), output_field=models.BooleanField()),
+        ),
+        migrations.AddIndex(
+            model_name='dispenser',
+            index=models.Index(condition=models.Q(('is_low', True)), fields=['id'], name='dispenser_low_idx'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:40
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0003_dispenser_fill_pct_is_low'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('built_until', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DispenserReading',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ts', models.DateTimeField(help_text='When the sensor took the reading')),
+                ('level', models.PositiveIntegerField(help_text='Reported level in units')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('dispenser', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='main_app.dispenser')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['dispenser', 'ts'], name='reading_dispenser_ts_idx'), models.Index(fields=['created_at'], name='reading_created_at_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DispenserRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('H', 'Hour'), ('D', 'Day')], max_length=1)),
+                ('bucket', models.DateTimeField(help_text='Start of the hour or day')),
+                ('consumed', models.PositiveIntegerField(default=0, help_text='Units taken out during the bucket')),
+                ('refilled', models.PositiveIntegerField(default=0, help_text='Units put in during the bucket')),
+                ('last_level', models.PositiveIntegerField(help_text='Level at the end of the bucket')),
+                ('readings', models.PositiveIntegerField(default=0, help_text='Number of readings in the bucket')),
+                ('dispenser', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='main_app.dispenser')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('dispenser', 'period', 'bucket'), name='rollup_unique_bucket')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0004_dispenser_readings_and_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DispenserForecast',
+            fields=[
+                ('dispenser', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='forecast', serialize=False, to='main_app.dispenser')),
+                ('rate_per_hour', models.FloatField(help_text='Smoothed consumption in units per hour')),
+                ('hours_to_empty', models.FloatField(help_text='Empty when None: the dispenser is not being used', null=True)),
+                ('empty_at', models.DateTimeField(null=True)),
+                ('computed_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['empty_at'], name='forecast_empty_at_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0005_dispenser_forecast'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.CharField(help_text='Start of the key, to tell keys apart', max_length=12)),
+                ('key_hash', models.CharField(max_length=64, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('revoked', models.BooleanField(default=False)),
+                ('dispenser', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='device_keys', to='main_app.dispenser')),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0006_device_key'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AlertRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('dispenser_type', models.CharField(blank=True, choices=[('DR', 'Drink'), ('SN', 'Snack'), ('CO', 'Coffee')], help_text='Empty for every type', max_length=2)),
+                ('start_time', models.TimeField(blank=True, help_text='Empty for all day; may be after end_time', null=True)),
+                ('end_time', models.TimeField(blank=True, null=True)),
+                ('threshold', models.PositiveIntegerField(help_text='Alert below this fill percentage')),
+                ('active', models.BooleanField(default=True)),
+                ('pantry', models.ForeignKey(blank=True, help_text='Empty for every pantry', null=True, on_delete=django.db.models.deletion.CASCADE, to='main_app.pantry')),
+                ('user', models.ForeignKey(help_text='Rules apply to the dispensers of this user', on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'active'], name='alertrule_user_active_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0007_alert_rule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pantry',
+            name='x',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='pantry',
+            name='y',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
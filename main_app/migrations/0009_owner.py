@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_owners(apps, schema_editor):
+    """Fill in the owner of existing pantries and dispensers from their floor, one UPDATE per table"""
+    Floor = apps.get_model('main_app', 'Floor')
+    Pantry = apps.get_model('main_app', 'Pantry')
+    Dispenser = apps.get_model('main_app', 'Dispenser')
+    Pantry.objects.update(owner_id=Subquery(Floor.objects.filter(id=OuterRef('floor_id')).values('user_id')[:1]))
+    Dispenser.objects.update(owner_id=Subquery(Pantry.objects.filter(id=OuterRef('pantry_id')).values('owner_id')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0008_pantry_position'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dispenser',
+            name='owner',
+            field=models.ForeignKey(db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='pantry',
+            name='owner',
+            field=models.ForeignKey(db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        # Made NOT NULL in the next migration: PostgreSQL can't alter a table with pending
+        # foreign key checks from these updates in the same transaction
+        migrations.RunPython(copy_owners, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0009_owner'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='dispenser',
+            name='dispenser_low_idx',
+        ),
+        migrations.AlterField(
+            model_name='dispenser',
+            name='owner',
+            field=models.ForeignKey(db_index=False, editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='pantry',
+            name='owner',
+            field=models.ForeignKey(db_index=False, editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='dispenser',
+            index=models.Index(fields=['owner', 'id'], name='dispenser_owner_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dispenser',
+            index=models.Index(condition=models.Q(('is_low', True)), fields=['owner', 'id'], name='dispenser_owner_low_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pantry',
+            index=models.Index(fields=['owner', 'id'], name='pantry_owner_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0010_owner_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dispenser',
+            name='last_seq',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -1,16 +1,60 @@
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Cast
+from django.db.models.lookups import LessThan
+from django.utils import timezone
+
+from .cache import invalidate
+
+
+def _change_owner(queryset, owner_id, cache_name):
+    """Give the rows of ``queryset`` that belong to someone else to ``owner_id``"""
+    rows = list(queryset.exclude(owner_id=owner_id).values_list('id', 'owner_id'))
+    if rows:
+        ids = [pk for pk, _ in rows]
+        queryset.model.objects.filter(id__in=ids).update(owner_id=owner_id)
+        invalidate(cache_name, ids, [owner_id, *(old_owner_id for _, old_owner_id in rows)])
+
 
 class Floor(models.Model):
     number = models.IntegerField()
     user = models.ForeignKey(User, on_delete=models.CASCADE)
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding:
+            return
+        # Pantries and dispensers keep a copy of the owner; move them along if it changed
+        _change_owner(Pantry.objects.filter(floor=self), self.user_id, 'pantry')
+        _change_owner(Dispenser.objects.filter(pantry__floor=self), self.user_id, 'dispenser')
+
     def __str__(self):
         return f"Floor {self.number} (User: {self.user.username})"
 
 class Pantry(models.Model):
     name = models.CharField(max_length=100)
     floor = models.ForeignKey(Floor, on_delete=models.CASCADE)
+    # Position on the floor plan in meters, measured from the elevator; used to plan refill routes
+    x = models.FloatField(null=True, blank=True)
+    y = models.FloatField(null=True, blank=True)
+    # Copy of floor.user, so a tenant's pantries are found with one indexed lookup instead of a join.
+    # db_index=False: the (owner, id) index below already covers owner lookups
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, editable=False, db_index=False, related_name='+')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'id'], name='pantry_owner_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.owner_id is None or Pantry.floor.is_cached(self):
+            self.owner_id = self.floor.user_id
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if not adding:
+            _change_owner(Dispenser.objects.filter(pantry=self), self.owner_id, 'dispenser')
 
     def __str__(self):
         return f"Pantry {self.name} on Floor {self.floor.number}"
@@ -31,6 +75,56 @@ class Dispenser(models.Model):
     current_level = models.PositiveIntegerField(help_text='Current level in units')
     threshold = models.PositiveIntegerField(default=10, help_text='Low level threshold percentage')
     pantry = models.ForeignKey('Pantry', on_delete=models.CASCADE)
+    # Copy of pantry.owner (see Pantry.owner)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, editable=False, db_index=False, related_name='+')
+    # Sequence number of the newest sensor reading applied; older and repeated ones are dropped (see levels)
+    last_seq = models.BigIntegerField(null=True, blank=True, editable=False)
+    # A seq more than half the 32-bit range below last_seq isn't a late reading but a frame
+    # counter that wrapped around (serial number arithmetic, RFC 1982). A device that
+    # restarts its counter says so with seq_reset instead (see levels).
+    SEQ_WRAP_GAP = 2 ** 31
+
+    # Kept up to date by the database so low-stock queries don't need to load every row.
+    # is_low compares current_level * 100 against threshold * max_capacity to stay in integers,
+    # in bigint: Postgres multiplies integer columns in int4, which overflows for big capacities.
+    fill_pct = models.GeneratedField(
+        expression=Case(
+            When(max_capacity=0, then=Value(0.0)),
+            default=F('current_level') * 100.0 / F('max_capacity'),
+        ),
+        output_field=models.FloatField(),
+        db_persist=True,
+    )
+    is_low = models.GeneratedField(
+        expression=LessThan(
+            Cast('current_level', models.BigIntegerField()) * 100,
+            Cast('threshold', models.BigIntegerField()) * F('max_capacity'),
+        ),
+        output_field=models.BooleanField(),
+        db_persist=True,
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'id'], name='dispenser_owner_idx'),
+            # Partial index: only low dispensers are in it, so the refill list stays small and fast
+            models.Index(fields=['owner', 'id'], condition=Q(is_low=True), name='dispenser_owner_low_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.owner_id is None or Dispenser.pantry.is_cached(self):
+            self.owner_id = self.pantry.owner_id
+        super().save(*args, **kwargs)
+        # The generated columns were computed by the database; forget the stale values
+        # so they are reloaded the next time they are read.
+        self.__dict__.pop('fill_pct', None)
+        self.__dict__.pop('is_low', None)
+
+    def is_new_reading(self, seq, seq_reset=False):
+        """Whether a reading numbered ``seq`` should be applied, by the rule of ``levels.newer_than_last``"""
+        if seq is None or seq_reset or self.last_seq is None:
+            return True
+        return seq > self.last_seq or seq < self.last_seq - self.SEQ_WRAP_GAP
 
     def is_running_low(self):
         """Check if the dispenser is below the threshold"""
@@ -38,3 +132,129 @@ class Dispenser(models.Model):
 
     def __str__(self):
         return f"{self.get_type_display()} Dispenser in {self.pantry.name}"
+
+
+class DispenserReading(models.Model):
+    """
+    One level report from a sensor. Rows are only ever appended, never updated,
+    so this is the full usage history of a dispenser.
+    """
+    # db_index=False: the (dispenser, ts) index below already covers dispenser lookups
+    dispenser = models.ForeignKey(Dispenser, on_delete=models.CASCADE, db_index=False)
+    ts = models.DateTimeField(help_text='When the sensor took the reading')
+    level = models.PositiveIntegerField(help_text='Reported level in units')
+    # When the server stored it; the rollup build picks up new readings by this (see rollups)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['dispenser', 'ts'], name='reading_dispenser_ts_idx'),
+            models.Index(fields=['created_at'], name='reading_created_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"Dispenser {self.dispenser_id} at {self.level} units ({self.ts:%Y-%m-%d %H:%M})"
+
+
+class DispenserRollup(models.Model):
+    """
+    Consumption of one dispenser during one hour or one day, built from the
+    readings by the ``build_rollups`` command. Dashboards read these instead of
+    the raw readings.
+    """
+    HOUR = 'H'
+    DAY = 'D'
+
+    PERIOD_CHOICES = [
+        (HOUR, 'Hour'),
+        (DAY, 'Day'),
+    ]
+
+    dispenser = models.ForeignKey(Dispenser, on_delete=models.CASCADE, db_index=False)
+    period = models.CharField(max_length=1, choices=PERIOD_CHOICES)
+    bucket = models.DateTimeField(help_text='Start of the hour or day')
+    consumed = models.PositiveIntegerField(default=0, help_text='Units taken out during the bucket')
+    refilled = models.PositiveIntegerField(default=0, help_text='Units put in during the bucket')
+    last_level = models.PositiveIntegerField(help_text='Level at the end of the bucket')
+    readings = models.PositiveIntegerField(default=0, help_text='Number of readings in the bucket')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['dispenser', 'period', 'bucket'], name='rollup_unique_bucket'),
+        ]
+
+    def __str__(self):
+        return f"Dispenser {self.dispenser_id} {self.get_period_display()} {self.bucket:%Y-%m-%d %H:%M}"
+
+
+class RollupState(models.Model):
+    """Remembers up to when readings were stored at the start of the last rollup build"""
+    name = models.CharField(max_length=50, unique=True)
+    built_until = models.DateTimeField(null=True)  # None: never built
+
+    def __str__(self):
+        return f"{self.name}: built until {self.built_until}"
+
+
+class DispenserForecast(models.Model):
+    """
+    When a dispenser is expected to run empty, stored by the ``forecast_depletion``
+    command so the refill list can be read with one indexed query.
+    """
+    dispenser = models.OneToOneField(Dispenser, on_delete=models.CASCADE, primary_key=True, related_name='forecast')
+    rate_per_hour = models.FloatField(help_text='Smoothed consumption in units per hour')
+    hours_to_empty = models.FloatField(null=True, help_text='Empty when None: the dispenser is not being used')
+    empty_at = models.DateTimeField(null=True)
+    computed_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['empty_at'], name='forecast_empty_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"Dispenser {self.dispenser_id} empty in {self.hours_to_empty} hours"
+
+
+class DeviceKey(models.Model):
+    """
+    API key of the sensor in one dispenser. It can only update that dispenser's
+    level. Only a SHA-256 hash of the key is stored; the key itself is shown once,
+    when it is issued with the ``issue_device_keys`` command.
+    """
+    dispenser = models.ForeignKey(Dispenser, on_delete=models.CASCADE, related_name='device_keys')
+    prefix = models.CharField(max_length=12, help_text='Start of the key, to tell keys apart')
+    key_hash = models.CharField(max_length=64, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    revoked = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f"Key {self.prefix}... of dispenser {self.dispenser_id}{' (revoked)' if self.revoked else ''}"
+
+
+class AlertRule(models.Model):
+    """
+    An extra low-stock threshold on top of each dispenser's own ``threshold``,
+    e.g. "coffee dispensers alert at 30% before 9am". A rule can be narrowed to one
+    dispenser type, one pantry and a time of day; empty fields match everything.
+    A dispenser alerts when it is below its own threshold or below any active rule
+    that matches it. See ``alert_rules.py``.
+    """
+    name = models.CharField(max_length=100)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, help_text='Rules apply to the dispensers of this user')
+    dispenser_type = models.CharField(max_length=2, choices=Dispenser.DISPENSER_TYPE_CHOICES, blank=True,
+                                      help_text='Empty for every type')
+    pantry = models.ForeignKey(Pantry, on_delete=models.CASCADE, null=True, blank=True,
+                               help_text='Empty for every pantry')
+    start_time = models.TimeField(null=True, blank=True, help_text='Empty for all day; may be after end_time')
+    end_time = models.TimeField(null=True, blank=True)
+    threshold = models.PositiveIntegerField(help_text='Alert below this fill percentage')
+    active = models.BooleanField(default=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'active'], name='alertrule_user_active_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} (< {self.threshold}%)"
@@ -0,0 +1,207 @@
+"""
+Low-level email notifications.
+
+Sending mail inside the request means a slow SMTP server slows down every sensor
+update, and a sensor that keeps reporting a low level sends an email on every
+reading. This module fixes both:
+
+- Views call ``notifier.report(dispenser)`` after a level change. The call only
+  touches the cache and an in-memory queue, it never talks to SMTP.
+- An alert is raised once when a dispenser goes low and is re-armed when it
+  recovers. The dedup state lives in Django's cache, so it is only shared between
+  worker processes with a shared backend (Redis, as configured with ``REDIS_URL``);
+  with the local-memory cache each process dedupes on its own.
+- A background worker collects the alerts raised during a short window and sends
+  one digest email per recipient. At exit it is stopped and sends the batch it is
+  collecting, so no claimed alert is left without its email.
+
+Configure it with the ``LOW_LEVEL_ALERTS`` setting. With ``'ASYNC': False`` the
+alerts are sent straight away in the calling thread, which is what the tests use.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import get_connection, EmailMessage
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ASYNC': True,
+    'DIGEST_WINDOW_SECONDS': 30,
+    'FROM_EMAIL': 'no-reply@yourapp.com',
+    'DEFAULT_RECIPIENT': 'user@example.com',
+}
+
+
+def get_setting(name):
+    return getattr(settings, 'LOW_LEVEL_ALERTS', {}).get(name, DEFAULTS[name])
+
+
+@dataclass(frozen=True)
+class LowLevelAlert:
+    """Everything needed to write the email, captured when the alert is raised"""
+    dispenser_id: int
+    dispenser_type: str
+    pantry_name: str
+    floor_number: int
+    recipient: str
+
+    @classmethod
+    def from_dispenser(cls, dispenser):
+        """
+        Build an alert from a dispenser. Load it with
+        ``select_related('pantry__floor__user')`` to avoid extra queries here.
+        """
+        pantry = dispenser.pantry
+        return cls(
+            dispenser_id=dispenser.id,
+            dispenser_type=dispenser.get_type_display(),
+            pantry_name=pantry.name,
+            floor_number=pantry.floor.number,
+            recipient=pantry.floor.user.email or get_setting('DEFAULT_RECIPIENT'),
+        )
+
+    def describe(self):
+        return f"The {self.dispenser_type.lower()} dispenser in pantry '{self.pantry_name}' on floor '{self.floor_number}'"
+
+
+# Put on the queue to make the worker send its batch and exit
+_STOP = object()
+
+
+def _dedup_key(dispenser_id):
+    return f'low-level-alert:{dispenser_id}'
+
+
+def build_email(recipient, alerts, connection=None):
+    """Turn the alerts for one recipient into a single email"""
+    if len(alerts) == 1:
+        alert = alerts[0]
+        subject = f"{alert.dispenser_type} Dispenser Running Low"
+        body = f"{alert.describe()} is running low. Please refill it soon."
+    else:
+        subject = f"{len(alerts)} Dispensers Running Low"
+        lines = [f"- {alert.describe()}" for alert in alerts]
+        body = "The following dispensers are running low. Please refill them soon.\n\n" + "\n".join(lines)
+    return EmailMessage(subject, body, get_setting('FROM_EMAIL'), [recipient], connection=connection)
+
+
+def send_digest(alerts):
+    """Group alerts by recipient and send one email each over a single connection"""
+    by_recipient = defaultdict(list)
+    for alert in alerts:
+        by_recipient[alert.recipient].append(alert)
+
+    try:
+        connection = get_connection()
+        messages = [build_email(recipient, items, connection) for recipient, items in by_recipient.items()]
+        connection.send_messages(messages)
+    except Exception:
+        logger.exception("Failed to send low-level notifications")
+        # Let these dispensers alert again on their next low reading
+        cache.delete_many([_dedup_key(alert.dispenser_id) for alert in alerts])
+
+
+class LowLevelNotifier:
+    """Dedupes low-level alerts and hands them to a background digest worker"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def report(self, dispenser, is_low=None):
+        """
+        Call after every level change. Raises an alert the first time the
+        dispenser is seen low and re-arms it once the level recovers.
+        ``is_low`` is the verdict of the alert rules (see ``alert_rules.py``);
+        without it only the dispenser's own threshold is checked.
+        """
+        if is_low is None:
+            is_low = dispenser.is_running_low()
+        if not self.claim(dispenser.id, is_low):
+            return False
+        self.enqueue(LowLevelAlert.from_dispenser(dispenser))
+        return True
+
+    def claim(self, dispenser_id, is_low):
+        """True when a low dispenser has no alert yet; a recovered one is re-armed"""
+        if not is_low:
+            cache.delete(_dedup_key(dispenser_id))
+            return False
+        # cache.add is atomic, so only one worker raises the alert
+        return cache.add(_dedup_key(dispenser_id), True, timeout=None)
+
+    def enqueue(self, alert):
+        if not get_setting('ASYNC'):
+            send_digest([alert])
+            return
+        self._ensure_worker()
+        self._queue.put(alert)
+
+    def flush(self):
+        """Send everything that is waiting in the queue right now"""
+        pending = []
+        while True:
+            try:
+                alert = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if alert is not _STOP:
+                pending.append(alert)
+        if pending:
+            send_digest(pending)
+
+    def shutdown(self, timeout=10):
+        """
+        Stop the worker once it has sent the batch it is collecting, then send
+        whatever is still queued. Registered with ``atexit``.
+        """
+        worker = self._worker
+        if worker is not None and worker.is_alive():
+            self._queue.put(_STOP)
+            worker.join(timeout)
+        self.flush()
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='low-level-notifier', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            # Wait for the first alert, then keep collecting until the window closes
+            alert = self._queue.get()
+            if alert is _STOP:
+                return
+            batch = [alert]
+            deadline = time.monotonic() + get_setting('DIGEST_WINDOW_SECONDS')
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    alert = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if alert is _STOP:
+                    # Shutting down: send what we have now instead of waiting out the window
+                    stopping = True
+                    break
+                batch.append(alert)
+            send_digest(batch)
+
+
+notifier = LowLevelNotifier()
+atexit.register(notifier.shutdown)
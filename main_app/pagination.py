@@ -0,0 +1,15 @@
+from rest_framework.pagination import CursorPagination
+
+
+class IdCursorPagination(CursorPagination):
+    """
+    Keyset pagination on the primary key.
+
+    Each page is an indexed ``WHERE id > ... ORDER BY id LIMIT n`` query, so page
+    1000 costs the same as page 1 and no ``COUNT(*)`` is run. Clients follow the
+    ``next`` link and can ask for up to ``max_page_size`` rows with ``?page_size=``.
+    """
+    ordering = 'id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
@@ -0,0 +1,173 @@
+"""
+Refill route planning: which dispensers to refill, in which order, and how much
+stock to carry.
+
+A dispenser is on the plan when it alerts right now (below its threshold or an
+alert rule, see ``alert_rules``) or its forecast says it runs empty within the
+next ``within`` hours. All of them come back from one query.
+
+The route visits floors in order, so staff ride the elevator in one direction:
+starting at ``from_floor`` it goes to the nearer end of the building first and
+then sweeps to the other end. On each floor, pantries are ordered by walking
+distance from the elevator, which is at (0, 0) of the floor plan: a
+nearest-neighbour tour, improved by 2-opt until no swap of two legs makes the
+walk shorter. Distances are one NumPy matrix per floor and every 2-opt step
+checks all swaps for one leg at once, so a floor with hundreds of pantries takes
+milliseconds. Pantries without a position go last on their floor, by id.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+import numpy as np
+from django.db.models import Q
+from django.utils import timezone
+
+from .alert_rules import alerting_condition
+from .models import Dispenser
+
+DEFAULT_WITHIN_HOURS = 8  # one shift
+MAX_2OPT_PASSES = 50
+
+
+def distance_matrix(points):
+    """Euclidean distances between all ``points`` (an n x 2 array)"""
+    diff = points[:, None, :] - points[None, :, :]
+    return np.sqrt((diff ** 2).sum(axis=-1))
+
+
+def path_length(distances, order):
+    return float(distances[order[:-1], order[1:]].sum())
+
+
+def nearest_neighbour(distances):
+    """A path that starts at node 0 and always walks to the closest node not visited yet"""
+    n = len(distances)
+    visited = np.zeros(n, dtype=bool)
+    order = [0]
+    visited[0] = True
+    for _ in range(n - 1):
+        row = np.where(visited, np.inf, distances[order[-1]])
+        nxt = int(row.argmin())
+        order.append(nxt)
+        visited[nxt] = True
+    return np.array(order)
+
+
+def two_opt(distances, order):
+    """
+    Shortens an open path that starts at ``order[0]`` by reversing segments.
+    Reversing ``order[i:j + 1]`` swaps the legs a-b and c-e for a-c and b-e;
+    the last node has no leg after it, so reversing a tail only changes a-b.
+    """
+    order = order.copy()
+    n = len(order)
+    for _ in range(MAX_2OPT_PASSES):
+        improved = False
+        for i in range(1, n - 1):
+            a, b = order[i - 1], order[i]
+            c = order[i + 1:]  # every possible end of the segment
+            e = order[i + 2:]  # the node after each end, none for the last one
+            gain = distances[a, c] - distances[a, b]
+            gain[:-1] += distances[b, e] - distances[c[:-1], e]
+            j = int(gain.argmin())
+            if gain[j] < -1e-9:
+                order[i:i + j + 2] = order[i:i + j + 2][::-1]
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+def order_pantries(pantries):
+    """
+    Walking order of one floor's pantries, a list of ``(id, x, y)``.
+    Returns the ordered ids and the walking distance from the elevator.
+    """
+    placed = [p for p in pantries if p[1] is not None and p[2] is not None]
+    unplaced = sorted(p[0] for p in pantries if p[1] is None or p[2] is None)
+    if not placed:
+        return unplaced, 0.0
+    points = np.array([(0.0, 0.0)] + [(x, y) for _, x, y in placed])
+    distances = distance_matrix(points)
+    order = nearest_neighbour(distances)
+    if len(order) > 3:
+        order = two_opt(distances, order)
+    return [placed[i - 1][0] for i in order[1:]] + unplaced, path_length(distances, order)
+
+
+def floor_order(numbers, from_floor=None):
+    """Floors to visit, sweeping once through the building from ``from_floor``"""
+    numbers = sorted(numbers)
+    if from_floor is None or not numbers:
+        return numbers
+    here = [n for n in numbers if n == from_floor]
+    below = [n for n in numbers if n < from_floor][::-1]
+    above = [n for n in numbers if n > from_floor]
+    if from_floor - numbers[0] < numbers[-1] - from_floor:
+        return here + below + above
+    return here + above + below
+
+
+def candidates(user, within=DEFAULT_WITHIN_HOURS, now=None):
+    """The user's dispensers that need a refill now or within ``within`` hours, as dicts"""
+    # By empty_at, not hours_to_empty: that counts from when the forecast was made
+    empty_by = (now or timezone.now()) + timedelta(hours=within)
+    return (
+        Dispenser.objects.filter(owner=user)
+        .filter(alerting_condition(now) | Q(forecast__empty_at__lte=empty_by))
+        .values(
+            'id', 'type', 'current_level', 'max_capacity', 'is_low',
+            'pantry_id', 'pantry__name', 'pantry__x', 'pantry__y', 'pantry__floor__number',
+            'forecast__hours_to_empty',
+        )
+        .order_by('id')
+    )
+
+
+def build_plan(rows, from_floor=None):
+    """The route for the rows of ``candidates``"""
+    floors = defaultdict(lambda: defaultdict(list))  # floor number -> pantry id -> rows
+    for row in rows:
+        floors[row['pantry__floor__number']][row['pantry_id']].append(row)
+
+    stops = []
+    totals = defaultdict(int)
+    distance = 0.0
+    for number in floor_order(floors, from_floor):
+        pantries = floors[number]
+        ordered, walk = order_pantries([
+            (pantry_id, first['pantry__x'], first['pantry__y']) for pantry_id, (first, *_) in pantries.items()
+        ])
+        distance += walk
+        for pantry_id in ordered:
+            pantry_rows = pantries[pantry_id]
+            carry = defaultdict(int)
+            dispensers = []
+            for row in pantry_rows:
+                units = row['max_capacity'] - row['current_level']
+                carry[row['type']] += units
+                totals[row['type']] += units
+                dispensers.append({
+                    'id': row['id'],
+                    'type': row['type'],
+                    'current_level': row['current_level'],
+                    'max_capacity': row['max_capacity'],
+                    'refill': units,
+                    'is_low': row['is_low'],
+                    'hours_to_empty': row['forecast__hours_to_empty'],
+                })
+            stops.append({
+                'stop': len(stops) + 1,
+                'floor': number,
+                'pantry': {'id': pantry_id, 'name': pantry_rows[0]['pantry__name']},
+                'dispensers': dispensers,
+                'carry': dict(carry),
+            })
+
+    return {
+        'floors': floor_order(floors, from_floor),
+        'dispensers': sum(len(stop['dispensers']) for stop in stops),
+        'walking_distance': round(distance, 1),
+        'carry': dict(totals),
+        'stops': stops,
+    }
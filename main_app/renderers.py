@@ -0,0 +1,57 @@
+"""
+JSON rendering and parsing with orjson, when it is installed.
+
+DRF's ``JSONRenderer`` and ``JSONParser`` use the standard library ``json``
+module, which spends most of the time of a large dispenser list or bulk sensor
+payload in Python code. orjson does the same work in native code, several times
+faster. These classes are drop-in replacements and produce the same JSON as
+DRF's: datetimes in UTC end in ``Z``, objects orjson doesn't know (Decimals,
+lazy strings, NumPy scalars, ...) go through DRF's encoder, and ``\\u2028`` and
+``\\u2029`` are escaped.
+
+orjson is optional (``pip install orjson``). Without it, or for what orjson
+can't handle (pretty-printed output, non-UTF-8 request bodies), the DRF classes
+do the work, so behaviour never depends on whether it is installed.
+"""
+import codecs
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Same output as DRF: "Z" for UTC, and int keys (e.g. floor numbers) become strings
+ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS if orjson else 0
+
+
+class FastJSONRenderer(JSONRenderer):
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=JSONEncoder().default, option=ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            # e.g. an integer wider than 64 bits
+            return super().render(data, accepted_media_type, renderer_context)
+        # Keep the output a strict JavaScript subset, like DRF does
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+
+class FastJSONParser(JSONParser):
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        if orjson is None or codecs.lookup(encoding).name != 'utf-8':
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
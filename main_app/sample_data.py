@@ -0,0 +1,154 @@
+"""
+Fast synthetic data for development, load tests and benchmarks.
+
+Everything is inserted with ``bulk_create`` in chunks and rows are streamed, so
+even a million dispensers never sit in memory at once. Tables are emptied with
+the database's flush SQL (``TRUNCATE`` on Postgres) instead of deleting row by row.
+"""
+import random
+import re
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Floor, Pantry, Dispenser, DispenserReading
+
+SAMPLE_USERNAME = 'sampleuser'
+SAMPLE_PASSWORD = 'password123'
+DEFAULT_CHUNK_SIZE = 5000
+
+
+def sample_usernames(count, username=SAMPLE_USERNAME):
+    """The first user keeps the plain name so existing scripts can still log in with it"""
+    return [username if i == 0 else f'{username}{i + 1}' for i in range(count)]
+
+
+def sample_users(username=SAMPLE_USERNAME):
+    """
+    The users named by ``sample_usernames`` for any count: ``username`` itself and
+    ``username`` followed by 2, 3, ... Other names that merely start with it are left out.
+    """
+    return User.objects.filter(username__regex=rf'^{re.escape(username)}([2-9]|[1-9][0-9]+)?$')
+
+
+def truncate_app_tables():
+    """Empty every main_app table in one statement, resetting the id sequences"""
+    app_tables = [
+        model._meta.db_table
+        for model in connection.introspection.installed_models(connection.introspection.table_names())
+        if model._meta.app_label == 'main_app'
+    ]
+    sql = connection.ops.sql_flush(no_style(), app_tables, reset_sequences=True, allow_cascade=True)
+    connection.ops.execute_sql_flush(sql)
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def create_users(count, username=SAMPLE_USERNAME, password=SAMPLE_PASSWORD):
+    """Create (or reuse) ``count`` users that all share one password"""
+    names = sample_usernames(count, username)
+    existing = set(User.objects.filter(username__in=names).values_list('username', flat=True))
+
+    # Hash the password once and reuse it; hashing is deliberately slow
+    hashed = User()
+    hashed.set_password(password)
+    User.objects.bulk_create(
+        [User(username=name, email=f'{name}@example.com', password=hashed.password)
+         for name in names if name not in existing],
+        batch_size=DEFAULT_CHUNK_SIZE,
+    )
+    return list(User.objects.filter(username__in=names).order_by('id'))
+
+
+def _history(dispenser_id, level, max_capacity, hours, now, rng):
+    """
+    Hourly readings that end at the dispenser's current level. We walk backwards in
+    time adding back what was consumed; going past full capacity means a refill happened.
+    """
+    readings = []
+    for hours_ago in range(hours):
+        readings.append(DispenserReading(dispenser_id=dispenser_id, ts=now - timedelta(hours=hours_ago), level=level))
+        level += rng.randint(0, max(1, max_capacity // 20))
+        if level > max_capacity:
+            level = rng.randint(0, max_capacity // 4)
+    return readings
+
+
+def generate(users=1, floors=5, pantries=3, dispensers=3, history=0, chunk_size=DEFAULT_CHUNK_SIZE,
+             username=SAMPLE_USERNAME, password=SAMPLE_PASSWORD, seed=None, log=None):
+    """
+    Create ``users`` accounts, each owning ``floors`` floors with ``pantries``
+    pantries per floor and ``dispensers`` dispensers per pantry. With ``history``
+    every dispenser also gets that many hourly readings. Returns the row counts.
+    """
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+    types = [choice for choice, _ in Dispenser.DISPENSER_TYPE_CHOICES]
+
+    with transaction.atomic():
+        owners = create_users(users, username, password)
+
+        Floor.objects.bulk_create(
+            (Floor(number=number, user=owner) for owner in owners for number in range(1, floors + 1)),
+            batch_size=chunk_size,
+        )
+        floor_rows = Floor.objects.filter(user__in=owners).values_list('id', 'number', 'user_id')
+        # Pantries get a spot on the floor plan, from their own generator so seeded levels stay the same
+        spots = random.Random(seed)
+        Pantry.objects.bulk_create(
+            (
+                Pantry(name=f"Pantry {p} on Floor {number}", floor_id=floor_id, owner_id=owner_id,
+                       x=round(spots.uniform(-40, 40), 1), y=round(spots.uniform(-20, 20), 1))
+                for floor_id, number, owner_id in floor_rows.iterator(chunk_size=chunk_size)
+                for p in range(1, pantries + 1)
+            ),
+            batch_size=chunk_size,
+        )
+        log(f"Created {len(owners)} users, {len(owners) * floors} floors and {len(owners) * floors * pantries} pantries")
+
+        pantry_rows = Pantry.objects.filter(owner__in=owners).values_list('id', 'owner_id')
+        new_dispensers = (
+            Dispenser(type=rng.choice(types), max_capacity=100, current_level=rng.randint(20, 100),
+                      pantry_id=pantry_id, owner_id=owner_id)
+            for pantry_id, owner_id in pantry_rows.iterator(chunk_size=chunk_size)
+            for _ in range(dispensers)
+        )
+        created = 0
+        for chunk in _chunks(new_dispensers, chunk_size):
+            Dispenser.objects.bulk_create(chunk)
+            created += len(chunk)
+            log(f"  {created} dispensers...")
+
+        readings = 0
+        if history:
+            now = timezone.now().replace(minute=0, second=0, microsecond=0)
+            rows = Dispenser.objects.filter(owner__in=owners).values_list('id', 'current_level', 'max_capacity')
+            new_readings = (
+                reading
+                for dispenser_id, level, capacity in rows.iterator(chunk_size=chunk_size)
+                for reading in _history(dispenser_id, level, capacity, history, now, rng)
+            )
+            for chunk in _chunks(new_readings, chunk_size):
+                DispenserReading.objects.bulk_create(chunk)
+                readings += len(chunk)
+            log(f"  {readings} readings")
+
+    return {
+        'users': len(owners),
+        'floors': len(owners) * floors,
+        'pantries': len(owners) * floors * pantries,
+        'dispensers': created,
+        'readings': readings,
+    }
@@ -1,22 +1,234 @@
 from rest_framework import serializers
-from .models import Floor, Pantry, Dispenser
+from .frames import MAX_LEVEL
+from .metrics import serializer_timer
+from .models import Floor, Pantry, Dispenser, DispenserForecast, DispenserRollup, AlertRule
 from django.contrib.auth.models import User
 
-class FloorSerializer(serializers.ModelSerializer):
+
+def get_requested_fields(request):
+    """Field names asked for with ?fields=a,b on a GET request, or None for all fields"""
+    if request is None or request.method != 'GET':
+        return None
+    fields = request.query_params.get('fields')
+    if not fields:
+        return None
+    return {name.strip() for name in fields.split(',') if name.strip()}
+
+
+def check_requested_fields(requested, known):
+    """Rejects a ?fields= that names fields the resource doesn't have, instead of returning empty rows"""
+    unknown = sorted(set(requested) - set(known))
+    if unknown:
+        raise serializers.ValidationError({'fields': f"Unknown fields: {', '.join(unknown)}"})
+
+
+class TimedListSerializer(serializers.ListSerializer):
+    @property
+    def data(self):
+        with serializer_timer():
+            return super().data
+
+
+class TimedSerializerMixin:
+    """Counts the time spent building ``.data`` (of one object or a list) as serializer time in the metrics"""
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        meta = getattr(cls, 'Meta', None)
+        if meta is not None and not hasattr(meta, 'list_serializer_class'):
+            meta.list_serializer_class = TimedListSerializer
+
+    @property
+    def data(self):
+        with serializer_timer():
+            return super().data
+
+
+class SparseFieldsetMixin:
+    """Drops the fields the client did not ask for with ?fields="""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        requested = get_requested_fields(self.context.get('request'))
+        if requested:
+            check_requested_fields(requested, self.fields)
+            for name in set(self.fields) - requested:
+                self.fields.pop(name)
+
+
+def owned_by_requester(serializer, owner_id):
+    """Whether an object with this owner belongs to the user making the request"""
+    request = serializer.context.get('request')
+    return request is None or owner_id == request.user.id
+
+
+class FloorSerializer(TimedSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Floor
         fields = '__all__'
+        read_only_fields = ('user',)  # always the logged-in user
 
-class PantrySerializer(serializers.ModelSerializer):
+class PantrySerializer(TimedSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Pantry
         fields = '__all__'
 
-class DispenserSerializer(serializers.ModelSerializer):
+    def validate_floor(self, floor):
+        if not owned_by_requester(self, floor.user_id):
+            raise serializers.ValidationError("Floor not found")
+        return floor
+
+class DispenserSerializer(TimedSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Dispenser
         fields = '__all__'
 
+    def validate_pantry(self, pantry):
+        if not owned_by_requester(self, pantry.owner_id):
+            raise serializers.ValidationError("Pantry not found")
+        return pantry
+
+
+class ValuesSerializer:
+    """
+    Read-only stand-in for a ModelSerializer on large lists: the database builds
+    the rows with ``.values()``, one dict per object with the same keys and values
+    ``serializer_class`` gives, without creating model instances or calling every
+    field's ``to_representation``. Only for models whose fields all serialize as
+    their column value (numbers, strings, booleans and foreign key ids).
+    """
+    serializer_class = None
+
+    @classmethod
+    def field_names(cls):
+        if '_field_names' not in cls.__dict__:
+            cls._field_names = tuple(cls.serializer_class().fields)
+        return cls._field_names
+
+    @classmethod
+    def values(cls, queryset, requested=None):
+        """``queryset`` as row dicts with the ``requested`` fields, plus ``id`` for pagination"""
+        names = cls.field_names()
+        if requested:
+            names = [name for name in names if name in requested or name == 'id']
+        return queryset.values(*names)
+
+class FloorValuesSerializer(ValuesSerializer):
+    serializer_class = FloorSerializer
+
+class PantryValuesSerializer(ValuesSerializer):
+    serializer_class = PantrySerializer
+
+class DispenserValuesSerializer(ValuesSerializer):
+    serializer_class = DispenserSerializer
+
+
+class DispenserLevelReadingSerializer(serializers.Serializer):
+    """A single sensor reading inside a bulk level update"""
+    id = serializers.IntegerField(min_value=1)
+    current_level = serializers.IntegerField(min_value=0, max_value=MAX_LEVEL)
+    ts = serializers.DateTimeField(required=False)
+    seq = serializers.IntegerField(required=False, min_value=1, max_value=2 ** 63 - 1)
+
+
+class DispenserLevelUpdateSerializer(serializers.Serializer):
+    """
+    Body of the update-level endpoint. Exactly one operation is required: an absolute
+    ``current_level``, a relative ``consume`` or ``refill``, or ``refill_to_full``.
+    ``seq`` is the device's number for the reading and ``seq_reset`` says its counter
+    started over; see ``levels``.
+    """
+    current_level = serializers.IntegerField(required=False, min_value=0, max_value=MAX_LEVEL)
+    consume = serializers.IntegerField(required=False, min_value=1, max_value=MAX_LEVEL)
+    refill = serializers.IntegerField(required=False, min_value=1, max_value=MAX_LEVEL)
+    refill_to_full = serializers.BooleanField(required=False)
+    ts = serializers.DateTimeField(required=False)
+    seq = serializers.IntegerField(required=False, min_value=1, max_value=2 ** 63 - 1)
+    seq_reset = serializers.BooleanField(required=False, default=False)
+
+    def validate(self, data):
+        if data['seq_reset'] and 'seq' not in data:
+            raise serializers.ValidationError("'seq_reset' needs a 'seq' to count on from")
+        operations = [name for name in ('current_level', 'consume', 'refill') if name in data]
+        if data.get('refill_to_full'):
+            operations.append('refill_to_full')
+        if len(operations) != 1:
+            raise serializers.ValidationError(
+                "Pass exactly one of 'current_level', 'consume', 'refill' or 'refill_to_full'"
+            )
+        data['operation'] = operations[0]
+        return data
+
+
+class ConsumptionQuerySerializer(serializers.Serializer):
+    """Query parameters of the consumption endpoint. Exactly one of dispenser, pantry or floor is required."""
+    GRANULARITIES = {'hour': DispenserRollup.HOUR, 'day': DispenserRollup.DAY}
+
+    dispenser = serializers.IntegerField(required=False)
+    pantry = serializers.IntegerField(required=False)
+    floor = serializers.IntegerField(required=False)
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+    granularity = serializers.ChoiceField(choices=list(GRANULARITIES), default='hour')
+
+    def validate(self, data):
+        scopes = [name for name in ('dispenser', 'pantry', 'floor') if name in data]
+        if len(scopes) != 1:
+            raise serializers.ValidationError("Pass exactly one of 'dispenser', 'pantry' or 'floor'")
+        if 'start' in data and 'end' in data and data['start'] >= data['end']:
+            raise serializers.ValidationError("'start' must be before 'end'")
+        return data
+
+
+class DispenserForecastSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    id = serializers.IntegerField(source='dispenser_id', read_only=True)
+    type = serializers.CharField(source='dispenser.type', read_only=True)
+    pantry = serializers.IntegerField(source='dispenser.pantry_id', read_only=True)
+    current_level = serializers.IntegerField(source='dispenser.current_level', read_only=True)
+
+    class Meta:
+        model = DispenserForecast
+        fields = ('id', 'type', 'pantry', 'current_level', 'rate_per_hour', 'hours_to_empty', 'empty_at', 'computed_at')
+
+
+class AlertRuleSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = AlertRule
+        fields = '__all__'
+        read_only_fields = ('user',)
+
+    def validate_pantry(self, pantry):
+        if pantry is not None and not owned_by_requester(self, pantry.owner_id):
+            raise serializers.ValidationError("Pantry not found")
+        return pantry
+
+    def validate_threshold(self, threshold):
+        if threshold > 100:
+            raise serializers.ValidationError("'threshold' is a percentage between 0 and 100")
+        return threshold
+
+
+# Nested serializers for the building overview (floor -> pantries -> dispensers).
+# The view prefetches the related rows, so these never trigger extra queries.
+class OverviewDispenserSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Dispenser
+        fields = ('id', 'type', 'max_capacity', 'current_level', 'threshold', 'fill_pct', 'is_low')
+
+class OverviewPantrySerializer(serializers.ModelSerializer):
+    dispensers = OverviewDispenserSerializer(source='dispenser_set', many=True, read_only=True)
+
+    class Meta:
+        model = Pantry
+        fields = ('id', 'name', 'dispensers')
+
+class OverviewFloorSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    pantries = OverviewPantrySerializer(source='pantry_set', many=True, read_only=True)
+
+    class Meta:
+        model = Floor
+        fields = ('id', 'number', 'pantries')
+
 
 class UserSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)  # Add a password field, make it write-only
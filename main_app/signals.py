@@ -0,0 +1,39 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import invalidate
+from .metrics import install_query_recorder
+from .models import Floor, Pantry, Dispenser
+from .write_behind import level_buffer
+
+CACHED_MODELS = {Floor: 'floor', Pantry: 'pantry', Dispenser: 'dispenser'}
+
+
+# Connected per model: a post_delete receiver for every sender would stop Django from
+# fast-deleting the reading and rollup rows of a deleted dispenser with one DELETE
+@receiver(post_save, sender=Floor)
+@receiver(post_save, sender=Pantry)
+@receiver(post_save, sender=Dispenser)
+@receiver(post_delete, sender=Floor)
+@receiver(post_delete, sender=Pantry)
+@receiver(post_delete, sender=Dispenser)
+def invalidate_api_cache(sender, instance, **kwargs):
+    """Keep the API cache in sync with ORM saves and deletes (including cascades)"""
+    name = CACHED_MODELS[sender]
+    # After commit, so a concurrent read can't cache the old row under the new version
+    pk = instance.pk
+    owner_id = instance.user_id if sender is Floor else instance.owner_id
+    transaction.on_commit(lambda: invalidate(name, [pk], [owner_id]))
+
+
+@receiver(post_save, sender=Dispenser)
+@receiver(post_delete, sender=Dispenser)
+def discard_buffered_level(sender, instance, **kwargs):
+    """A dispenser saved or deleted through the ORM wins over a level still in the write-behind buffer"""
+    level_buffer.discard(instance.pk)
+
+
+# Count the queries of every request, whichever connection or thread runs them
+connection_created.connect(install_query_recorder)
@@ -0,0 +1,96 @@
+"""
+Building statistics for dashboards: dispenser counts, stock and low counts per
+floor, per pantry and per dispenser type.
+
+Everything comes from one ``GROUP BY`` query over the finest level, floor x
+pantry x type, which returns one row per pantry and type, not one per dispenser.
+The floor and building totals are rolled up from those rows in Python. (Not every
+supported database has ``GROUP BY ROLLUP``, and the rows are few.)
+
+The query starts from the floors and left-joins pantries and dispensers, so
+floors and pantries without dispensers are listed too, with zeros.
+"""
+from django.db.models import Count, Q, Sum
+
+from .models import Dispenser, Floor
+
+TYPES = [code for code, _ in Dispenser.DISPENSER_TYPE_CHOICES]
+
+
+def grouped_rows(user):
+    """One row per floor, pantry and dispenser type of the user's building"""
+    return (
+        Floor.objects.filter(user=user)
+        .values('id', 'number', 'pantry__id', 'pantry__name', 'pantry__dispenser__type')
+        .annotate(
+            dispensers=Count('pantry__dispenser'),
+            stock=Sum('pantry__dispenser__current_level'),
+            capacity=Sum('pantry__dispenser__max_capacity'),
+            low=Count('pantry__dispenser', filter=Q(pantry__dispenser__is_low=True)),
+        )
+        .order_by('number', 'id', 'pantry__id', 'pantry__dispenser__type')
+    )
+
+
+class Totals:
+    """Running sums of one floor, pantry, type or the whole building"""
+
+    def __init__(self):
+        self.dispensers = self.current_level = self.max_capacity = self.low = 0
+
+    def add(self, row):
+        self.dispensers += row['dispensers']
+        self.current_level += row['stock'] or 0
+        self.max_capacity += row['capacity'] or 0
+        self.low += row['low']
+
+    def as_dict(self):
+        return {
+            'dispensers': self.dispensers,
+            'current_level': self.current_level,
+            'max_capacity': self.max_capacity,
+            'fill_pct': round(self.current_level * 100 / self.max_capacity, 1) if self.max_capacity else 0.0,
+            'low': self.low,
+        }
+
+
+class Group:
+    """Totals of a floor, pantry or the building, overall and per dispenser type"""
+
+    def __init__(self, **fields):
+        self.fields = fields
+        self.total = Totals()
+        self.by_type = {code: Totals() for code in TYPES}
+        self.children = {}
+
+    def add(self, row):
+        self.total.add(row)
+        if row['pantry__dispenser__type'] is not None:
+            self.by_type[row['pantry__dispenser__type']].add(row)
+
+    def as_dict(self, children=None):
+        data = {**self.fields, **self.total.as_dict()}
+        data['by_type'] = {code: totals.as_dict() for code, totals in self.by_type.items()}
+        if children is not None:
+            data[children] = [child.as_dict() for child in self.children.values()]
+        return data
+
+
+def building_stats(rows):
+    """Rolls the rows of ``grouped_rows`` up into pantry, floor and building totals"""
+    building = Group()
+    for row in rows:
+        floor = building.children.get(row['id'])
+        if floor is None:
+            floor = building.children[row['id']] = Group(id=row['id'], number=row['number'])
+        if row['pantry__id'] is not None:
+            pantry = floor.children.get(row['pantry__id'])
+            if pantry is None:
+                pantry = floor.children[row['pantry__id']] = Group(id=row['pantry__id'], name=row['pantry__name'])
+            pantry.add(row)
+        floor.add(row)
+        building.add(row)
+
+    data = building.as_dict()
+    data['floors'] = [floor.as_dict(children='pantries') for floor in building.children.values()]
+    return data
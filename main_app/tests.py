@@ -1,3 +1,1240 @@
-from django.test import TestCase
+import base64
+import json
+from datetime import UTC, datetime, time, timedelta
+from decimal import Decimal
+from io import StringIO
+from time import sleep
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import CommandError, call_command
+from django.core.cache import cache
+from django.db import connection
+from django.test import AsyncClient, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .alert_rules import alerting_dispensers, sweep
+from .benchmarks import BenchmarkError, compare, measure, ok
+from .db_routing import PrimaryReplicaRouter
+from .device_auth import issue_keys, key_cache, revoke_keys
+from .events import publish_level_change
+from .forecasting import compute_forecasts, store_forecasts
+from .frames import MAX_LEVEL, MEDIA_TYPE, FrameError, Reading, decode_frame, encode_frame
+from .loadgen import LoadGenerator, TokenManager, percentile, token_expiry
+from .metrics import registry as metrics_registry
+from .models import Floor, Pantry, Dispenser, AlertRule, DeviceKey, DispenserForecast, DispenserReading, DispenserRollup
+from .notifications import LowLevelAlert, LowLevelNotifier, notifier, send_digest
+from .refill_plan import candidates, floor_order, order_pantries
+from .renderers import FastJSONRenderer
+from .rollups import build_rollups, hour_of
+from .serializers import DispenserValuesSerializer, FloorValuesSerializer, PantryValuesSerializer
+from .views import dispenser_events
+from .write_behind import level_buffer
+
+
+def tearDownModule():
+    # Send the alerts the tests left with the background worker while the test mail backend is still in place
+    notifier.shutdown()
+
+
+# A replica is another connection, which can't see the rows of a test's open transaction.
+# Reads routed to the "replica" use the primary's connection instead.
+@override_settings(DATABASE_REPLICA={'ALIAS': 'default'})
+class PantryBossTestCase(TestCase):
+    """Creates one user with a floor, a pantry and two dispensers"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('tester', 'tester@example.com', 'password123')
+        self.floor = Floor.objects.create(number=1, user=self.user)
+        self.pantry = Pantry.objects.create(name='Kitchen', floor=self.floor)
+        self.coffee = Dispenser.objects.create(type='CO', max_capacity=100, current_level=50, pantry=self.pantry)
+        self.snack = Dispenser.objects.create(type='SN', max_capacity=100, current_level=50, pantry=self.pantry)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+
+@override_settings(LOW_LEVEL_ALERTS={'ASYNC': False})
+class LowLevelNotificationTests(PantryBossTestCase):
+
+    def update_level(self, dispenser, level):
+        return self.client.post(f'/api/dispensers/{dispenser.id}/update-level/', {'current_level': level}, format='json')
+
+    def test_alert_is_sent_once_while_level_stays_low(self):
+        self.update_level(self.coffee, 5)
+        self.update_level(self.coffee, 4)
+        self.update_level(self.coffee, 3)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['tester@example.com'])
+
+    def test_alert_is_rearmed_after_refill(self):
+        self.update_level(self.coffee, 5)
+        self.update_level(self.coffee, 90)
+        self.update_level(self.coffee, 5)
+
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_digest_groups_alerts_per_recipient(self):
+        alerts = [
+            LowLevelAlert(self.coffee.id, 'Coffee', 'Kitchen', 1, 'a@example.com'),
+            LowLevelAlert(self.snack.id, 'Snack', 'Kitchen', 1, 'a@example.com'),
+            LowLevelAlert(99, 'Drink', 'Lobby', 2, 'b@example.com'),
+        ]
+        send_digest(alerts)
+
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].subject, '2 Dispensers Running Low')
+        self.assertEqual(mail.outbox[1].subject, 'Drink Dispenser Running Low')
+
+    @override_settings(LOW_LEVEL_ALERTS={'ASYNC': True})
+    def test_async_mode_queues_instead_of_sending(self):
+        with mock.patch.object(notifier, '_ensure_worker'):
+            self.update_level(self.coffee, 5)
+
+        self.assertEqual(len(mail.outbox), 0)
+        notifier.flush()
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(LOW_LEVEL_ALERTS={'ASYNC': True, 'DIGEST_WINDOW_SECONDS': 30})
+    def test_shutdown_sends_the_batch_the_worker_is_collecting(self):
+        alerts = LowLevelNotifier()
+        alerts.enqueue(LowLevelAlert(self.coffee.id, 'Coffee', 'Kitchen', 1, 'a@example.com'))
+        while not alerts._queue.empty():  # the worker has taken it and is waiting out the window
+            sleep(0.01)
+
+        alerts.shutdown(timeout=5)
+
+        self.assertFalse(alerts._worker.is_alive())
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class LowDispenserTests(PantryBossTestCase):
+
+    def test_is_low_is_maintained_by_the_database(self):
+        Dispenser.objects.filter(id=self.coffee.id).update(current_level=9)
+
+        self.assertTrue(Dispenser.objects.get(id=self.coffee.id).is_low)
+        self.assertFalse(Dispenser.objects.get(id=self.snack.id).is_low)
+
+    def test_low_endpoint_lists_only_low_dispensers(self):
+        Dispenser.objects.filter(id=self.coffee.id).update(current_level=9)
+
+        response = self.client.get('/api/dispensers/low/')
+
+        self.assertEqual([row['id'] for row in response.json()['results']], [self.coffee.id])
+
+    def test_is_low_does_not_overflow_at_the_largest_levels(self):
+        # level * 100 and threshold * capacity are past int4 here; Postgres would fail in int4
+        Dispenser.objects.filter(id=self.coffee.id).update(max_capacity=MAX_LEVEL, current_level=MAX_LEVEL // 20)
+        Dispenser.objects.filter(id=self.snack.id).update(max_capacity=MAX_LEVEL, current_level=MAX_LEVEL // 5)
+
+        self.assertEqual(list(Dispenser.objects.filter(is_low=True).values_list('id', flat=True)), [self.coffee.id])
+        self.assertEqual(list(alerting_dispensers().values_list('id', flat=True)), [self.coffee.id])
+
+
+class RelativeLevelUpdateTests(PantryBossTestCase):
+
+    def update_level(self, body, dispenser_id=None):
+        dispenser_id = dispenser_id or self.coffee.id
+        return self.client.post(f'/api/dispensers/{dispenser_id}/update-level/', body, format='json')
+
+    def test_consume_and_refill_are_clamped_to_capacity(self):
+        self.assertEqual(self.update_level({'consume': 20}).json()['current_level'], 30)
+        self.assertEqual(self.update_level({'consume': 500}).json()['current_level'], 0)
+        self.assertEqual(self.update_level({'refill': 500}).json()['current_level'], 100)
+
+        self.coffee.refresh_from_db()
+        self.assertEqual(self.coffee.current_level, 100)
+        self.assertEqual(
+            list(DispenserReading.objects.filter(dispenser=self.coffee).order_by('id').values_list('level', flat=True)),
+            [30, 0, 100],
+        )
+
+    def test_refill_to_full(self):
+        self.update_level({'refill_to_full': True})
+
+        self.coffee.refresh_from_db()
+        self.assertEqual(self.coffee.current_level, 100)
+
+    def test_update_is_a_single_write_of_the_level(self):
+        # The row changed behind our back; the delta must apply to what is in the database now
+        Dispenser.objects.filter(id=self.coffee.id).update(current_level=80, threshold=25)
+
+        with CaptureQueriesContext(connection) as captured:
+            self.update_level({'consume': 5})
+
+        statements = [q['sql'] for q in captured.captured_queries if 'SAVEPOINT' not in q['sql']]
+        # No SELECT before the write, and the write sets nothing but the level
+        self.assertTrue(statements[0].startswith('UPDATE "main_app_dispenser" SET "current_level" = '))
+        self.assertNotIn('threshold', statements[0])
+
+        self.coffee.refresh_from_db()
+        self.assertEqual((self.coffee.current_level, self.coffee.threshold), (75, 25))
+
+    def test_exactly_one_operation_is_required(self):
+        self.assertEqual(self.update_level({'consume': 5, 'refill': 5}).status_code, 400)
+        self.assertEqual(self.update_level({}).status_code, 400)
+        self.assertEqual(self.update_level({'consume': 0}).status_code, 400)
+
+    def test_unknown_dispenser_is_404(self):
+        self.assertEqual(self.update_level({'consume': 5}, dispenser_id=9999).status_code, 404)
+
+
+class BulkLevelUpdateTests(PantryBossTestCase):
+    URL = '/api/dispensers/levels/bulk/'
+
+    def post(self, readings, client=None):
+        return (client or self.client).post(self.URL, readings, format='json')
+
+    def test_authentication_is_required(self):
+        response = self.post([{'id': self.coffee.id, 'current_level': 10}], client=APIClient())
+
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(Dispenser.objects.get(id=self.coffee.id).current_level, 50)
+
+    def test_mixed_batch_reports_each_item(self):
+        response = self.post([
+            {'id': self.coffee.id, 'current_level': 30},
+            {'id': 9999, 'current_level': 30},
+            {'id': self.snack.id, 'current_level': -1},
+        ])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['updated'], 1)
+        self.assertEqual(
+            [result['status'] for result in response.json()['results']], ['updated', 'not_found', 'invalid'],
+        )
+        self.assertEqual(list(Dispenser.objects.order_by('id').values_list('current_level', flat=True)), [30, 50])
+
+    def test_newest_reading_of_a_duplicate_id_wins(self):
+        response = self.post([
+            {'id': self.coffee.id, 'current_level': 10, 'ts': '2024-11-16T08:30:00Z'},
+            {'id': self.coffee.id, 'current_level': 20, 'ts': '2024-11-16T08:00:00Z'},
+        ])
+
+        self.assertEqual([result['status'] for result in response.json()['results']], ['updated', 'superseded'])
+        self.assertEqual(Dispenser.objects.get(id=self.coffee.id).current_level, 10)
+
+    def test_over_capacity_level_is_capped(self):
+        self.post([{'id': self.coffee.id, 'current_level': 250}])
+
+        self.assertEqual(Dispenser.objects.get(id=self.coffee.id).current_level, 100)
+
+    def test_batch_is_written_with_one_update(self):
+        readings = [{'id': self.coffee.id, 'current_level': 30}, {'id': self.snack.id, 'current_level': 40}]
+        # Load the dispensers, savepoint, UPDATE, INSERT history, release, alert rules
+        with self.assertNumQueries(6), CaptureQueriesContext(connection) as captured:
+            self.post(readings)
+
+        updates = [q['sql'] for q in captured.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+
+
+class SequenceNumberTests(PantryBossTestCase):
+
+    def update_level(self, body):
+        return self.client.post(f'/api/dispensers/{self.coffee.id}/update-level/', body, format='json')
+
+    def test_a_retried_reading_is_applied_once(self):
+        self.update_level({'consume': 10, 'seq': 5})
+        response = self.update_level({'consume': 10, 'seq': 5})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['current_level'], 40)
+        self.coffee.refresh_from_db()
+        self.assertEqual((self.coffee.current_level, self.coffee.last_seq), (40, 5))
+        self.assertEqual(DispenserReading.objects.filter(dispenser=self.coffee).count(), 1)
+
+    def test_a_late_older_reading_is_dropped(self):
+        self.update_level({'current_level': 30, 'seq': 9})
+        self.update_level({'current_level': 80, 'seq': 8})
+        # Readings without a number are always applied
+        self.update_level({'consume': 5})
+
+        self.coffee.refresh_from_db()
+        self.assertEqual((self.coffee.current_level, self.coffee.last_seq), (25, 9))
+
+    def test_bulk_skips_stale_readings_in_one_update(self):
+        Dispenser.objects.filter(id=self.coffee.id).update(last_seq=10)
+
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.post('/api/dispensers/levels/bulk/', [
+                {'id': self.coffee.id, 'current_level': 5, 'seq': 10},
+                {'id': self.snack.id, 'current_level': 20, 'seq': 3},
+                {'id': self.snack.id, 'current_level': 70, 'seq': 2},
+            ], format='json')
+
+        self.assertEqual([result['status'] for result in response.json()['results']], ['stale', 'updated', 'superseded'])
+        updates = [q['sql'] for q in captured.captured_queries if q['sql'].startswith('UPDATE "main_app_dispenser"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(
+            list(Dispenser.objects.order_by('id').values_list('current_level', 'last_seq')), [(50, 10), (20, 3)],
+        )
+
+    def test_bulk_history_ends_at_the_written_level(self):
+        self.client.post('/api/dispensers/levels/bulk/', [
+            {'id': self.coffee.id, 'current_level': 10, 'seq': 5, 'ts': '2024-11-16T08:30:00Z'},
+            {'id': self.coffee.id, 'current_level': 20, 'seq': 3},
+            {'id': self.coffee.id, 'current_level': 30, 'seq': 2, 'ts': '2024-11-16T08:10:00Z'},
+            {'id': self.coffee.id, 'current_level': 40, 'seq': 4, 'ts': '2024-11-16T09:00:00Z'},
+        ], format='json')
+
+        history = DispenserReading.objects.filter(dispenser=self.coffee).order_by('ts', 'id')
+        self.assertEqual([reading.level for reading in history], [30, 10])
+
+    def test_a_wrapped_counter_starts_over(self):
+        Dispenser.objects.filter(id=self.coffee.id).update(last_seq=2 ** 32 - 2)
+
+        # The 32-bit counter of a frame wrapped around; a slightly late reading is still dropped
+        for seq, level in ((2 ** 32 - 3, 90), (3, 30), (2, 20)):
+            self.client.post(
+                '/api/dispensers/levels/frame/', encode_frame([(self.coffee.id, seq, 0, level)]), content_type=MEDIA_TYPE,
+            )
+
+        self.coffee.refresh_from_db()
+        self.assertEqual((self.coffee.current_level, self.coffee.last_seq), (30, 3))
+
+    def test_a_very_late_reading_is_still_dropped(self):
+        # The simulator numbers readings by the millisecond clock: this one is an hour late
+        last_seq = 1_731_736_800_000 % 2 ** 32
+        self.update_level({'current_level': 30, 'seq': last_seq})
+        self.update_level({'current_level': 90, 'seq': last_seq - 3_600_000})
+
+        self.coffee.refresh_from_db()
+        self.assertEqual((self.coffee.current_level, self.coffee.last_seq), (30, last_seq))
+
+    def test_a_device_resets_its_counter_explicitly(self):
+        Dispenser.objects.filter(id=self.coffee.id).update(last_seq=500)
+
+        self.assertEqual(self.update_level({'consume': 5, 'seq': 1}).json()['current_level'], 50)
+        self.update_level({'consume': 5, 'seq': 1, 'seq_reset': True})
+        self.update_level({'consume': 5, 'seq': 2})
+
+        self.coffee.refresh_from_db()
+        self.assertEqual((self.coffee.current_level, self.coffee.last_seq), (40, 2))
+        self.assertEqual(self.update_level({'consume': 5, 'seq_reset': True}).status_code, 400)
+
+    @override_settings(LEVEL_WRITE_BEHIND={'ENABLED': True, 'FLUSH_INTERVAL_MS': 0, 'MAX_PENDING': 100})
+    def test_write_behind_drops_stale_readings_in_memory(self):
+        try:
+            self.update_level({'current_level': 30, 'seq': 2})
+            self.update_level({'current_level': 90, 'seq': 1})
+            level_buffer.flush()
+        finally:
+            level_buffer.clear()
+
+        self.coffee.refresh_from_db()
+        self.assertEqual((self.coffee.current_level, self.coffee.last_seq), (30, 2))
+
+
+class LevelFrameTests(PantryBossTestCase):
+    URL = '/api/dispensers/levels/frame/'
+
+    def post_frame(self, readings, client=None):
+        return (client or self.client).post(self.URL, encode_frame(readings), content_type=MEDIA_TYPE)
+
+    def test_frame_round_trip(self):
+        frame = encode_frame([(1, 7, 1731736800, 42), Reading(2, 8, 0, 5)])
+
+        self.assertEqual(len(frame), 5 + 2 * 16)
+        first, second = decode_frame(frame)
+        self.assertEqual(first, Reading(1, 7, datetime(2024, 11, 16, 6, 0, tzinfo=UTC), 42))
+        self.assertIsNone(second.ts)
+        for broken in (frame[:-1], b'XX' + frame[2:], frame[:2] + bytes([2]) + frame[3:]):
+            with self.assertRaises(FrameError):
+                decode_frame(broken)
+
+    def test_frame_updates_levels_with_the_newest_reading_winning(self):
+        other = User.objects.create_user('other', 'other@example.com', 'password123')
+        theirs = Dispenser.objects.create(
+            type='DR', max_capacity=100, current_level=50,
+            pantry=Pantry.objects.create(name='Theirs', floor=Floor.objects.create(number=1, user=other)),
+        )
+
+        response = self.post_frame([
+            (self.coffee.id, 2, 0, 30), (self.coffee.id, 1, 0, 40), (self.snack.id, 1, 0, 7), (theirs.id, 1, 0, 0),
+        ])
+
+        self.assertEqual(response.json(), {'updated': 2, 'superseded': 1, 'stale': 0, 'not_found': [theirs.id]})
+        self.coffee.refresh_from_db()
+        self.assertEqual(self.coffee.current_level, 30)
+        # The superseded reading has no time of its own, so only the winner is in the history
+        history = DispenserReading.objects.filter(dispenser=self.coffee)
+        self.assertEqual(list(history.values_list('level', flat=True)), [30])
+        self.assertEqual(Dispenser.objects.get(id=theirs.id).current_level, 50)
+
+    def test_bulk_levels_are_capped_at_capacity(self):
+        self.post_frame([(self.coffee.id, 0, 0, 500)])
+        self.client.post('/api/dispensers/levels/bulk/', [{'id': self.snack.id, 'current_level': 500}], format='json')
+
+        self.assertEqual(list(Dispenser.objects.order_by('id').values_list('current_level', flat=True)), [100, 100])
+        self.assertEqual(set(DispenserReading.objects.values_list('level', flat=True)), {100})
+
+    def test_device_key_frames_only_reach_its_dispenser(self):
+        key = issue_keys([self.coffee.id])[self.coffee.id]
+        device = APIClient()
+        device.credentials(HTTP_AUTHORIZATION=f'Device {key}')
+
+        response = self.post_frame([(self.coffee.id, 1, 0, 12), (self.snack.id, 1, 0, 12)], client=device)
+
+        self.assertEqual(response.json()['not_found'], [self.snack.id])
+        self.assertEqual(Dispenser.objects.get(id=self.coffee.id).current_level, 12)
+
+    def test_malformed_frame_is_a_400(self):
+        response = self.client.post(self.URL, b'PB\x01\x00\x02', content_type=MEDIA_TYPE)
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_levels_the_database_cant_hold_are_rejected(self):
+        self.assertEqual(self.post_frame([(self.coffee.id, 0, 0, 2 ** 31)]).status_code, 400)
+
+        response = self.client.post(
+            '/api/dispensers/levels/bulk/', [{'id': self.coffee.id, 'current_level': 2 ** 31}], format='json'
+        )
+        self.assertEqual(response.json()['results'][0]['status'], 'invalid')
+        self.assertEqual(Dispenser.objects.get(id=self.coffee.id).current_level, 50)
+
+
+@override_settings(
+    LEVEL_WRITE_BEHIND={'ENABLED': True, 'FLUSH_INTERVAL_MS': 0, 'MAX_PENDING': 100},
+    LOW_LEVEL_ALERTS={'ASYNC': False},
+)
+class WriteBehindTests(PantryBossTestCase):
+
+    def tearDown(self):
+        level_buffer.clear()
+
+    def update_level(self, body, dispenser_id=None):
+        dispenser_id = dispenser_id or self.coffee.id
+        return self.client.post(f'/api/dispensers/{dispenser_id}/update-level/', body, format='json')
+
+    def test_readings_are_coalesced_into_one_write(self):
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(5):
+                self.update_level({'consume': 2})
+            self.update_level({'consume': 1}, self.snack.id)
+        writes = [q['sql'] for q in queries if q['sql'].startswith(('UPDATE', 'INSERT'))]
+        self.assertEqual(writes, [])
+
+        # Reads see the buffered level before it is written
+        self.assertEqual(self.client.get(f'/api/dispensers/{self.coffee.id}/').json()['current_level'], 40)
+        self.coffee.refresh_from_db()
+        self.assertEqual(self.coffee.current_level, 50)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(level_buffer.flush(), 2)
+        statements = [q['sql'].split()[0] for q in queries if not q['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+        self.assertEqual(statements.count('UPDATE'), 1)
+        self.assertEqual(statements.count('INSERT'), 1)
+
+        self.coffee.refresh_from_db()
+        self.assertEqual(self.coffee.current_level, 40)
+        self.assertEqual(DispenserReading.objects.count(), 2)
+
+    def test_low_crossing_alerts_before_the_flush(self):
+        self.update_level({'current_level': 5})
+
+        self.assertEqual(len(mail.outbox), 1)
+        level_buffer.flush()
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_other_tenants_dispensers_are_not_found(self):
+        other = User.objects.create_user('other', 'other@example.com', 'password123')
+        theirs = Dispenser.objects.create(
+            type='CO', max_capacity=10, current_level=10,
+            pantry=Pantry.objects.create(name='Theirs', floor=Floor.objects.create(number=1, user=other)),
+        )
+
+        self.assertEqual(self.update_level({'consume': 1}, theirs.id).status_code, 404)
+        self.assertFalse(level_buffer.has_pending())
+
+
+@override_settings(LOW_LEVEL_ALERTS={'ASYNC': False})
+class AlertRuleTests(PantryBossTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Dispenser.objects.filter(id=self.coffee.id).update(current_level=25)
+        self.morning = AlertRule.objects.create(
+            name='Coffee before 9', user=self.user, dispenser_type='CO', end_time=time(9), threshold=30,
+        )
+
+    def at(self, hour):
+        return timezone.make_aware(datetime(2024, 11, 18, hour))
+
+    def test_rules_apply_by_type_and_time_of_day(self):
+        self.assertEqual(list(alerting_dispensers(self.at(7)).values_list('id', flat=True)), [self.coffee.id])
+        self.assertEqual(list(alerting_dispensers(self.at(10)).values_list('id', flat=True)), [])
+
+    def test_windows_can_wrap_past_midnight(self):
+        self.morning.start_time, self.morning.end_time = time(22), time(6)
+        self.morning.save()
+
+        self.assertTrue(alerting_dispensers(self.at(23)).exists())
+        self.assertTrue(alerting_dispensers(self.at(5)).exists())
+        self.assertFalse(alerting_dispensers(self.at(12)).exists())
+
+    def test_evaluation_is_one_query_however_many_rules(self):
+        for pantry_rule in range(20):
+            AlertRule.objects.create(name=f'Rule {pantry_rule}', user=self.user, pantry=self.pantry, threshold=5)
+
+        with self.assertNumQueries(1):
+            list(alerting_dispensers(self.at(7)))
+
+    def test_sweep_alerts_once(self):
+        self.assertEqual(sweep(self.at(7)), 1)
+        self.assertEqual(sweep(self.at(7)), 0)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_level_update_uses_the_rules(self):
+        self.morning.end_time = None
+        self.morning.save()
+
+        self.client.post(f'/api/dispensers/{self.coffee.id}/update-level/', {'current_level': 28}, format='json')
+
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_rules_only_apply_to_their_owner(self):
+        other = User.objects.create_user('other', 'other@example.com', 'password123')
+        AlertRule.objects.create(name='Everything', user=other, threshold=100)
+
+        self.assertEqual(list(alerting_dispensers(self.at(10))), [])
+
+
+class BuildingOverviewTests(PantryBossTestCase):
+
+    def test_overview_returns_nested_tree(self):
+        response = self.client.get('/api/overview/')
+
+        floor = response.json()[0]
+        self.assertEqual(floor['number'], 1)
+        self.assertEqual(floor['pantries'][0]['name'], 'Kitchen')
+        self.assertEqual(
+            [d['id'] for d in floor['pantries'][0]['dispensers']],
+            [self.coffee.id, self.snack.id]
+        )
+
+    def test_overview_query_count_does_not_grow_with_data(self):
+        for number in range(2, 6):
+            floor = Floor.objects.create(number=number, user=self.user)
+            for p in range(3):
+                pantry = Pantry.objects.create(name=f'Pantry {p}', floor=floor)
+                Dispenser.objects.bulk_create(
+                    Dispenser(type='DR', max_capacity=100, current_level=80, pantry=pantry, owner=self.user)
+                    for _ in range(3)
+                )
+
+        # floors, pantries, dispensers
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/overview/')
+        self.assertEqual(len(response.json()), 5)
+
+    def test_overview_only_shows_own_floors(self):
+        other = User.objects.create_user('other', 'other@example.com', 'password123')
+        Floor.objects.create(number=9, user=other)
+
+        response = self.client.get('/api/overview/')
+
+        self.assertEqual([floor['number'] for floor in response.json()], [1])
+
+
+class BuildingStatsTests(PantryBossTestCase):
+
+    def test_stats_roll_up_floors_pantries_and_types_in_one_query(self):
+        Dispenser.objects.filter(id=self.coffee.id).update(current_level=5)
+        lounge = Pantry.objects.create(name='Lounge', floor=self.floor)
+        Dispenser.objects.create(type='CO', max_capacity=200, current_level=150, pantry=lounge)
+        Floor.objects.create(number=2, user=self.user)
+
+        with self.assertNumQueries(1):
+            stats = self.client.get('/api/stats/').json()
+
+        self.assertEqual(stats['dispensers'], 3)
+        self.assertEqual((stats['current_level'], stats['max_capacity'], stats['low']), (205, 400, 1))
+        self.assertEqual(stats['by_type']['CO']['fill_pct'], 51.7)
+        self.assertEqual(stats['by_type']['DR']['dispensers'], 0)
+
+        first, second = stats['floors']
+        self.assertEqual(second['number'], 2)
+        self.assertEqual((second['dispensers'], second['pantries']), (0, []))
+        kitchen, lounge_stats = first['pantries']
+        self.assertEqual((kitchen['name'], kitchen['dispensers'], kitchen['low'], kitchen['fill_pct']),
+                         ('Kitchen', 2, 1, 27.5))
+        self.assertEqual(lounge_stats['by_type']['CO']['current_level'], 150)
+
+    def test_stats_are_cached_briefly_per_user(self):
+        self.client.get('/api/stats/')
+        with self.assertNumQueries(0):
+            self.client.get('/api/stats/')
+
+        other = User.objects.create_user('other', 'other@example.com', 'password123')
+        self.client.force_authenticate(other)
+        stats = self.client.get('/api/stats/').json()
+        self.assertEqual((stats['dispensers'], stats['floors']), (0, []))
+
+
+class TenantScopingTests(PantryBossTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.other = User.objects.create_user('other', 'other@example.com', 'password123')
+        other_pantry = Pantry.objects.create(name='Theirs', floor=Floor.objects.create(number=1, user=self.other))
+        self.theirs = Dispenser.objects.create(type='CO', max_capacity=100, current_level=5, pantry=other_pantry)
+
+    def test_owner_is_copied_from_the_floor(self):
+        self.assertEqual(self.theirs.owner_id, self.other.id)
+        self.assertEqual(self.coffee.pantry.owner_id, self.user.id)
+
+    def test_lists_are_one_query_on_the_owner_without_joins(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/dispensers/')
+
+        self.assertEqual([row['id'] for row in response.json()['results']], [self.coffee.id, self.snack.id])
+        self.assertEqual(len(queries), 1)
+        self.assertIn('"owner_id" =', queries[0]['sql'])
+        self.assertNotIn('JOIN', queries[0]['sql'])
+
+    def test_other_tenants_objects_are_not_found(self):
+        # Warm the detail cache as the owner first; it must not leak to us
+        other_client = APIClient()
+        other_client.force_authenticate(self.other)
+        self.assertEqual(other_client.get(f'/api/dispensers/{self.theirs.id}/').status_code, 200)
+
+        self.assertEqual(self.client.get(f'/api/dispensers/{self.theirs.id}/').status_code, 404)
+        self.assertEqual(self.client.get(f'/api/pantries/{self.theirs.pantry_id}/').status_code, 404)
+        self.assertEqual(self.client.get('/api/dispensers/low/').json()['results'], [])
+        self.assertEqual(self.client.get(f'/api/floors/?user={self.other.id}').json()['results'][0]['user'], self.user.id)
+
+        response = self.client.post(f'/api/dispensers/{self.theirs.id}/update-level/', {'consume': 1}, format='json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_cannot_create_in_someone_elses_pantry_or_floor(self):
+        response = self.client.post('/api/dispensers/', {
+            'type': 'SN', 'max_capacity': 10, 'current_level': 10, 'pantry': self.theirs.pantry_id,
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post('/api/floors/', {'number': 7, 'user': self.other.id}, format='json')
+        self.assertEqual(Floor.objects.get(id=response.json()['id']).user, self.user)
+
+    def test_moving_a_floor_moves_its_contents(self):
+        self.floor.user = self.other
+        self.floor.save()
+
+        self.assertEqual(Dispenser.objects.filter(owner=self.other).count(), 3)
+        self.assertEqual(self.client.get('/api/pantries/').json()['results'], [])
+
+
+class ReplicaRoutingTests(PantryBossTestCase):
+
+    def read_aliases(self, path):
+        """The alias the router picked for every read of a GET request"""
+        aliases = []
+        route = PrimaryReplicaRouter.db_for_read
+
+        def spy(router, model, **hints):
+            aliases.append(route(router, model, **hints))
+            return aliases[-1]
+
+        with mock.patch.object(PrimaryReplicaRouter, 'db_for_read', spy):
+            self.client.get(path)
+        return aliases
+
+    def test_read_only_views_read_from_the_replica(self):
+        self.assertEqual(set(self.read_aliases('/api/dispensers/')), {'default'})
+        # No replica configured: everything reads from the primary
+        with override_settings(DATABASE_REPLICA={'ALIAS': 'missing'}):
+            self.assertEqual(set(self.read_aliases('/api/dispensers/?page_size=1')), {None})
+
+    def test_reads_stay_on_the_primary_after_a_write(self):
+        response = self.client.post(f'/api/dispensers/{self.coffee.id}/update-level/', {'consume': 5}, format='json')
+        self.assertIn('read_primary_until', response.cookies)
+
+        self.assertEqual(set(self.read_aliases(f'/api/dispensers/{self.coffee.id}/')), {None})
+
+        self.client.cookies['read_primary_until'] = '0'
+        self.assertEqual(set(self.read_aliases(f'/api/dispensers/{self.snack.id}/')), {'default'})
+
+
+class ListPaginationTests(PantryBossTestCase):
+
+    def test_list_follows_cursor_pages(self):
+        first = self.client.get('/api/dispensers/?page_size=1').json()
+        second = self.client.get(first['next']).json()
+
+        self.assertEqual([row['id'] for row in first['results']], [self.coffee.id])
+        self.assertEqual([row['id'] for row in second['results']], [self.snack.id])
+        self.assertIsNone(second['next'])
+
+    def test_fields_param_limits_the_output(self):
+        response = self.client.get('/api/dispensers/?fields=id,current_level')
+
+        self.assertEqual(response.json()['results'][0], {'id': self.coffee.id, 'current_level': 50})
+
+    def test_unknown_fields_are_rejected(self):
+        for url in ('/api/dispensers/?fields=id,bogus,nope', f'/api/dispensers/{self.coffee.id}/?fields=id,bogus,nope'):
+            response = self.client.get(url)
+
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'fields': 'Unknown fields: bogus, nope'})
+
+    def test_fields_without_id_still_pages(self):
+        first = self.client.get('/api/dispensers/?fields=current_level&page_size=1').json()
+
+        self.assertEqual(first['results'], [{'current_level': 50}])
+        self.assertEqual(len(self.client.get(first['next']).json()['results']), 1)
+
+    def test_values_rows_match_the_model_serializers(self):
+        Pantry.objects.create(name='Lounge', floor=self.floor, x=2.5)
+        for values_serializer, queryset in (
+            (FloorValuesSerializer, Floor.objects.all()),
+            (PantryValuesSerializer, Pantry.objects.all()),
+            (DispenserValuesSerializer, Dispenser.objects.all()),
+        ):
+            expected = values_serializer.serializer_class(queryset.order_by('id'), many=True).data
+            self.assertEqual(list(values_serializer.values(queryset.order_by('id'))), expected)
+
+
+class FastJSONTests(PantryBossTestCase):
+    DATA = {
+        'ts': datetime(2024, 11, 16, 6, 30, 0, 250000, tzinfo=UTC),
+        'amount': Decimal('1.5'),
+        'levels': {1: 42},
+        'name': 'Kitchen\u2028',
+        'pct': np.float64(12.5),
+    }
+
+    def test_renderer_matches_drf(self):
+        expected = JSONRenderer().render(self.DATA)
+
+        self.assertEqual(FastJSONRenderer().render(self.DATA), expected)
+        with mock.patch('main_app.renderers.orjson', None):
+            self.assertEqual(FastJSONRenderer().render(self.DATA), expected)
+
+    def test_invalid_json_body_is_a_400(self):
+        response = self.client.post('/api/dispensers/levels/bulk/', b'[{"id": 1,', content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('JSON parse error', response.json()['detail'])
+
+
+class ConsumptionHistoryTests(PantryBossTestCase):
+
+    def post_reading(self, dispenser, level, ts):
+        self.client.post(
+            f'/api/dispensers/{dispenser.id}/update-level/', {'current_level': level, 'ts': ts}, format='json'
+        )
+
+    def test_updates_append_readings(self):
+        self.post_reading(self.coffee, 40, '2024-11-16T08:10:00Z')
+        self.client.post('/api/dispensers/levels/bulk/', [
+            {'id': self.coffee.id, 'current_level': 30, 'ts': '2024-11-16T08:20:00Z'},
+            {'id': self.snack.id, 'current_level': 45, 'ts': '2024-11-16T08:20:00Z'},
+        ], format='json')
+
+        self.assertEqual(DispenserReading.objects.filter(dispenser=self.coffee).count(), 2)
+        self.assertEqual(DispenserReading.objects.filter(dispenser=self.snack).count(), 1)
+
+    def test_rollups_are_built_incrementally(self):
+        self.post_reading(self.coffee, 40, '2024-11-16T08:10:00Z')
+        self.post_reading(self.coffee, 30, '2024-11-16T08:50:00Z')
+        self.post_reading(self.coffee, 100, '2024-11-16T09:05:00Z')
+        build_rollups()
+        self.post_reading(self.coffee, 90, '2024-11-16T09:30:00Z')
+        result = build_rollups()
+
+        self.assertEqual(result['readings'], 1)
+        hours = DispenserRollup.objects.filter(period=DispenserRollup.HOUR).order_by('bucket')
+        self.assertEqual([(h.consumed, h.refilled, h.readings) for h in hours], [(10, 0, 2), (10, 70, 2)])
+        day = DispenserRollup.objects.get(period=DispenserRollup.DAY)
+        self.assertEqual((day.consumed, day.refilled, day.last_level), (20, 70, 90))
+
+    def test_a_reading_committed_after_a_build_is_still_rolled_up(self):
+        DispenserReading.objects.create(
+            id=100, dispenser=self.coffee, ts=datetime(2024, 11, 16, 8, 10, tzinfo=UTC), level=40,
+        )
+        build_rollups()
+        # Given its id and created_at before that build, but committed after it
+        DispenserReading.objects.create(
+            id=50, dispenser=self.coffee, ts=datetime(2024, 11, 16, 8, 20, tzinfo=UTC), level=25,
+            created_at=timezone.now() - timedelta(minutes=1),
+        )
+        build_rollups()
+
+        hour = DispenserRollup.objects.get(period=DispenserRollup.HOUR)
+        self.assertEqual((hour.readings, hour.last_level), (2, 25))
+
+    def test_consumption_endpoint_sums_rollups_per_floor(self):
+        self.post_reading(self.coffee, 50, '2024-11-16T08:00:00Z')
+        self.post_reading(self.coffee, 40, '2024-11-16T08:10:00Z')
+        self.post_reading(self.snack, 50, '2024-11-16T08:00:00Z')
+        self.post_reading(self.snack, 20, '2024-11-16T08:20:00Z')
+        build_rollups()
+
+        response = self.client.get('/api/consumption/', {
+            'floor': self.floor.id, 'start': '2024-11-16T00:00:00Z', 'end': '2024-11-17T00:00:00Z',
+        })
+
+        self.assertEqual(response.json()['total_consumed'], 40)
+        self.assertEqual(len(response.json()['buckets']), 1)
+
+    def test_consumption_requires_one_scope(self):
+        response = self.client.get('/api/consumption/')
+        self.assertEqual(response.status_code, 400)
+
+
+class ForecastTests(PantryBossTestCase):
+
+    def test_forecast_uses_recent_consumption(self):
+        now = timezone.now()
+        for hours_ago in range(3):
+            DispenserRollup.objects.create(
+                dispenser=self.coffee, period=DispenserRollup.HOUR, bucket=hour_of(now) - timedelta(hours=hours_ago),
+                consumed=10, last_level=50, readings=2,
+            )
+
+        forecasts = compute_forecasts(window_hours=3, alpha=0.5, now=now)
+        store_forecasts(forecasts)
+
+        coffee = DispenserForecast.objects.get(dispenser=self.coffee)
+        self.assertAlmostEqual(coffee.rate_per_hour, 10)
+        self.assertAlmostEqual(coffee.hours_to_empty, 5)
+        self.assertIsNone(DispenserForecast.objects.get(dispenser=self.snack).hours_to_empty)
+
+        response = self.client.get('/api/dispensers/forecast/?within=6')
+        self.assertEqual([row['id'] for row in response.json()], [self.coffee.id])
+        response = self.client.get('/api/dispensers/forecast/?within=4')
+        self.assertEqual(response.json(), [])
+
+    def test_within_must_be_a_sensible_number_of_hours(self):
+        for within in ('nan', 'inf', '-inf', '1e12', '0', '-3', 'soon'):
+            response = self.client.get('/api/dispensers/forecast/', {'within': within})
+            self.assertEqual(response.status_code, 400, within)
+
+    def test_old_forecasts_count_down_from_when_they_were_made(self):
+        made = timezone.now() - timedelta(hours=10)
+        DispenserForecast.objects.create(
+            dispenser=self.coffee, rate_per_hour=5, hours_to_empty=12,
+            empty_at=made + timedelta(hours=12), computed_at=made,
+        )
+
+        response = self.client.get('/api/dispensers/forecast/?within=4')
+
+        self.assertEqual([row['id'] for row in response.json()], [self.coffee.id])
+        self.assertIn(self.coffee.id, [row['id'] for row in candidates(self.user, within=4)])
+
+    def test_command_rejects_invalid_arguments(self):
+        for args in (['--alpha', '0'], ['--alpha', '1.5'], ['--window', '0']):
+            with self.assertRaises(CommandError):
+                call_command('forecast_depletion', *args, stdout=StringIO())
+
+
+class RefillPlanTests(PantryBossTestCase):
+
+    def test_within_must_be_a_sensible_number_of_hours(self):
+        for within in ('nan', 'inf', '1e12', '0'):
+            self.assertEqual(self.client.get('/api/refill-plan/', {'within': within}).status_code, 400, within)
+
+    def test_plan_covers_low_and_soon_empty_dispensers(self):
+        Dispenser.objects.filter(id=self.coffee.id).update(current_level=5)
+        DispenserForecast.objects.create(
+            dispenser=self.snack, rate_per_hour=10, hours_to_empty=5,
+            empty_at=timezone.now() + timedelta(hours=5), computed_at=timezone.now(),
+        )
+        upstairs = Pantry.objects.create(name='Lounge', floor=Floor.objects.create(number=3, user=self.user))
+        Dispenser.objects.create(type='CO', max_capacity=80, current_level=0, pantry=upstairs)
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/refill-plan/')
+        plan = response.json()
+
+        self.assertEqual(plan['floors'], [1, 3])
+        self.assertEqual([stop['pantry']['name'] for stop in plan['stops']], ['Kitchen', 'Lounge'])
+        self.assertEqual(plan['carry'], {'CO': 95 + 80, 'SN': 50})
+        self.assertEqual(plan['stops'][0]['carry'], {'CO': 95, 'SN': 50})
+
+        # The snack is only due in 5 hours
+        response = self.client.get('/api/refill-plan/?within=2')
+        self.assertEqual(response.json()['carry'], {'CO': 175})
+
+    def test_pantries_are_walked_in_a_short_order(self):
+        # Along a corridor: nearest-neighbour goes to 1 first, then has to walk back past the elevator
+        pantries = [(1, 1.0, 0.0), (2, -2.0, 0.0), (3, 3.0, 0.0), (4, -4.0, 0.0), (5, None, None)]
+        order, distance = order_pantries(pantries)
+
+        self.assertEqual(order[-1], 5)
+        self.assertEqual(sorted(order), [1, 2, 3, 4, 5])
+        self.assertLessEqual(distance, 11)
+
+    def test_floors_are_swept_from_the_nearer_end(self):
+        self.assertEqual(floor_order([1, 2, 5, 9], from_floor=8), [9, 5, 2, 1])
+        self.assertEqual(floor_order([1, 2, 5, 9], from_floor=2), [2, 1, 5, 9])
+        self.assertEqual(floor_order([3, 1, 2]), [1, 2, 3])
+
+
+class ApiCacheTests(PantryBossTestCase):
+
+    def test_detail_is_served_from_cache_until_the_object_changes(self):
+        url = f'/api/pantries/{self.pantry.id}/'
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).json()['name'], 'Kitchen')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(url, {'name': 'Lobby', 'floor': self.floor.id}, format='json')
+
+        self.assertEqual(self.client.get(url).json()['name'], 'Lobby')
+
+    def test_level_update_invalidates_dispenser_list(self):
+        self.client.get('/api/dispensers/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/api/dispensers/{self.coffee.id}/update-level/', {'current_level': 30}, format='json')
+
+        levels = {row['id']: row['current_level'] for row in self.client.get('/api/dispensers/').json()['results']}
+        self.assertEqual(levels[self.coffee.id], 30)
+
+    def test_other_tenants_writes_keep_the_list_cached(self):
+        other = User.objects.create_user('other', 'other@example.com', 'password123')
+        theirs = Dispenser.objects.create(
+            type='CO', max_capacity=10, current_level=10,
+            pantry=Pantry.objects.create(name='Theirs', floor=Floor.objects.create(number=1, user=other)),
+        )
+        self.client.get('/api/dispensers/')
+
+        their_client = APIClient()
+        their_client.force_authenticate(other)
+        with self.captureOnCommitCallbacks(execute=True):
+            their_client.post(f'/api/dispensers/{theirs.id}/update-level/', {'consume': 1}, format='json')
+
+        with self.assertNumQueries(0):
+            self.client.get('/api/dispensers/')
+
+    def test_bulk_update_invalidates_dispenser_detail(self):
+        url = f'/api/dispensers/{self.coffee.id}/'
+        self.client.get(url)
+        self.client.post('/api/dispensers/levels/bulk/', [{'id': self.coffee.id, 'current_level': 12}], format='json')
+
+        self.assertEqual(self.client.get(url).json()['current_level'], 12)
+
+    def test_pinned_client_skips_entries_built_from_the_replica(self):
+        self.client.get('/api/dispensers/')
+        # The primary moved on; the cached entry stands for what a lagging replica returned
+        Dispenser.objects.filter(id=self.coffee.id).update(current_level=7)
+
+        pinned = APIClient()
+        pinned.force_authenticate(self.user)
+        pinned.cookies['read_primary_until'] = str(timezone.now().timestamp() + 5)
+        levels = {row['id']: row['current_level'] for row in pinned.get('/api/dispensers/').json()['results']}
+
+        self.assertEqual(levels[self.coffee.id], 7)
+
+    def test_deleting_a_dispenser_deletes_its_history_in_bulk(self):
+        DispenserReading.objects.bulk_create(
+            DispenserReading(dispenser=self.coffee, ts=timezone.now(), level=level) for level in range(5)
+        )
+
+        with CaptureQueriesContext(connection) as captured:
+            self.client.delete(f'/api/dispensers/{self.coffee.id}/')
+
+        history = [q['sql'] for q in captured.captured_queries if 'main_app_dispenserreading' in q['sql']]
+        self.assertEqual(len(history), 1)
+        self.assertTrue(history[0].startswith('DELETE'))
+        self.assertFalse(DispenserReading.objects.exists())
+
+    def test_matching_etag_returns_304(self):
+        url = f'/api/floors/{self.floor.id}/'
+        etag = self.client.get(url)['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+
+class AsyncDispenserViewTests(PantryBossTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.async_client = AsyncClient()
+        self.headers = {'Authorization': f'Bearer {RefreshToken.for_user(self.user).access_token}'}
+
+    async def test_async_update_level_matches_the_sync_endpoint(self):
+        response = await self.async_client.post(
+            f'/api/async/dispensers/{self.coffee.id}/update-level/', {'consume': 20},
+            content_type='application/json', headers=self.headers,
+        )
+
+        self.assertEqual(response.json()['current_level'], 30)
+        dispenser = await Dispenser.objects.aget(id=self.coffee.id)
+        self.assertEqual(dispenser.current_level, 30)
+        self.assertEqual(await DispenserReading.objects.filter(dispenser_id=self.coffee.id).acount(), 1)
+
+    async def test_async_update_level_validates_the_body(self):
+        response = await self.async_client.post(
+            f'/api/async/dispensers/{self.coffee.id}/update-level/', {'consume': -1},
+            content_type='application/json', headers=self.headers,
+        )
+        self.assertEqual(response.status_code, 400)
+
+    async def test_async_list_pages_by_id(self):
+        first = (await self.async_client.get('/api/async/dispensers/?page_size=1', headers=self.headers)).json()
+        second = (await self.async_client.get(first['next'], headers=self.headers)).json()
+
+        self.assertEqual([row['id'] for row in first['results'] + second['results']], [self.coffee.id, self.snack.id])
+        self.assertIsNone(second['next'])
+
+    async def test_async_detail(self):
+        response = await self.async_client.get(f'/api/async/dispensers/{self.snack.id}/', headers=self.headers)
+        self.assertEqual(response.json()['type'], 'SN')
+
+        response = await self.async_client.get('/api/async/dispensers/9999/', headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+
+    async def test_async_views_need_a_login(self):
+        response = await self.async_client.get(f'/api/async/dispensers/{self.snack.id}/')
+        self.assertEqual(response.status_code, 401)
+
+
+class DeviceKeyTests(PantryBossTestCase):
+
+    def setUp(self):
+        super().setUp()
+        key_cache.clear()
+        self.key = issue_keys([self.coffee.id])[self.coffee.id]
+        self.device = APIClient()
+        self.device.credentials(HTTP_AUTHORIZATION=f'Device {self.key}')
+
+    def test_device_key_updates_its_dispenser_without_loading_a_user(self):
+        self.device.post(f'/api/dispensers/{self.coffee.id}/update-level/', {'consume': 5}, format='json')
+
+        # Verified keys are cached: only the level update itself touches the database
+        with CaptureQueriesContext(connection) as captured:
+            response = self.device.post(f'/api/dispensers/{self.coffee.id}/update-level/', {'consume': 5}, format='json')
+
+        self.assertEqual(response.json()['current_level'], 40)
+        lookups = [q['sql'] for q in captured.captured_queries
+                   if 'FROM "auth_user"' in q['sql'] or 'FROM "main_app_devicekey"' in q['sql']]
+        self.assertEqual(lookups, [])
+
+    def test_device_key_is_scoped_to_its_dispenser(self):
+        response = self.device.post(f'/api/dispensers/{self.snack.id}/update-level/', {'consume': 5}, format='json')
+        self.assertEqual(response.status_code, 403)
+
+        # Elsewhere it is no credential at all
+        response = self.device.get('/api/overview/')
+        self.assertEqual(response.status_code, 401)
+
+    def test_revoked_and_unknown_keys_are_rejected(self):
+        revoke_keys(DeviceKey.objects.filter(dispenser=self.coffee))
+
+        response = self.device.post(f'/api/dispensers/{self.coffee.id}/update-level/', {'consume': 5}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+        self.device.credentials(HTTP_AUTHORIZATION='Device pbk_not-a-key')
+        response = self.device.post(f'/api/dispensers/{self.coffee.id}/update-level/', {'consume': 5}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+    async def test_async_update_level_accepts_device_keys(self):
+        client = AsyncClient()
+        headers = {'Authorization': f'Device {self.key}'}
+
+        response = await client.post(f'/api/async/dispensers/{self.coffee.id}/update-level/', {'consume': 5},
+                                     content_type='application/json', headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+        response = await client.post(f'/api/async/dispensers/{self.snack.id}/update-level/', {'consume': 5},
+                                     content_type='application/json', headers=headers)
+        self.assertEqual(response.status_code, 403)
+
+
+class PerformanceMetricsTests(PantryBossTestCase):
+
+    def setUp(self):
+        super().setUp()
+        metrics_registry.reset()
+
+    def test_responses_carry_server_timing(self):
+        response = self.client.get('/api/overview/')
+
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('desc="3 queries"', response['Server-Timing'])
+
+    def test_metrics_are_aggregated_per_route(self):
+        self.client.get('/api/dispensers/')
+        self.client.get('/api/dispensers/')
+        self.client.get(f'/api/dispensers/{self.coffee.id}/')
+
+        body = self.client.get('/metrics').content.decode()
+
+        self.assertIn('pantryboss_request_duration_seconds_count{route="dispenser-list",method="GET"} 2', body)
+        self.assertIn('pantryboss_db_queries_bucket{route="dispenser-list",method="GET",le="1"} 2', body)
+        self.assertIn('pantryboss_responses_total{route="dispenser-detail",method="GET",status="200"} 1', body)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+
+class DispenserEventTests(PantryBossTestCase):
+
+    def events_request(self, query):
+        token = RefreshToken.for_user(self.user).access_token
+        return RequestFactory().get(f'/api/events/?{query}', HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    async def test_subscribers_receive_level_events_for_their_floor(self):
+        response = await dispenser_events(self.events_request(f'floor={self.floor.id}'))
+        stream = aiter(response.streaming_content)
+        await anext(stream)  # retry hint
+
+        dispenser = await Dispenser.objects.select_related('pantry').aget(id=self.coffee.id)
+        dispenser.current_level = 5
+        # Published from a worker thread, like a sync view would
+        await sync_to_async(publish_level_change, thread_sensitive=False)(dispenser, True)
+
+        level = (await anext(stream)).decode()
+        low_stock = (await anext(stream)).decode()
+        await stream.aclose()
+
+        self.assertTrue(level.startswith('event: level\n'))
+        self.assertIn('"current_level": 5', level)
+        self.assertTrue(low_stock.startswith('event: low_stock\n'))
+
+    async def test_cannot_subscribe_to_other_users_floor(self):
+        other = await User.objects.acreate(username='other', email='other@example.com')
+        floor = await Floor.objects.acreate(number=2, user=other)
+
+        response = await dispenser_events(self.events_request(f'floor={floor.id}'))
+
+        self.assertEqual(response.status_code, 404)
+
+    async def test_requires_a_token(self):
+        response = await dispenser_events(RequestFactory().get(f'/api/events/?floor={self.floor.id}'))
+        self.assertEqual(response.status_code, 401)
+
+
+class ResetDataTests(TestCase):
+
+    def test_reset_only_deletes_generated_sample_users(self):
+        for username in ('sampleuser', 'sampleuser3', 'sampleuser_alice', 'sampleuser0'):
+            User.objects.create_user(username, password='password123')
+
+        call_command('reset_data', floors=1, pantries=1, dispensers=1, stdout=StringIO())
+
+        self.assertEqual(
+            set(User.objects.values_list('username', flat=True)), {'sampleuser', 'sampleuser_alice', 'sampleuser0'},
+        )
+        self.assertEqual(Dispenser.objects.count(), 1)
+
+
+def fake_jwt(exp):
+    payload = base64.urlsafe_b64encode(json.dumps({'exp': exp}).encode()).decode().rstrip('=')
+    return f'header.{payload}.signature'
+
+
+class LoadGeneratorTests(SimpleTestCase):
+
+    def test_percentile_edge_cases(self):
+        self.assertEqual(percentile([], 50), 0.0)
+        self.assertEqual([percentile([0.3], pct) for pct in (0, 50, 99, 100)], [0.3] * 4)
+        values = list(range(1, 101))
+        self.assertEqual([percentile(values, pct) for pct in (0, 50, 95, 100)], [1, 50, 95, 100])
+
+    def test_token_expiry(self):
+        self.assertEqual(token_expiry(fake_jwt(1731736800)), 1731736800)
+        self.assertIsNone(token_expiry('not-a-token'))
+
+    def test_token_is_renewed_before_it_expires(self):
+        tokens = TokenManager('http://testserver/api/login/', 'sampleuser', 'password123', refresh_margin=60)
+        now = 1_000_000
+        issued = []
+
+        def login(url, json, timeout):
+            issued.append(fake_jwt(now + 600))
+            return mock.Mock(**{'json.return_value': {'access': issued[-1]}})
+
+        with mock.patch('main_app.loadgen.requests.post', side_effect=login), \
+                mock.patch('main_app.loadgen.time.time', side_effect=lambda: now):
+            first = tokens.get()
+            now += 500  # 100 s left: still outside the margin
+            self.assertEqual(tokens.get(), first)
+            now += 50  # 50 s left: renewed before it runs out
+            self.assertNotEqual(tokens.get(), first)
+
+        self.assertEqual(len(issued), 2)
+
+
+    def test_device_key_frames_hold_one_devices_readings(self):
+        keys = {1: 'pbk_one', 2: 'pbk_two', 3: 'pbk_three'}
+        generator = LoadGenerator(
+            'http://testserver', None, list(keys), devices=3, rate=1, duration=1,
+            bulk=True, batch_size=20, device_keys=keys, binary=True,
+        )
+
+        for _ in range(10):
+            _, frame, count, key = generator._request()
+            ids = {reading.id for reading in decode_frame(frame)}
+            self.assertEqual(count, 20)
+            self.assertEqual(len(ids), 1)
+            self.assertEqual(key, keys[ids.pop()])
+
+        with self.assertRaises(ValueError):
+            LoadGenerator('http://testserver', None, list(keys), 3, 1, 1, bulk=True, device_keys=keys)
+
+    def test_only_applied_readings_count_as_delivered(self):
+        tokens = mock.Mock(**{'get.return_value': 'token'})
+        generator = LoadGenerator('http://testserver', tokens, [1, 2], devices=2, rate=1, duration=1,
+                                  bulk=True, batch_size=10)
+        responses = [
+            mock.Mock(status_code=200, **{'json.return_value': {'updated': 7, 'results': []}}),
+            mock.Mock(status_code=200, **{'json.return_value': {'updated': 10, 'results': []}}),
+            mock.Mock(status_code=400),
+        ]
+        session = mock.Mock(**{'post.side_effect': responses})
+
+        with mock.patch.object(generator, '_session', return_value=session):
+            for _ in responses:
+                generator._send_one(0.0)
+
+        report = generator._report
+        self.assertEqual((report.readings, report.rejected, report.errors), (17, 3, 1))
+        self.assertEqual(report.summary()['rejected'], 3)
+
+
+class BenchmarkCompareTests(SimpleTestCase):
+
+    @staticmethod
+    def results(p50_ms, queries=2, name='dispenser-list'):
+        return {'benchmarks': {name: {'p50_ms': p50_ms, 'queries': queries}}}
+
+    def test_slowdown_is_flagged_only_beyond_the_tolerance(self):
+        baseline = self.results(10.0)
+
+        self.assertEqual(compare(self.results(12.0), baseline, tolerance=0.2), [])
+        self.assertEqual(
+            compare(self.results(12.1), baseline, tolerance=0.2), ['dispenser-list: p50 10.0 ms -> 12.1 ms'],
+        )
+        self.assertEqual(len(compare(self.results(10.5), baseline, tolerance=0.0)), 1)
+
+    def test_any_extra_query_is_flagged(self):
+        self.assertEqual(
+            compare(self.results(10.0, queries=3), self.results(10.0)), ['dispenser-list: 2 -> 3 queries'],
+        )
+        self.assertEqual(compare(self.results(5.0, queries=1), self.results(10.0)), [])
+
+    def test_benchmarks_missing_from_the_baseline_are_skipped(self):
+        self.assertEqual(compare(self.results(100.0, name='stats'), self.results(1.0)), [])
+        self.assertEqual(compare(self.results(100.0), {}), [])
+
+    def test_error_responses_are_not_timed(self):
+        self.assertEqual(measure(lambda: ok(mock.Mock(status_code=201)), iterations=2, warmup=0)['iterations'], 2)
+        with self.assertRaisesMessage(BenchmarkError, '403 response: denied'):
+            measure(lambda: ok(mock.Mock(status_code=403, content=b'denied')), iterations=2, warmup=0)
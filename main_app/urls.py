@@ -8,8 +8,23 @@ urlpatterns = [
     path('pantries/', views.PantryListCreateView.as_view(), name='pantry-list'),
     path('pantries/<int:id>/', views.PantryDetailView.as_view(), name='pantry-detail'),
     path('dispensers/', views.DispenserListCreateView.as_view(), name='dispenser-list'),
+    path('dispensers/low/', views.LowDispenserListView.as_view(), name='dispenser-low-list'),
+    path('dispensers/forecast/', views.DispenserForecastListView.as_view(), name='dispenser-forecast'),
+    path('dispensers/levels/bulk/', views.BulkUpdateDispenserLevels.as_view(), name='bulk-update-dispenser-levels'),
+    path('dispensers/levels/frame/', views.BinaryLevelFrameView.as_view(), name='dispenser-level-frame'),
     path('dispensers/<int:id>/', views.DispenserDetailView.as_view(), name='dispenser-detail'),
     path('dispensers/<int:id>/update-level/', views.UpdateDispenserLevel.as_view(), name='update-dispenser-level'),
+    path('async/dispensers/', views.async_dispenser_list, name='async-dispenser-list'),
+    path('async/dispensers/<int:id>/', views.async_dispenser_detail, name='async-dispenser-detail'),
+    path('async/dispensers/<int:id>/update-level/', views.async_update_dispenser_level,
+         name='async-update-dispenser-level'),
+    path('alert-rules/', views.AlertRuleListCreateView.as_view(), name='alert-rule-list'),
+    path('alert-rules/<int:id>/', views.AlertRuleDetailView.as_view(), name='alert-rule-detail'),
+    path('consumption/', views.ConsumptionView.as_view(), name='consumption'),
+    path('events/', views.dispenser_events, name='dispenser-events'),
+    path('overview/', views.BuildingOverviewView.as_view(), name='building-overview'),
+    path('stats/', views.BuildingStatsView.as_view(), name='building-stats'),
+    path('refill-plan/', views.RefillPlanView.as_view(), name='refill-plan'),
     path('users/register/', views.CreateUserView.as_view(), name='register'),
     path('users/login/', views.LoginView.as_view(), name='login'),
     path('users/token/refresh/', views.VerifyUserView.as_view(), name='token_refresh'),
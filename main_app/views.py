@@ -1,16 +1,89 @@
+import asyncio
+import functools
+import json
+import math
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
 from rest_framework import status, generics, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from django.core.mail import send_mail, BadHeaderError
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import authenticate
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from django.core.cache import cache
+from django.db.models import Prefetch
+from rest_framework.authentication import get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
 
 # Import our models and serializers
-from .models import Floor, Pantry, Dispenser
+from .models import Floor, Pantry, Dispenser, DispenserForecast, DispenserRollup, AlertRule
+from .rollups import bucket_range, consumption
+from .cache import CachedListMixin, CachedRetrieveMixin, cached_response, make_entry
+from .db_routing import ReplicaReadMixin, read_from_replica
+from .device_auth import DeviceIdentity, DeviceKeyAuthentication, DeviceKeyScope, adispenser_for_key, get_raw_key
+from .events import floor_channel, format_sse, get_broker, pantry_channel
+from .frames import LevelFrameParser
+from .levels import bulk_update_levels, update_level
+from .metrics import registry as metrics_registry
+from .pagination import IdCursorPagination
+from .write_behind import PendingLevelsMixin, level_buffer
+from .refill_plan import DEFAULT_WITHIN_HOURS, build_plan, candidates
+from .stats import building_stats, grouped_rows
 from django.contrib.auth.models import User
-from .serializers import FloorSerializer, PantrySerializer, DispenserSerializer, UserSerializer, LoginSerializer
+from .serializers import (
+    FloorSerializer, PantrySerializer, DispenserSerializer, DispenserLevelReadingSerializer, OverviewFloorSerializer,
+    DispenserLevelUpdateSerializer, ConsumptionQuerySerializer, AlertRuleSerializer, DispenserForecastSerializer,
+    FloorValuesSerializer, PantryValuesSerializer, DispenserValuesSerializer,
+    UserSerializer, LoginSerializer, check_requested_fields, get_requested_fields,
+)
+
+
+# --------------------------------------------------------
+# SHARED LIST BEHAVIOUR
+# --------------------------------------------------------
+
+class SparseListMixin:
+    """
+    Cursor pagination plus ?fields= support for list views. Only the requested
+    columns are loaded from the database. With a ``values_serializer_class`` the
+    page is built from ``.values()`` rows instead of model instances.
+    """
+    pagination_class = IdCursorPagination
+    values_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        if self.values_serializer_class is None:
+            return super().list(request, *args, **kwargs)
+        requested = get_requested_fields(request)
+        if requested:
+            check_requested_fields(requested, self.values_serializer_class.field_names())
+        page = self.paginate_queryset(
+            self.values_serializer_class.values(self.filter_queryset(self.get_queryset()), requested)
+        )
+        response = self.get_paginated_response(page)
+        if requested and 'id' not in requested:
+            # Only loaded for the cursor, which the links above are already built from
+            for row in page:
+                del row['id']
+        return response
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        requested = get_requested_fields(self.request)
+        if requested:
+            columns = {field.name for field in queryset.model._meta.concrete_fields}
+            queryset = queryset.only('id', *(requested & columns))
+        return queryset
 
 
 # --------------------------------------------------------
@@ -18,23 +91,20 @@ from .serializers import FloorSerializer, PantrySerializer, DispenserSerializer,
 # --------------------------------------------------------
 
 # This view handles listing all floors and creating new floors
-class FloorListCreateView(generics.ListCreateAPIView):
+class FloorListCreateView(ReplicaReadMixin, CachedListMixin, SparseListMixin, generics.ListCreateAPIView):
     """
     Handles:
-    - GET: List all floors, optionally filtered by user
+    - GET: List the logged-in user's floors
     - POST: Create a new floor
     """
     serializer_class = FloorSerializer
+    values_serializer_class = FloorValuesSerializer
+    cache_name = 'floor'
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        """Return floors filtered for the logged-in user or by query parameter"""
-        user = self.request.user
-        user_id = self.request.query_params.get('user')
-
-        if user_id:
-            return Floor.objects.filter(user_id=user_id)
-        return Floor.objects.filter(user=user)
+        """Return the floors of the logged-in user"""
+        return Floor.objects.filter(user=self.request.user)
 
     def perform_create(self, serializer):
         """Associate the logged-in user with the newly created floor"""
@@ -42,87 +112,254 @@ class FloorListCreateView(generics.ListCreateAPIView):
 
 
 # This view handles retrieving, updating, or deleting a specific floor by ID
-class FloorDetailView(generics.RetrieveUpdateDestroyAPIView):
+class FloorDetailView(ReplicaReadMixin, CachedRetrieveMixin, generics.RetrieveUpdateDestroyAPIView):
     """
     Handles:
     - GET: Retrieve a specific floor by ID
     - PUT: Update a specific floor by ID
     - DELETE: Delete a specific floor by ID
+
+    Other users' floors are not found (404).
     """
-    queryset = Floor.objects.all()
     serializer_class = FloorSerializer
+    cache_name = 'floor'
+    permission_classes = [permissions.IsAuthenticated]
     lookup_field = 'id'  # Use 'id' instead of the default 'pk'
 
+    def get_queryset(self):
+        return Floor.objects.filter(user=self.request.user)
+
 
 # --------------------------------------------------------
 # PANTRY VIEWS
 # --------------------------------------------------------
 
 # Handles listing all pantries and creating new ones
-class PantryListCreateView(generics.ListCreateAPIView):
+class PantryListCreateView(ReplicaReadMixin, CachedListMixin, SparseListMixin, generics.ListCreateAPIView):
     """
     Handles:
-    - GET: List all pantries, optionally filtered by floor
-    - POST: Create a new pantry
+    - GET: List the logged-in user's pantries, optionally filtered by floor
+    - POST: Create a new pantry on one of your floors
+
+    Pantries carry their owner, so this is one lookup on the (owner, id) index
+    without a join through the floors.
     """
     serializer_class = PantrySerializer
+    values_serializer_class = PantryValuesSerializer
+    cache_name = 'pantry'
+    permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        """Return pantries filtered by the floor query parameter if provided"""
+        """Return the user's pantries, filtered by the floor query parameter if provided"""
+        pantries = Pantry.objects.filter(owner=self.request.user)
         floor_id = self.request.query_params.get('floor')
 
         if floor_id:
-            return Pantry.objects.filter(floor_id=floor_id)
-        return Pantry.objects.all()
+            return pantries.filter(floor_id=floor_id)
+        return pantries
 
 
 # Handles retrieving, updating, or deleting a specific pantry by ID
-class PantryDetailView(generics.RetrieveUpdateDestroyAPIView):
+class PantryDetailView(ReplicaReadMixin, CachedRetrieveMixin, generics.RetrieveUpdateDestroyAPIView):
     """
     Handles:
     - GET: Retrieve a specific pantry by ID
     - PUT: Update a specific pantry by ID
     - DELETE: Delete a specific pantry by ID
     """
-    queryset = Pantry.objects.all()
     serializer_class = PantrySerializer
+    cache_name = 'pantry'
+    permission_classes = [permissions.IsAuthenticated]
     lookup_field = 'id'
 
+    def get_queryset(self):
+        return Pantry.objects.filter(owner=self.request.user)
+
 
 # --------------------------------------------------------
 # DISPENSER VIEWS
 # --------------------------------------------------------
 
 # Handles listing all dispensers and creating new ones
-class DispenserListCreateView(generics.ListCreateAPIView):
+class DispenserListCreateView(
+    ReplicaReadMixin, PendingLevelsMixin, CachedListMixin, SparseListMixin, generics.ListCreateAPIView
+):
     """
     Handles:
-    - GET: List all dispensers, optionally filtered by pantry
-    - POST: Create a new dispenser
+    - GET: List the logged-in user's dispensers, optionally filtered by pantry
+    - POST: Create a new dispenser in one of your pantries
     """
     serializer_class = DispenserSerializer
+    values_serializer_class = DispenserValuesSerializer
+    cache_name = 'dispenser'
+    permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        """Return dispensers filtered by the pantry query parameter if provided"""
+        """Return the user's dispensers, filtered by the pantry query parameter if provided"""
+        dispensers = Dispenser.objects.filter(owner=self.request.user)
         pantry_id = self.request.query_params.get('pantry')
 
         if pantry_id:
-            return Dispenser.objects.filter(pantry_id=pantry_id)
-        return Dispenser.objects.all()
+            return dispensers.filter(pantry_id=pantry_id)
+        return dispensers
 
 
 # Handles retrieving, updating, or deleting a specific dispenser by ID
-class DispenserDetailView(generics.RetrieveUpdateDestroyAPIView):
+class DispenserDetailView(
+    ReplicaReadMixin, PendingLevelsMixin, CachedRetrieveMixin, generics.RetrieveUpdateDestroyAPIView
+):
     """
     Handles:
     - GET: Retrieve a specific dispenser by ID
     - PUT: Update a specific dispenser by ID
     - DELETE: Delete a specific dispenser by ID
     """
-    queryset = Dispenser.objects.all()
     serializer_class = DispenserSerializer
+    cache_name = 'dispenser'
+    permission_classes = [permissions.IsAuthenticated]
     lookup_field = 'id'
 
+    def get_queryset(self):
+        return Dispenser.objects.filter(owner=self.request.user)
+
+
+# Lists the dispensers that need refilling
+class LowDispenserListView(ReplicaReadMixin, SparseListMixin, generics.ListAPIView):
+    """
+    Handles:
+    - GET: List your dispensers that are below their threshold
+
+    Uses the database-maintained ``is_low`` column and its partial index, so only
+    the low rows are read.
+    """
+    serializer_class = DispenserSerializer
+    values_serializer_class = DispenserValuesSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return Dispenser.objects.filter(owner=self.request.user, is_low=True)
+
+
+MAX_WITHIN_HOURS = 24 * 366
+
+
+def _within_hours(request, default):
+    """The ``?within=`` query parameter: a number of hours, more than 0 and at most a year"""
+    try:
+        within = float(request.query_params.get('within', default))
+    except ValueError:
+        raise ValidationError({'within': "'within' must be a number of hours"})
+    if not math.isfinite(within) or not 0 < within <= MAX_WITHIN_HOURS:
+        raise ValidationError({'within': f"'within' must be more than 0 and at most {MAX_WITHIN_HOURS} hours"})
+    return within
+
+
+# Lists the dispensers expected to run empty soon
+class DispenserForecastListView(ReplicaReadMixin, generics.ListAPIView):
+    """
+    Handles:
+    - GET: Your dispensers that will be empty within ``?within=`` hours (default 24), soonest first
+
+    Reads the forecasts stored by the ``forecast_depletion`` command. They are
+    matched by ``empty_at``, so a forecast keeps counting down after it was made.
+    """
+    serializer_class = DispenserForecastSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    @swagger_auto_schema(manual_parameters=[
+        openapi.Parameter('within', openapi.IN_QUERY, type=openapi.TYPE_NUMBER, description='Hours ahead (default 24)'),
+    ])
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def get_queryset(self):
+        within = _within_hours(self.request, 24)
+        return (
+            DispenserForecast.objects
+            .filter(dispenser__owner=self.request.user, empty_at__lte=timezone.now() + timedelta(hours=within))
+            .select_related('dispenser')
+            .order_by('empty_at')
+        )
+
+
+# --------------------------------------------------------
+# BUILDING OVERVIEW
+# --------------------------------------------------------
+
+class BuildingOverviewView(ReplicaReadMixin, generics.ListAPIView):
+    """
+    Handles:
+    - GET: The whole floor -> pantry -> dispenser tree of the logged-in user
+
+    Always costs three queries (floors, pantries, dispensers), no matter how many
+    pantries or dispensers there are.
+    """
+    serializer_class = OverviewFloorSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        dispensers = Dispenser.objects.order_by('id')
+        pantries = Pantry.objects.order_by('id').prefetch_related(Prefetch('dispenser_set', queryset=dispensers))
+        return (
+            Floor.objects.filter(user=self.request.user)
+            .order_by('number', 'id')
+            .prefetch_related(Prefetch('pantry_set', queryset=pantries))
+        )
+
+
+class BuildingStatsView(ReplicaReadMixin, APIView):
+    """
+    Handles:
+    - GET: Dispenser counts, stock, fill percentage and low counts of the logged-in
+      user's building, per floor, per pantry and per dispenser type
+
+    One grouped query (see ``stats``). The result is cached per user for
+    ``STATS_CACHE_TIMEOUT`` seconds instead of being invalidated on every level
+    update, so a busy building still costs at most one query per interval.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        key = f'api:stats:{request.user.pk}'
+        entry = cache.get(key)
+        if entry is None:
+            entry = make_entry(building_stats(grouped_rows(request.user)))
+            cache.set(key, entry, getattr(settings, 'STATS_CACHE_TIMEOUT', 10))
+        return cached_response(request, entry)
+
+
+# --------------------------------------------------------
+# REFILL ROUTE
+# --------------------------------------------------------
+
+class RefillPlanView(APIView):
+    """
+    Handles:
+    - GET: The refill round for the logged-in user's building: the dispensers that
+      are low or alerting now or will be empty within ``?within=`` hours (default 8),
+      in walking order, floor by floor, with the stock to carry per type
+
+    ``?from_floor=`` is where the round starts; without it floors go bottom to top.
+    One query, then the route is planned in memory (see ``refill_plan``).
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    @swagger_auto_schema(manual_parameters=[
+        openapi.Parameter('within', openapi.IN_QUERY, type=openapi.TYPE_NUMBER,
+                          description=f'Also refill what runs empty within this many hours (default {DEFAULT_WITHIN_HOURS})'),
+        openapi.Parameter('from_floor', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                          description='Floor number the round starts on'),
+    ])
+    def get(self, request):
+        within = _within_hours(request, DEFAULT_WITHIN_HOURS)
+        from_floor = request.query_params.get('from_floor')
+        if from_floor is not None:
+            try:
+                from_floor = int(from_floor)
+            except ValueError:
+                raise ValidationError({'from_floor': "'from_floor' must be a floor number"})
+        return Response(build_plan(candidates(request.user, within), from_floor))
+
 
 # --------------------------------------------------------
 # CUSTOM API VIEW FOR UPDATING DISPENSER LEVEL
@@ -132,16 +369,37 @@ class UpdateDispenserLevel(APIView):
     """
     Handles:
     - POST: Update the level of a dispenser and notify if it's running low
+
+    The level is either set (``current_level``) or changed relative to whatever it
+    is in the database (``consume``, ``refill``, ``refill_to_full``). Either way it
+    is one ``UPDATE`` clamped to ``[0, max_capacity]``, so concurrent updates
+    can't overwrite each other. A reading with a ``seq`` the dispenser already has,
+    or a lower one, is acknowledged but not applied, so retries are safe.
+
+    Sensors authenticate with their dispenser's device key (``Authorization: Device <key>``),
+    which is checked without loading a user. Users can only update their own dispensers.
     """
+    authentication_classes = [JWTAuthentication, DeviceKeyAuthentication]
+    permission_classes = [permissions.IsAuthenticated, DeviceKeyScope]
 
     @swagger_auto_schema(
-        operation_description="Update the current level of a dispenser",
+        operation_description="Set the level of a dispenser, or change it by a relative amount",
         request_body=openapi.Schema(
             type=openapi.TYPE_OBJECT,
             properties={
                 'current_level': openapi.Schema(type=openapi.TYPE_INTEGER, description='Current level in units'),
+                'consume': openapi.Schema(type=openapi.TYPE_INTEGER, description='Units taken out (stops at 0)'),
+                'refill': openapi.Schema(type=openapi.TYPE_INTEGER,
+                                         description='Units put in (stops at max_capacity)'),
+                'refill_to_full': openapi.Schema(type=openapi.TYPE_BOOLEAN, description='Fill up to max_capacity'),
+                'ts': openapi.Schema(type=openapi.TYPE_STRING, format=openapi.FORMAT_DATETIME,
+                                     description='When the reading was taken (defaults to now)'),
+                'seq': openapi.Schema(type=openapi.TYPE_INTEGER,
+                                      description="The device's number for this reading; old ones are ignored"),
+                'seq_reset': openapi.Schema(type=openapi.TYPE_BOOLEAN,
+                                            description="The device's counter started over at this seq"),
             },
-            required=['current_level']
+            description="Exactly one of current_level, consume, refill or refill_to_full",
         ),
         responses={
             200: "Dispenser updated successfully",
@@ -150,55 +408,448 @@ class UpdateDispenserLevel(APIView):
         }
     )
     def post(self, request, id):
-        # Try to get the dispenser with the given ID
-        try:
-            dispenser = Dispenser.objects.get(id=id)
-        except Dispenser.DoesNotExist:
+        # Validate the body: one operation, and optionally when the reading was taken
+        serializer = DispenserLevelUpdateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({"error": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+        data = serializer.validated_data
+        operation = data['operation']
+
+        # Let the database compute the new level and append it to the history, then queue
+        # a notification if the dispenser just went low (sent in the background) and push
+        # the new level to the dashboards watching this floor or pantry
+        owner = None if isinstance(request.auth, DeviceIdentity) else request.user
+        dispenser = update_level(
+            id, operation, data.get(operation), data.get('ts'), owner, data.get('seq'), data['seq_reset']
+        )
+        if dispenser is None:
             return Response({"error": "Dispenser not found"}, status=status.HTTP_404_NOT_FOUND)
 
-        # Get the 'current_level' from the request data
-        new_level = request.data.get('current_level')
-        if new_level is None:
-            return Response({"error": "'current_level' is required"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(
+            {"message": _level_update_message(dispenser), "current_level": dispenser.current_level},
+            status=status.HTTP_200_OK,
+        )
 
-        # Ensure the new level is an integer and is not negative
-        try:
-            new_level = int(new_level)
-            if new_level < 0:
-                raise ValueError("Level cannot be negative")
-        except ValueError:
-            return Response({"error": "'current_level' must be a positive integer"}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Update the dispenser's current level
-        dispenser.current_level = new_level
-        dispenser.save()
-
-        # Check if the dispenser is running low and send a notification
-        if dispenser.is_running_low():
-            self.notify_user(dispenser)
-
-        return Response({"message": "Dispenser updated successfully"}, status=status.HTTP_200_OK)
-
-    def notify_user(self, dispenser):
-        """
-        Sends an email notification if the dispenser level is too low.
-        """
-        subject = f"{dispenser.get_type_display()} Dispenser Running Low"
-        message = (
-            f"The dispenser in pantry '{dispenser.pantry.name}' on floor '{dispenser.pantry.floor.number}' "
-            "is running low. Please refill it soon."
+
+def _level_update_message(dispenser):
+    if dispenser.applied:
+        return "Dispenser updated successfully"
+    # A retry, or a reading that arrived after a newer one: nothing to send again
+    return "Reading already applied or superseded by a newer one"
+
+
+# --------------------------------------------------------
+# ALERT RULE VIEWS
+# --------------------------------------------------------
+
+class AlertRuleListCreateView(ReplicaReadMixin, generics.ListCreateAPIView):
+    """
+    Handles:
+    - GET: List your alert rules
+    - POST: Create an alert rule (e.g. coffee dispensers alert below 30% before 9am)
+    """
+    serializer_class = AlertRuleSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return AlertRule.objects.filter(user=self.request.user).order_by('id')
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user)
+
+
+class AlertRuleDetailView(ReplicaReadMixin, generics.RetrieveUpdateDestroyAPIView):
+    """
+    Handles:
+    - GET: Retrieve one of your alert rules
+    - PUT: Update it
+    - DELETE: Delete it
+    """
+    serializer_class = AlertRuleSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    lookup_field = 'id'
+
+    def get_queryset(self):
+        return AlertRule.objects.filter(user=self.request.user)
+
+
+# --------------------------------------------------------
+# BULK API VIEW FOR IOT FLEETS
+# --------------------------------------------------------
+
+class BulkUpdateDispenserLevels(APIView):
+    """
+    Handles:
+    - POST: Apply a batch of sensor readings in a single write
+
+    The body is a list of ``{"id", "current_level", "ts", "seq"}`` objects. Every item is
+    validated, the matching dispensers are loaded with one query and the new levels
+    are written with one ``UPDATE``; the readings are appended to the history
+    with one ``bulk_create``. The response lists a result per item, in the same
+    order as the request. Other users' dispensers are ``not_found``, and readings
+    with a ``seq`` the dispenser already has are ``stale``.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    max_batch_size = 1000
+
+    @swagger_auto_schema(
+        operation_description="Update the current level of many dispensers at once",
+        request_body=DispenserLevelReadingSerializer(many=True),
+        responses={
+            200: "Per-item results",
+            400: "Body is not a list or the batch is too large",
+        }
+    )
+    def post(self, request):
+        readings = request.data
+        if not isinstance(readings, list):
+            return Response({"error": "Expected a list of readings"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(readings) > self.max_batch_size:
+            return Response(
+                {"error": f"A batch can hold at most {self.max_batch_size} readings"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Step 1: Validate every reading in one pass, remembering the errors per item
+        results = [None] * len(readings)
+        validated = {}  # index -> validated reading
+        reading_serializer = DispenserLevelReadingSerializer()
+        for index, item in enumerate(readings):
+            try:
+                validated[index] = reading_serializer.run_validation(item)
+            except ValidationError as e:
+                results[index] = {"index": index, "id": _item_id(item), "status": "invalid", "errors": e.detail}
+
+        # Step 2: Write the newest reading of each of the user's dispensers, see ``bulk_update_levels``
+        indexes = list(validated)
+        statuses = bulk_update_levels(
+            [validated[index] for index in indexes], Dispenser.objects.filter(owner=request.user)
         )
-        try:
-            send_mail(
-                subject=subject,
-                message=message,
-                from_email='no-reply@yourapp.com',
-                recipient_list=['user@example.com']
+        for index, result in zip(indexes, statuses):
+            results[index] = {"index": index, "id": validated[index]['id'], "status": result}
+
+        updated = sum(1 for result in results if result["status"] == "updated")
+        return Response({"updated": updated, "results": results}, status=status.HTTP_200_OK)
+
+
+class BinaryLevelFrameView(APIView):
+    """
+    Handles:
+    - POST: Apply a binary frame of sensor readings (``Content-Type: application/vnd.pantryboss.levels``)
+
+    The compact alternative to ``update-level`` and the bulk endpoint for
+    constrained devices; see ``frames`` for the format. The readings are written
+    like a bulk update: the newest of each dispenser wins, by sequence number and
+    then by timestamp, and readings the dispenser already has are ``stale``. A
+    device key may only send readings of its own dispenser; a user's readings of
+    other users' dispensers are not found, as usual.
+    """
+    authentication_classes = [JWTAuthentication, DeviceKeyAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+    parser_classes = [LevelFrameParser]
+    max_batch_size = BulkUpdateDispenserLevels.max_batch_size
+
+    @swagger_auto_schema(
+        operation_description="Update the current level of many dispensers from a binary frame",
+        request_body=openapi.Schema(type=openapi.TYPE_STRING, format=openapi.FORMAT_BINARY),
+        responses={
+            200: "Counts of updated and superseded readings, and the dispenser ids not found",
+            400: "Malformed frame or the batch is too large",
+        }
+    )
+    def post(self, request):
+        readings = request.data
+        if not isinstance(readings, list):
+            return Response({"error": "Expected a level frame"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(readings) > self.max_batch_size:
+            return Response(
+                {"error": f"A frame can hold at most {self.max_batch_size} readings"},
+                status=status.HTTP_400_BAD_REQUEST
             )
-        except BadHeaderError:
-            print("Invalid email header detected.")
-        except Exception as e:
-            print(f"Failed to send email: {e}")
+
+        if isinstance(request.auth, DeviceIdentity):
+            dispensers = Dispenser.objects.filter(id=request.auth.dispenser_id)
+        else:
+            dispensers = Dispenser.objects.filter(owner=request.user)
+        statuses = bulk_update_levels([reading._asdict() for reading in readings], dispensers)
+
+        return Response({
+            "updated": statuses.count('updated'),
+            "superseded": statuses.count('superseded'),
+            "stale": statuses.count('stale'),
+            "not_found": sorted({reading.id for reading, result in zip(readings, statuses) if result == 'not_found'}),
+        }, status=status.HTTP_200_OK)
+
+
+def _item_id(item):
+    """Best-effort id of a raw reading, used to label validation errors"""
+    return item.get('id') if isinstance(item, dict) else None
+
+
+# --------------------------------------------------------
+# CONSUMPTION HISTORY
+# --------------------------------------------------------
+
+class ConsumptionView(APIView):
+    """
+    Handles:
+    - GET: Consumption of a dispenser, pantry or floor per hour or per day
+
+    Reads the rollups built by the ``build_rollups`` command, never the raw
+    readings, so it stays fast however long the history gets.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    @swagger_auto_schema(query_serializer=ConsumptionQuerySerializer)
+    def get(self, request):
+        query = ConsumptionQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        params = query.validated_data
+
+        period = ConsumptionQuerySerializer.GRANULARITIES[params['granularity']]
+        start, end = bucket_range(period, end=params.get('end'))
+        start = params.get('start', start)
+
+        # Narrow the rollups down to the dispensers in scope
+        rollups = DispenserRollup.objects.filter(dispenser__owner=request.user)
+        if 'dispenser' in params:
+            rollups = rollups.filter(dispenser_id=params['dispenser'])
+        elif 'pantry' in params:
+            rollups = rollups.filter(dispenser__pantry_id=params['pantry'])
+        else:
+            rollups = rollups.filter(dispenser__pantry__floor_id=params['floor'])
+
+        buckets = list(consumption(rollups, period, start, end))
+        return Response({
+            'granularity': params['granularity'],
+            'start': start,
+            'end': end,
+            'total_consumed': sum(bucket['consumed'] for bucket in buckets),
+            'total_refilled': sum(bucket['refilled'] for bucket in buckets),
+            'buckets': buckets,
+        }, status=status.HTTP_200_OK)
+
+
+# --------------------------------------------------------
+# ASYNC DISPENSER VIEWS (NEED THE ASGI SERVER)
+# --------------------------------------------------------
+
+ASYNC_PAGE_SIZE = 100
+ASYNC_MAX_PAGE_SIZE = 1000
+
+
+async def _authenticate_async(request, allow_query_token=False):
+    """
+    What DRF's JWTAuthentication does, without blocking the event loop. The token
+    comes from the Authorization header or, with ``allow_query_token``, from
+    ``?token=``. Returns None when no token was sent and raises InvalidToken or
+    TokenError for a bad one.
+    """
+    authenticator = JWTAuthentication()
+    header = authenticator.get_header(request)
+    raw_token = authenticator.get_raw_token(header) if header else None
+    if raw_token is None and allow_query_token:
+        raw_token = request.GET.get('token')
+    if not raw_token:
+        return None
+    validated = authenticator.get_validated_token(raw_token)
+    return await sync_to_async(authenticator.get_user)(validated)
+
+
+def _async_view(view=None, *, device_keys=False):
+    """
+    Shared plumbing of the async views: no CSRF check (they are token APIs like
+    the DRF views), the logged-in user in ``request.user``, and a 401 for a bad
+    or missing token. With ``device_keys`` a request without a token goes
+    through as ``request.user = None``, and the view checks the device key.
+    """
+    if view is None:
+        return functools.partial(_async_view, device_keys=device_keys)
+
+    @csrf_exempt
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            request.user = await _authenticate_async(request)
+        except (InvalidToken, TokenError):
+            return JsonResponse({'detail': 'Given token not valid for any token type'}, status=401)
+        if request.user is None and not device_keys:
+            return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+@require_GET
+@_async_view
+async def async_dispenser_list(request):
+    """
+    Handles:
+    - GET: List your dispensers, optionally filtered by ``?pantry=``. Pages with
+      ``?after=<last id>`` and ``?page_size=``.
+    """
+    try:
+        after = int(request.GET.get('after', 0))
+        page_size = min(int(request.GET.get('page_size', ASYNC_PAGE_SIZE)), ASYNC_MAX_PAGE_SIZE)
+        pantry_id = int(request.GET['pantry']) if request.GET.get('pantry') else None
+    except ValueError:
+        return JsonResponse({'error': "'after', 'page_size' and 'pantry' must be integers"}, status=400)
+
+    queryset = Dispenser.objects.filter(owner=request.user, id__gt=after).order_by('id')
+    if pantry_id is not None:
+        queryset = queryset.filter(pantry_id=pantry_id)
+    # One row more than the page tells us whether there is a next page
+    with read_from_replica():
+        dispensers = [dispenser async for dispenser in queryset[:page_size + 1]]
+
+    next_url = None
+    if len(dispensers) > page_size:
+        dispensers = dispensers[:page_size]
+        params = request.GET.copy()
+        params['after'] = dispensers[-1].id
+        next_url = request.build_absolute_uri(f'{request.path}?{params.urlencode()}')
+    results = DispenserSerializer(dispensers, many=True).data
+    return JsonResponse({'next': next_url, 'results': level_buffer.overlay(results)})
+
+
+@require_GET
+@_async_view
+async def async_dispenser_detail(request, id):
+    """
+    Handles:
+    - GET: Retrieve a specific dispenser by ID
+    """
+    try:
+        with read_from_replica():
+            dispenser = await Dispenser.objects.aget(id=id, owner=request.user)
+    except Dispenser.DoesNotExist:
+        return JsonResponse({'error': 'Dispenser not found'}, status=404)
+    return JsonResponse(level_buffer.overlay([DispenserSerializer(dispenser).data])[0])
+
+
+@require_POST
+@_async_view(device_keys=True)
+async def async_update_dispenser_level(request, id):
+    """
+    Handles:
+    - POST: Same body, device keys and behaviour as ``/dispensers/<id>/update-level/``
+
+    Django has no async transactions, so the write (UPDATE, read-back and history
+    insert in one transaction) and the alert bookkeeping run in a single
+    ``sync_to_async`` call; the event loop is free while they wait on the database.
+    """
+    # Sensors may send their dispenser's device key instead of a JWT
+    try:
+        raw_key = get_raw_key(get_authorization_header(request))
+    except AuthenticationFailed as e:
+        return JsonResponse({'detail': e.detail}, status=401)
+    if raw_key is not None:
+        device_dispenser_id = await adispenser_for_key(raw_key)
+        if device_dispenser_id is None:
+            return JsonResponse({'detail': 'Invalid or revoked device key.'}, status=401)
+        if device_dispenser_id != id:
+            return JsonResponse({'detail': DeviceKeyScope.message}, status=403)
+    elif request.user is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+
+    try:
+        body = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({'error': 'Body must be JSON'}, status=400)
+
+    serializer = DispenserLevelUpdateSerializer(data=body)
+    if not serializer.is_valid():
+        return JsonResponse({'error': serializer.errors}, status=400)
+    data = serializer.validated_data
+    operation = data['operation']
+
+    owner = None if raw_key is not None else request.user
+    dispenser = await sync_to_async(update_level)(
+        id, operation, data.get(operation), data.get('ts'), owner, data.get('seq'), data['seq_reset']
+    )
+    if dispenser is None:
+        return JsonResponse({'error': 'Dispenser not found'}, status=404)
+    return JsonResponse({'message': _level_update_message(dispenser), 'current_level': dispenser.current_level})
+
+
+# --------------------------------------------------------
+# LIVE EVENTS (SERVER-SENT EVENTS, NEED THE ASGI SERVER)
+# --------------------------------------------------------
+
+EVENTS_KEEPALIVE_SECONDS = 15
+
+
+def _parse_ids(value):
+    """'1,2,3' -> [1, 2, 3]; raises ValueError on anything else"""
+    return [int(part) for part in value.split(',') if part.strip()] if value else []
+
+
+async def dispenser_events(request):
+    """
+    Handles:
+    - GET: A text/event-stream of ``level`` and ``low_stock`` events for
+      ``?floor=1,2`` and/or ``?pantry=3`` (only your own floors and pantries)
+    """
+    # Browsers' EventSource can't set headers, so the token may also come as ?token=
+    try:
+        user = await _authenticate_async(request, allow_query_token=True)
+    except (InvalidToken, TokenError):
+        user = None
+    if user is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+
+    try:
+        floor_ids = _parse_ids(request.GET.get('floor'))
+        pantry_ids = _parse_ids(request.GET.get('pantry'))
+    except ValueError:
+        return JsonResponse({'error': "'floor' and 'pantry' must be comma-separated ids"}, status=400)
+    if not floor_ids and not pantry_ids:
+        return JsonResponse({'error': "Subscribe to at least one 'floor' or 'pantry'"}, status=400)
+
+    # Only let users listen to their own floors and pantries
+    owned_floors = await Floor.objects.filter(id__in=floor_ids, user=user).acount()
+    owned_pantries = await Pantry.objects.filter(id__in=pantry_ids, owner=user).acount()
+    if owned_floors != len(set(floor_ids)) or owned_pantries != len(set(pantry_ids)):
+        return JsonResponse({'error': 'Floor or pantry not found'}, status=404)
+
+    channels = [floor_channel(i) for i in floor_ids] + [pantry_channel(i) for i in pantry_ids]
+    subscription = get_broker().subscribe(channels)
+
+    async def stream():
+        try:
+            yield 'retry: 5000\n\n'  # tells the browser how long to wait before reconnecting
+            while True:
+                try:
+                    event = await subscription.get(timeout=EVENTS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'  # keeps proxies from closing an idle connection
+                    continue
+                yield format_sse(event)
+        finally:
+            # Runs when the client disconnects
+            subscription.close()
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # don't let nginx buffer the stream
+    return response
+
+
+# --------------------------------------------------------
+# METRICS (PROMETHEUS)
+# --------------------------------------------------------
+
+def metrics(request):
+    """
+    Handles:
+    - GET: Per-route request metrics of this process in the Prometheus text format
+
+    When ``METRICS_TOKEN`` is set, scrapers must send it as ``Authorization: Bearer <token>``.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token and not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse(status=401)
+    return HttpResponse(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 
 # --------------------------------------------------------
 # CUSTOM API VIEW FOR AUTH
@@ -0,0 +1,271 @@
+"""
+Write-behind buffering of sensor levels.
+
+Sensors can report the same dispenser several times a second. Normally every
+report is its own committed ``UPDATE`` plus a history row. With write-behind
+enabled, level updates only change the latest level of the dispenser in this
+process's memory. A background thread writes all of them every
+``FLUSH_INTERVAL_MS``: one ``UPDATE`` for all the changed dispensers
+(``bulk_update``) and one ``INSERT`` for their readings. So the number of writes
+grows with the number of dispensers, not with the number of readings. Only the
+latest reading of each dispenser per flush goes into the history.
+
+- A dispenser that drops below its own threshold alerts straight away, from
+  memory. The alert rules need the database, so they are checked for the whole
+  batch in one query when it is written. That is also when recovered dispensers
+  are re-armed.
+- Dispenser list and detail responses show the buffered levels
+  (``PendingLevelsMixin``). The other endpoints read the database, which is at
+  most one flush behind.
+- The first update of a dispenser in each flush window loads it (one query).
+  Later updates in the same window don't touch the database.
+- Readings with a sequence number are checked against the dispenser's
+  ``last_seq`` in memory, so retried and late readings are dropped without a
+  query. The flush writes the new ``last_seq`` with the level.
+
+The buffer lives in one process, and a flush writes absolute levels. Send all
+readings of a dispenser to the same process, and don't mix it with other
+writers of ``current_level``. Levels still in memory are lost if the process
+dies before the next flush.
+
+Configure it with the ``LEVEL_WRITE_BEHIND`` setting. ``FLUSH_INTERVAL_MS: 0``
+starts no thread; then ``level_buffer.flush()`` must be called, which is what
+the tests do.
+"""
+import atexit
+import copy
+import logging
+import threading
+import time
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .alert_rules import alerting_dispensers
+from .cache import invalidate
+from .events import publish_level_change
+from .models import Dispenser, DispenserReading
+from .notifications import notifier
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': False,
+    'FLUSH_INTERVAL_MS': 200,
+    'MAX_PENDING': 10000,  # flush straight away once this many dispensers are waiting
+}
+
+
+def get_setting(name):
+    return getattr(settings, 'LEVEL_WRITE_BEHIND', {}).get(name, DEFAULTS[name])
+
+
+def is_enabled():
+    return get_setting('ENABLED')
+
+
+def new_level(level, max_capacity, operation, amount=None):
+    """The level after an operation, with the same rules as ``levels.level_expression``"""
+    if operation == 'current_level':
+        return min(amount, max_capacity)
+    if operation == 'consume':
+        return max(level - amount, 0)
+    if operation == 'refill':
+        return min(level + amount, max_capacity)
+    if operation == 'refill_to_full':
+        return max_capacity
+    raise ValueError(f"Unknown level operation {operation!r}")
+
+
+@dataclass
+class Pending:
+    """A dispenser waiting to be written. ``dispenser.current_level`` is the buffered level."""
+    dispenser: Dispenser  # with pantry, floor and owner loaded for notifications
+    ts: object = None  # when its latest reading was taken
+
+
+class LevelBuffer:
+    """Latest level per dispenser, written to the database in batches"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}  # dispenser id -> Pending
+        self._flushing = {}  # the batch being written right now
+        self._worker = None
+
+    def update(self, dispenser_id, operation, amount=None, ts=None, owner=None, seq=None, seq_reset=False):
+        """
+        Apply a level update in memory. Returns a copy of the dispenser with its new
+        level, or None when it doesn't exist (or, with ``owner``, isn't theirs).
+        A reading ``seq`` says is old changes nothing; ``applied`` on the copy is then False.
+        """
+        loaded = self._load(dispenser_id)
+        if loaded is None or (owner is not None and loaded.dispenser.owner_id != owner.pk):
+            return None
+        with self._lock:
+            entry = self._pending.get(dispenser_id, loaded)
+            dispenser = entry.dispenser
+            if not dispenser.is_new_reading(seq, seq_reset):
+                dispenser = copy.copy(dispenser)
+                dispenser.applied = False
+                return dispenser
+            self._pending[dispenser_id] = entry
+            dispenser.current_level = new_level(dispenser.current_level, dispenser.max_capacity, operation, amount)
+            if seq is not None:
+                dispenser.last_seq = seq
+            entry.ts = ts or timezone.now()
+            dispenser = copy.copy(dispenser)
+            dispenser.applied = True
+            pending = len(self._pending)
+
+        # Threshold crossings can't wait for the flush. Recovery is left to the flush,
+        # which also knows the alert rules, so a rule alert isn't re-armed here.
+        went_low = dispenser.is_running_low() and notifier.report(dispenser, True)
+        publish_level_change(dispenser, went_low)
+
+        if pending >= get_setting('MAX_PENDING'):
+            self.flush()
+        elif get_setting('FLUSH_INTERVAL_MS'):
+            self._ensure_worker()
+        return dispenser
+
+    def _load(self, dispenser_id):
+        with self._lock:
+            entry = self._pending.get(dispenser_id)
+            if entry is None and dispenser_id in self._flushing:
+                # Being written right now; continue from its level without touching that batch
+                writing = self._flushing[dispenser_id]
+                entry = Pending(copy.copy(writing.dispenser), writing.ts)
+        if entry is not None:
+            return entry
+        dispenser = Dispenser.objects.select_related('pantry__floor__user').filter(id=dispenser_id).first()
+        return Pending(dispenser) if dispenser is not None else None
+
+    def flush(self):
+        """
+        Write every buffered level: one UPDATE for all the dispensers and one INSERT
+        for their readings. Returns the number of dispensers written.
+        """
+        with self._lock:
+            if self._flushing or not self._pending:
+                return 0  # nothing to do, or another thread is already writing
+            batch, self._pending = self._pending, {}
+            self._flushing = batch
+        try:
+            return self._write(batch)
+        except Exception:
+            logger.exception("Failed to write buffered dispenser levels")
+            # Keep them for the next flush, unless newer readings came in meanwhile
+            with self._lock:
+                for dispenser_id, entry in batch.items():
+                    self._pending.setdefault(dispenser_id, entry)
+            return 0
+        finally:
+            with self._lock:
+                self._flushing = {}
+
+    def _write(self, batch):
+        # Skip dispensers that were deleted since they were loaded
+        live = set(Dispenser.objects.filter(id__in=list(batch)).values_list('id', flat=True))
+        entries = [entry for dispenser_id, entry in batch.items() if dispenser_id in live]
+        dispensers = [entry.dispenser for entry in entries]
+        if not dispensers:
+            return 0
+
+        with transaction.atomic():
+            Dispenser.objects.bulk_update(dispensers, ['current_level', 'last_seq'])
+            DispenserReading.objects.bulk_create(
+                DispenserReading(dispenser_id=entry.dispenser.id, ts=entry.ts, level=entry.dispenser.current_level)
+                for entry in entries
+            )
+        # bulk_update sends no signals, so drop the cached copies ourselves
+        invalidate('dispenser', [dispenser.id for dispenser in dispensers], [d.owner_id for d in dispensers])
+
+        # One query for the alert rules of the whole batch. Dispensers with newer
+        # readings waiting are left to the next flush, which sees their latest level.
+        alerting = set(alerting_dispensers().filter(id__in=[d.id for d in dispensers]).values_list('id', flat=True))
+        with self._lock:
+            newer = set(self._pending)
+        for dispenser in dispensers:
+            if dispenser.id not in newer and notifier.report(dispenser, dispenser.id in alerting):
+                publish_level_change(dispenser, went_low=True)
+        return len(dispensers)
+
+    def discard(self, dispenser_id):
+        """Forget a buffered level, e.g. because the dispenser was edited or deleted"""
+        with self._lock:
+            self._pending.pop(dispenser_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+
+    def has_pending(self):
+        return bool(self._pending)
+
+    def overlay(self, rows):
+        """Serialized dispensers with their buffered levels filled in (new dicts, ``rows`` is left alone)"""
+        with self._lock:
+            pending = {
+                dispenser_id: (entry.dispenser.current_level, entry.dispenser.max_capacity, entry.dispenser.threshold)
+                for dispenser_id, entry in self._pending.items()
+            }
+        result = []
+        for row in rows:
+            if row.get('id') in pending:
+                level, max_capacity, threshold = pending[row['id']]
+                row = dict(row)
+                if 'current_level' in row:
+                    row['current_level'] = level
+                if 'fill_pct' in row:
+                    row['fill_pct'] = level * 100.0 / max_capacity if max_capacity else 0.0
+                if 'is_low' in row:
+                    row['is_low'] = level * 100 < threshold * max_capacity
+            result.append(row)
+        return result
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='level-write-behind', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            time.sleep(get_setting('FLUSH_INTERVAL_MS') / 1000)
+            close_old_connections()
+            self.flush()
+
+
+level_buffer = LevelBuffer()
+atexit.register(level_buffer.flush)
+
+
+class PendingLevelsMixin:
+    """
+    Shows the levels still waiting in the write-behind buffer on dispenser list and
+    detail views. Put it before the cache mixins: while levels are buffered, the
+    cached ETag may be out of date, so ``If-None-Match`` is ignored and no ETag is sent.
+    """
+
+    def list(self, request, *args, **kwargs):
+        if not level_buffer.has_pending():
+            return super().list(request, *args, **kwargs)
+        request.META.pop('HTTP_IF_NONE_MATCH', None)
+        response = super().list(request, *args, **kwargs)
+        response.data = {**response.data, 'results': level_buffer.overlay(response.data['results'])}
+        response.headers.pop('ETag', None)
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        if not level_buffer.has_pending():
+            return super().retrieve(request, *args, **kwargs)
+        request.META.pop('HTTP_IF_NONE_MATCH', None)
+        response = super().retrieve(request, *args, **kwargs)
+        response.data = level_buffer.overlay([response.data])[0]
+        response.headers.pop('ETag', None)
+        return response